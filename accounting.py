@@ -9,27 +9,23 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 sys.path.insert(0, currentdir)
 # Import common code
 from sysadmws_common import *
-from gsuite_scripts import *
-import gitlab
 import glob
-import psycopg2
 import textwrap
 from datetime import datetime
 from datetime import timedelta
 from datetime import time
 from dateutil.relativedelta import relativedelta
-from num2words import num2words
 import re
 from zipfile import ZipFile
 import subprocess
-import woocommerce
-import paramiko
 
 # Constants and envs
 
 LOGO="Accounting"
 WORK_DIR = os.environ.get("ACC_WORKDIR", "/opt/sysadmws/accounting")
 LOG_DIR = os.environ.get("ACC_LOGDIR", "/opt/sysadmws/accounting/log")
+CACHE_DIR = os.environ.get("ACC_CACHEDIR", "{0}/.cache".format(WORK_DIR))
+CONFIG_SNAPSHOT = os.environ.get("ACC_CONFIG_SNAPSHOT", "{0}/config.snapshot".format(WORK_DIR))
 LOG_FILE = "accounting.log"
 TARIFFS_SUBDIR = "tariffs"
 CLIENTS_SUBDIR = "clients"
@@ -220,6 +216,7 @@ if __name__ == "__main__":
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--db-structure", dest="db_structure", help="create database structure", action="store_true")
     group.add_argument("--yaml-check", dest="yaml_check", help="check yaml structure", action="store_true")
+    group.add_argument("--build-config-snapshot", dest="build_config_snapshot", help="compile accounting yaml, tariffs and clients into config snapshot file used by all scripts while sources are unchanged", action="store_true")
     group.add_argument("--asset-labels", dest="asset_labels", help="sync asset labels", action="store_true")
     group.add_argument("--issues-check", dest="issues_check", help="report issue activities as new issue in accounting project", action="store_true")
     group.add_argument("--merge-requests-check", dest="merge_requests_check", help="report MR activities as new issue in accounting project", action="store_true")
@@ -254,8 +251,29 @@ if __name__ == "__main__":
     else:
         logger = set_logger(logging.ERROR, LOG_DIR, LOG_FILE)
 
+    # Subsystem loggers, levels can be set separately with ACC_LOG_LEVELS
+    sql_logger = logger.getChild("sql")
+
+    # Import heavy third party modules only for subcommands which use them, the same conditions as for env vars below
+
+    if not (args.yaml_check or args.build_config_snapshot or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
+        import psycopg2
+
+    if not (args.yaml_check or args.build_config_snapshot or args.list_assets_for_client is not None or args.list_assets_for_all_clients or args.db_structure):
+        import gitlab
+        from gsuite_scripts import *
+
+    if args.storage_usage:
+        import paramiko
+
+    if args.make_hourly_invoice_for_client is not None or args.make_hourly_invoice_for_all_clients \
+    or args.make_monthly_invoice_for_client is not None or args.make_monthly_invoice_for_all_clients is not None \
+    or args.make_storage_invoice_for_client is not None or args.make_storage_invoice_for_all_clients is not None:
+        from num2words import num2words
+        import woocommerce
+
     # Skip vars check where not needed
-    if not (args.yaml_check or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
+    if not (args.yaml_check or args.build_config_snapshot or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
 
         PG_DB_HOST = os.environ.get("PG_DB_HOST")
         if PG_DB_HOST is None:
@@ -273,7 +291,7 @@ if __name__ == "__main__":
         if PG_DB_PASS is None:
             raise Exception("Env var PG_DB_PASS missing")
 
-    if not (args.yaml_check or args.list_assets_for_client is not None or args.list_assets_for_all_clients or args.db_structure):
+    if not (args.yaml_check or args.build_config_snapshot or args.list_assets_for_client is not None or args.list_assets_for_all_clients or args.db_structure):
 
         GL_ADMIN_PRIVATE_TOKEN = os.environ.get("GL_ADMIN_PRIVATE_TOKEN")
         if GL_ADMIN_PRIVATE_TOKEN is None:
@@ -321,16 +339,25 @@ if __name__ == "__main__":
         os.chdir(WORK_DIR)
 
         # Skip pgconnect where not needed
-        if not (args.yaml_check or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
+        if not (args.yaml_check or args.build_config_snapshot or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
 
             # Connect to PG
             dsn = "host={} dbname={} user={} password={}".format(PG_DB_HOST, PG_DB_NAME, PG_DB_USER, PG_DB_PASS)
             conn = psycopg2.connect(dsn)
 
+        # Prebuilt config snapshot, used for files unchanged since it was built
+        config_snapshot = ConfigSnapshot(CONFIG_SNAPSHOT, WORK_DIR, logger)
+
         # Read ACC_YAML
-        acc_yaml_dict = load_yaml("{0}/{1}".format(WORK_DIR, ACC_YAML), logger)
+        acc_yaml_dict = load_yaml_cached("{0}/{1}".format(WORK_DIR, ACC_YAML), CACHE_DIR, logger, config_snapshot)
         if acc_yaml_dict is None:
             raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, ACC_YAML))
+
+        # Client registry, each client YAML is loaded once per run, without key material as it is not needed here
+        client_registry = ClientRegistry(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, logger, CACHE_DIR, config_snapshot, secrets=False)
+
+        # Tariff catalog, each tariff file is loaded once per run
+        tariff_catalog = get_tariff_catalog(WORK_DIR, TARIFFS_SUBDIR, logger, CACHE_DIR, config_snapshot)
         
         # Do tasks
 
@@ -355,8 +382,8 @@ if __name__ == "__main__":
             sql = load_file_string("{0}/{1}".format(WORK_DIR, DB_STRUCTURE_FILE), logger)
             try:
                 cur.execute(sql)
-                logger.info("Query execution status:")
-                logger.info(cur.statusmessage)
+                sql_logger.debug("Query execution status:")
+                sql_logger.debug(cur.statusmessage)
                 conn.commit()
             except Exception as e:
                 raise Exception("Caught exception on query execution")
@@ -368,13 +395,16 @@ if __name__ == "__main__":
 
             errors = False
 
+            # Parse all client files concurrently
+            client_registry.preload()
+
             # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+            for client_file in client_registry.files():
                 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                client_dict = client_registry.load(client_file)
                 if client_dict is None:
                     raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
 
@@ -399,7 +429,7 @@ if __name__ == "__main__":
                                                     )
                                                 ):
 
-                    asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now())
+                    asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now(), has_storage=True)
 
                     # If there are assets
                     if len(asset_list) > 0:
@@ -473,12 +503,12 @@ if __name__ == "__main__":
                                                                 )
                                                         ;
                                                         """.format(client_asset_fqdn=asset["fqdn"], storage_asset_fqdn=storage_asset, storage_asset_path=storage_path, mb_used=mb_used)
-                                                        logger.info("Query:")
-                                                        logger.info(sql)
+                                                        sql_logger.debug("Query:")
+                                                        sql_logger.debug(sql)
                                                         try:
                                                             cur.execute(sql)
-                                                            logger.info("Query execution status:")
-                                                            logger.info(cur.statusmessage)
+                                                            sql_logger.debug("Query execution status:")
+                                                            sql_logger.debug(cur.statusmessage)
                                                             conn.commit()
                                                         except Exception as e:
                                                             raise Exception("Caught exception on query execution")
@@ -505,12 +535,12 @@ if __name__ == "__main__":
                 raise Exception("Caught exception on gsuite execution")
 
             # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+            for client_file in client_registry.files(args.update_envelopes_for_client[0] if args.update_envelopes_for_client is not None else None):
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                client_dict = client_registry.load(client_file)
                 if client_dict is None:
                     raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
                 
@@ -630,12 +660,12 @@ if __name__ == "__main__":
             uploaded_pdfs = []
 
             # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+            for client_file in client_registry.files(args.make_pdfs_for_client[0] if args.make_pdfs_for_client is not None else None):
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                client_dict = client_registry.load(client_file)
                 if client_dict is None:
                     raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
                 
@@ -776,12 +806,12 @@ if __name__ == "__main__":
             if args.make_gmail_drafts_for_all_clients or args.print_papers_for_all_clients:
 
                 # For *.yaml in client dir
-                for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+                for client_file in client_registry.files():
 
                     logger.info("Found client file: {0}".format(client_file))
 
                     # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                    client_dict = client_registry.load(client_file)
                     if client_dict is None:
                         raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
 
@@ -818,7 +848,7 @@ if __name__ == "__main__":
                 else:
                     raise Exception("Impossible became possible")
 
-                client_dict = load_client_yaml(WORK_DIR, "{0}/{1}.{2}".format(CLIENTS_SUBDIR, client_in_arg.lower(), YAML_EXT), CLIENTS_SUBDIR, YAML_GLOB, logger)
+                client_dict = client_registry.load("{0}/{1}.{2}".format(CLIENTS_SUBDIR, client_in_arg.lower(), YAML_EXT))
                 if client_dict is None:
                     raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
 
@@ -1187,17 +1217,24 @@ if __name__ == "__main__":
                         else:
                             logger.info("No unprinted invoices for client {0} found".format(client))
 
+        if args.build_config_snapshot:
+
+            build_config_snapshot(CONFIG_SNAPSHOT, WORK_DIR, ACC_YAML, TARIFFS_SUBDIR, CLIENTS_SUBDIR, YAML_GLOB, logger)
+
         if args.yaml_check:
 
+            # Parse all client files concurrently
+            client_registry.preload()
+
             # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+            for client_file in client_registry.files():
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 try:
 
                     # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                    client_dict = client_registry.load(client_file)
                     if client_dict is None:
                         raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
 
@@ -1274,11 +1311,7 @@ if __name__ == "__main__":
 
                                             # If tariff has file key - load it
                                             if "file" in asset_tariff:
-                                                
-                                                tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]), logger)
-                                                if tariff_dict is None:
-                                                    
-                                                    raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
+                                                tariff_catalog.get(asset_tariff["file"])
 
                             except:
                                 logger.error("Asset {asset} yaml check exception".format(asset=asset["fqdn"]))
@@ -1295,12 +1328,12 @@ if __name__ == "__main__":
             gl.auth()
         
             # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+            for client_file in client_registry.files():
                 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                client_dict = client_registry.load(client_file)
                 if client_dict is None:
                     raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
 
@@ -1342,22 +1375,8 @@ if __name__ == "__main__":
                             asset_tariff_list = []
                             for asset_tariff in activated_tariff(asset["tariffs"], datetime.now(), logger)["tariffs"]:
 
-                                # If tariff has file key - load it
-                                if "file" in asset_tariff:
-                                    
-                                    tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]), logger)
-                                    if tariff_dict is None:
-                                        
-                                        raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
-
-                                    # Add tariff plan and service to the tariff list for the label
-                                    asset_tariff_list.append("{0} {1}".format(tariff_dict["plan"], tariff_dict["service"]))
-
-                                # Also take inline plan and service
-                                else:
-
-                                    # Add tariff plan and service to the tariff list for the label
-                                    asset_tariff_list.append("{0} {1}".format(asset_tariff["plan"], asset_tariff["service"]))
+                                # Add tariff plan and service to the tariff list for the label
+                                asset_tariff_list.append(tariff_catalog.plan_label(asset_tariff))
                             
                             # Construct label description
                             asset_label_description = "{0}, {1}".format(asset_activeness, ", ".join(asset_tariff_list))
@@ -1385,12 +1404,12 @@ if __name__ == "__main__":
 
             # For *.yaml in client dir
             clients_dict = {}
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+            for client_file in client_registry.files():
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                client_dict = client_registry.load(client_file)
                 if client_dict is None:
                     raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
 
@@ -1484,25 +1503,25 @@ if __name__ == "__main__":
                             0                                               = ( SELECT count(checked_at) FROM issues_checked WHERE issue_id = issues_and_timelogs.issue_id )
             ;
             """.format(GL_PG_DB_HOST, GL_PG_DB_USER, GL_PG_DB_PASS, GL_PG_DB_NAME)
-            logger.info("Query:")
-            logger.info(sql)
+            sql_logger.debug("Query:")
+            sql_logger.debug(sql)
             try:
                 cur.execute(sql)
-                logger.info("Query execution status:")
-                logger.info(cur.statusmessage)
+                sql_logger.debug("Query execution status:")
+                sql_logger.debug(cur.statusmessage)
             except Exception as e:
                 raise Exception("Caught exception on query execution")
             
             # Save ids in temp table to log
             sql = "SELECT * FROM new_issues;"
-            logger.info("Query:")
-            logger.info(sql)
+            sql_logger.debug("Query:")
+            sql_logger.debug(sql)
             try:
                 cur.execute(sql)
                 for row in cur:
-                    logger.info(row)
-                logger.info("Query execution status:")
-                logger.info(cur.statusmessage)
+                    sql_logger.debug(row)
+                sql_logger.debug("Query execution status:")
+                sql_logger.debug(cur.statusmessage)
             except Exception as e:
                 raise Exception("Caught exception on query execution")
 
@@ -1521,12 +1540,12 @@ if __name__ == "__main__":
                     new_issues
             ;
             """
-            logger.info("Query:")
-            logger.info(sql)
+            sql_logger.debug("Query:")
+            sql_logger.debug(sql)
             try:
                 cur.execute(sql)
-                logger.info("Query execution status:")
-                logger.info(cur.statusmessage)
+                sql_logger.debug("Query execution status:")
+                sql_logger.debug(cur.statusmessage)
             except Exception as e:
                 raise Exception("Caught exception on query execution")
             
@@ -1668,8 +1687,8 @@ if __name__ == "__main__":
                     issues_checked.transaction_id = ( SELECT MAX(transaction_id) FROM issues_checked WHERE issue_id = non_hourly_issues.id GROUP BY issue_id )
             ;
             """.format(GL_PG_DB_HOST, GL_PG_DB_USER, GL_PG_DB_PASS, GL_PG_DB_NAME)
-            logger.info("Query:")
-            logger.info(sql)
+            sql_logger.debug("Query:")
+            sql_logger.debug(sql)
 
             # Read rows
             try:
@@ -1739,14 +1758,14 @@ if __name__ == "__main__":
                             ) AS ns_path
                     ;
                     """.format(GL_PG_DB_HOST, GL_PG_DB_USER, GL_PG_DB_PASS, GL_PG_DB_NAME, row_issue_namespace_id)
-                    logger.info("Query:")
-                    logger.info(sql)
+                    sql_logger.debug("Query:")
+                    sql_logger.debug(sql)
                     try:
                         sub_cur.execute(sql)
                         for sub_row in sub_cur:
                             row_issue_namespace_path = sub_row[0]
-                        logger.info("Query execution status:")
-                        logger.info(sub_cur.statusmessage)
+                        sql_logger.debug("Query execution status:")
+                        sql_logger.debug(sub_cur.statusmessage)
                     except Exception as e:
                         raise Exception("Caught exception on query execution")
 
@@ -1787,10 +1806,10 @@ if __name__ == "__main__":
                     ))
 
                     # Save raw data to log
-                    logger.info(row)
+                    sql_logger.debug(row)
 
-                logger.info("Query execution status:")
-                logger.info(cur.statusmessage)
+                sql_logger.debug("Query execution status:")
+                sql_logger.debug(cur.statusmessage)
             except Exception as e:
                 raise Exception("Caught exception on query execution")
             
@@ -1929,8 +1948,8 @@ if __name__ == "__main__":
                     issues_checked.transaction_id = ( SELECT MAX(transaction_id) FROM issues_checked WHERE issue_id = hourly_issues.id GROUP BY issue_id )
             ;
             """.format(GL_PG_DB_HOST, GL_PG_DB_USER, GL_PG_DB_PASS, GL_PG_DB_NAME)
-            logger.info("Query:")
-            logger.info(sql)
+            sql_logger.debug("Query:")
+            sql_logger.debug(sql)
 
             # Read rows
             try:
@@ -2000,14 +2019,14 @@ if __name__ == "__main__":
                             ) AS ns_path
                     ;
                     """.format(GL_PG_DB_HOST, GL_PG_DB_USER, GL_PG_DB_PASS, GL_PG_DB_NAME, row_issue_namespace_id)
-                    logger.info("Query:")
-                    logger.info(sql)
+                    sql_logger.debug("Query:")
+                    sql_logger.debug(sql)
                     try:
                         sub_cur.execute(sql)
                         for sub_row in sub_cur:
                             row_issue_namespace_path = sub_row[0]
-                        logger.info("Query execution status:")
-                        logger.info(sub_cur.statusmessage)
+                        sql_logger.debug("Query execution status:")
+                        sql_logger.debug(sub_cur.statusmessage)
                     except Exception as e:
                         raise Exception("Caught exception on query execution")
 
@@ -2037,10 +2056,10 @@ if __name__ == "__main__":
                     ))
 
                     # Save raw data to log
-                    logger.info(row)
+                    sql_logger.debug(row)
 
-                logger.info("Query execution status:")
-                logger.info(cur.statusmessage)
+                sql_logger.debug("Query execution status:")
+                sql_logger.debug(cur.statusmessage)
             except Exception as e:
                 raise Exception("Caught exception on query execution")
 
@@ -2070,12 +2089,12 @@ if __name__ == "__main__":
 
             # For *.yaml in client dir
             clients_dict = {}
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+            for client_file in client_registry.files():
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                client_dict = client_registry.load(client_file)
                 if client_dict is None:
                     raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
 
@@ -2163,25 +2182,25 @@ if __name__ == "__main__":
                             0                                               = ( SELECT count(checked_at) FROM merge_requests_checked WHERE merge_request_id = merge_requests_and_timelogs.merge_request_id )
             ;
             """.format(GL_PG_DB_HOST, GL_PG_DB_USER, GL_PG_DB_PASS, GL_PG_DB_NAME)
-            logger.info("Query:")
-            logger.info(sql)
+            sql_logger.debug("Query:")
+            sql_logger.debug(sql)
             try:
                 cur.execute(sql)
-                logger.info("Query execution status:")
-                logger.info(cur.statusmessage)
+                sql_logger.debug("Query execution status:")
+                sql_logger.debug(cur.statusmessage)
             except Exception as e:
                 raise Exception("Caught exception on query execution")
             
             # Save ids in temp table to log
             sql = "SELECT * FROM new_merge_requests;"
-            logger.info("Query:")
-            logger.info(sql)
+            sql_logger.debug("Query:")
+            sql_logger.debug(sql)
             try:
                 cur.execute(sql)
                 for row in cur:
-                    logger.info(row)
-                logger.info("Query execution status:")
-                logger.info(cur.statusmessage)
+                    sql_logger.debug(row)
+                sql_logger.debug("Query execution status:")
+                sql_logger.debug(cur.statusmessage)
             except Exception as e:
                 raise Exception("Caught exception on query execution")
 
@@ -2200,12 +2219,12 @@ if __name__ == "__main__":
                     new_merge_requests
             ;
             """
-            logger.info("Query:")
-            logger.info(sql)
+            sql_logger.debug("Query:")
+            sql_logger.debug(sql)
             try:
                 cur.execute(sql)
-                logger.info("Query execution status:")
-                logger.info(cur.statusmessage)
+                sql_logger.debug("Query execution status:")
+                sql_logger.debug(cur.statusmessage)
             except Exception as e:
                 raise Exception("Caught exception on query execution")
             
@@ -2343,8 +2362,8 @@ if __name__ == "__main__":
                     merge_requests_checked.transaction_id = ( SELECT MAX(transaction_id) FROM merge_requests_checked WHERE merge_request_id = non_hourly_merge_requests.id GROUP BY merge_request_id )
             ;
             """.format(GL_PG_DB_HOST, GL_PG_DB_USER, GL_PG_DB_PASS, GL_PG_DB_NAME)
-            logger.info("Query:")
-            logger.info(sql)
+            sql_logger.debug("Query:")
+            sql_logger.debug(sql)
 
             # Read rows
             try:
@@ -2413,14 +2432,14 @@ if __name__ == "__main__":
                             ) AS ns_path
                     ;
                     """.format(GL_PG_DB_HOST, GL_PG_DB_USER, GL_PG_DB_PASS, GL_PG_DB_NAME, row_merge_request_namespace_id)
-                    logger.info("Query:")
-                    logger.info(sql)
+                    sql_logger.debug("Query:")
+                    sql_logger.debug(sql)
                     try:
                         sub_cur.execute(sql)
                         for sub_row in sub_cur:
                             row_merge_request_namespace_path = sub_row[0]
-                        logger.info("Query execution status:")
-                        logger.info(sub_cur.statusmessage)
+                        sql_logger.debug("Query execution status:")
+                        sql_logger.debug(sub_cur.statusmessage)
                     except Exception as e:
                         raise Exception("Caught exception on query execution")
 
@@ -2460,10 +2479,10 @@ if __name__ == "__main__":
                     ))
 
                     # Save raw data to log
-                    logger.info(row)
+                    sql_logger.debug(row)
 
-                logger.info("Query execution status:")
-                logger.info(cur.statusmessage)
+                sql_logger.debug("Query execution status:")
+                sql_logger.debug(cur.statusmessage)
             except Exception as e:
                 raise Exception("Caught exception on query execution")
             
@@ -2598,8 +2617,8 @@ if __name__ == "__main__":
                     merge_requests_checked.transaction_id = ( SELECT MAX(transaction_id) FROM merge_requests_checked WHERE merge_request_id = hourly_merge_requests.id GROUP BY merge_request_id )
             ;
             """.format(GL_PG_DB_HOST, GL_PG_DB_USER, GL_PG_DB_PASS, GL_PG_DB_NAME)
-            logger.info("Query:")
-            logger.info(sql)
+            sql_logger.debug("Query:")
+            sql_logger.debug(sql)
 
             # Read rows
             try:
@@ -2668,14 +2687,14 @@ if __name__ == "__main__":
                             ) AS ns_path
                     ;
                     """.format(GL_PG_DB_HOST, GL_PG_DB_USER, GL_PG_DB_PASS, GL_PG_DB_NAME, row_merge_request_namespace_id)
-                    logger.info("Query:")
-                    logger.info(sql)
+                    sql_logger.debug("Query:")
+                    sql_logger.debug(sql)
                     try:
                         sub_cur.execute(sql)
                         for sub_row in sub_cur:
                             row_merge_request_namespace_path = sub_row[0]
-                        logger.info("Query execution status:")
-                        logger.info(sub_cur.statusmessage)
+                        sql_logger.debug("Query execution status:")
+                        sql_logger.debug(sub_cur.statusmessage)
                     except Exception as e:
                         raise Exception("Caught exception on query execution")
 
@@ -2704,10 +2723,10 @@ if __name__ == "__main__":
                     ))
 
                     # Save raw data to log
-                    logger.info(row)
+                    sql_logger.debug(row)
 
-                logger.info("Query execution status:")
-                logger.info(cur.statusmessage)
+                sql_logger.debug("Query execution status:")
+                sql_logger.debug(cur.statusmessage)
             except Exception as e:
                 raise Exception("Caught exception on query execution")
 
@@ -2789,25 +2808,25 @@ if __name__ == "__main__":
                                     )
             ;
             """.format(GL_PG_DB_HOST, GL_PG_DB_USER, GL_PG_DB_PASS, GL_PG_DB_NAME, hourly_employee)
-            logger.info("Query:")
-            logger.info(sql)
+            sql_logger.debug("Query:")
+            sql_logger.debug(sql)
             try:
                 cur.execute(sql)
-                logger.info("Query execution status:")
-                logger.info(cur.statusmessage)
+                sql_logger.debug("Query execution status:")
+                sql_logger.debug(cur.statusmessage)
             except Exception as e:
                 raise Exception("Caught exception on query execution")
             
             # Save ids in temp table to log
             sql = "SELECT * FROM hourly_employee_timelogs_unchecked;"
-            logger.info("Query:")
-            logger.info(sql)
+            sql_logger.debug("Query:")
+            sql_logger.debug(sql)
             try:
                 cur.execute(sql)
                 for row in cur:
-                    logger.info(row)
-                logger.info("Query execution status:")
-                logger.info(cur.statusmessage)
+                    sql_logger.debug(row)
+                sql_logger.debug("Query execution status:")
+                sql_logger.debug(cur.statusmessage)
             except Exception as e:
                 raise Exception("Caught exception on query execution")
 
@@ -2826,12 +2845,12 @@ if __name__ == "__main__":
                     hourly_employee_timelogs_unchecked
             ;
             """
-            logger.info("Query:")
-            logger.info(sql)
+            sql_logger.debug("Query:")
+            sql_logger.debug(sql)
             try:
                 cur.execute(sql)
-                logger.info("Query execution status:")
-                logger.info(cur.statusmessage)
+                sql_logger.debug("Query execution status:")
+                sql_logger.debug(cur.statusmessage)
             except Exception as e:
                 raise Exception("Caught exception on query execution")
 
@@ -2972,8 +2991,8 @@ if __name__ == "__main__":
                     hourly_employee_timelogs_checked_transaction_report.timelog_updated
             ;
             """.format(GL_PG_DB_HOST, GL_PG_DB_USER, GL_PG_DB_PASS, GL_PG_DB_NAME)
-            logger.info("Query:")
-            logger.info(sql)
+            sql_logger.debug("Query:")
+            sql_logger.debug(sql)
            
             # Set sum to zero
             sum_seconds = 0
@@ -3059,14 +3078,14 @@ if __name__ == "__main__":
                             ) AS ns_path
                     ;
                     """.format(GL_PG_DB_HOST, GL_PG_DB_USER, GL_PG_DB_PASS, GL_PG_DB_NAME, row_issue_namespace_id)
-                    logger.info("Query:")
-                    logger.info(sql)
+                    sql_logger.debug("Query:")
+                    sql_logger.debug(sql)
                     try:
                         sub_cur.execute(sql)
                         for sub_row in sub_cur:
                             row_issue_namespace_path = sub_row[0]
-                        logger.info("Query execution status:")
-                        logger.info(sub_cur.statusmessage)
+                        sql_logger.debug("Query execution status:")
+                        sql_logger.debug(sub_cur.statusmessage)
                     except Exception as e:
                         raise Exception("Caught exception on query execution")
 
@@ -3092,14 +3111,14 @@ if __name__ == "__main__":
                     ))
 
                     # Save raw data to log
-                    logger.info(row)
+                    sql_logger.debug(row)
 
                     # Add to sum if not hourly
                     if not row_issue_is_hourly:
                         sum_seconds = sum_seconds + row_time_spent
                 
-                logger.info("Query execution status:")
-                logger.info(cur.statusmessage)
+                sql_logger.debug("Query execution status:")
+                sql_logger.debug(cur.statusmessage)
             except Exception as e:
                 raise Exception("Caught exception on query execution")
 
@@ -3261,8 +3280,8 @@ if __name__ == "__main__":
                     hourly_employee_timelogs_checked_transaction_report.timelog_updated
             ;
             """.format(GL_PG_DB_HOST, GL_PG_DB_USER, GL_PG_DB_PASS, GL_PG_DB_NAME)
-            logger.info("Query:")
-            logger.info(sql)
+            sql_logger.debug("Query:")
+            sql_logger.debug(sql)
            
             # Set sum to zero
             sum_seconds = 0
@@ -3347,14 +3366,14 @@ if __name__ == "__main__":
                             ) AS ns_path
                     ;
                     """.format(GL_PG_DB_HOST, GL_PG_DB_USER, GL_PG_DB_PASS, GL_PG_DB_NAME, row_merge_request_namespace_id)
-                    logger.info("Query:")
-                    logger.info(sql)
+                    sql_logger.debug("Query:")
+                    sql_logger.debug(sql)
                     try:
                         sub_cur.execute(sql)
                         for sub_row in sub_cur:
                             row_merge_request_namespace_path = sub_row[0]
-                        logger.info("Query execution status:")
-                        logger.info(sub_cur.statusmessage)
+                        sql_logger.debug("Query execution status:")
+                        sql_logger.debug(sub_cur.statusmessage)
                     except Exception as e:
                         raise Exception("Caught exception on query execution")
 
@@ -3379,14 +3398,14 @@ if __name__ == "__main__":
                     ))
 
                     # Save raw data to log
-                    logger.info(row)
+                    sql_logger.debug(row)
 
                     # Add to sum if not hourly
                     if not row_merge_request_is_hourly:
                         sum_seconds = sum_seconds + row_time_spent
                 
-                logger.info("Query execution status:")
-                logger.info(cur.statusmessage)
+                sql_logger.debug("Query execution status:")
+                sql_logger.debug(cur.statusmessage)
             except Exception as e:
                 raise Exception("Caught exception on query execution")
 
@@ -3536,7 +3555,7 @@ if __name__ == "__main__":
                     client_name = timelogs_check_client.lower()
 
                     # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, "{0}/{1}.{2}".format(CLIENTS_SUBDIR, client_name, YAML_EXT), CLIENTS_SUBDIR, YAML_GLOB, logger)
+                    client_dict = client_registry.load("{0}/{1}.{2}".format(CLIENTS_SUBDIR, client_name, YAML_EXT))
                     if client_dict is None:
                         raise Exception("Config file error or missing: {0}/{1}/{2}.{3}".format(WORK_DIR, CLIENTS_SUBDIR, client_name, YAML_EXT))
 
@@ -3665,38 +3684,38 @@ if __name__ == "__main__":
                     ;
                     """.format(host=GL_PG_DB_HOST, user=GL_PG_DB_USER, password=GL_PG_DB_PASS, dbname=GL_PG_DB_NAME, projects=timelogs_check_client_projects, where_timelogs=where_timelogs)
                 
-                logger.info("Query:")
-                logger.info(sql)
+                sql_logger.debug("Query:")
+                sql_logger.debug(sql)
                 try:
                     cur.execute(sql)
-                    logger.info("Query execution status:")
-                    logger.info(cur.statusmessage)
+                    sql_logger.debug("Query execution status:")
+                    sql_logger.debug(cur.statusmessage)
                 except Exception as e:
                     raise Exception("Caught exception on query execution")
                 
                 # Save ids in temp table to log
 
                 sql = "SELECT * FROM hourly_issue_timelogs_unchecked;"
-                logger.info("Query:")
-                logger.info(sql)
+                sql_logger.debug("Query:")
+                sql_logger.debug(sql)
                 try:
                     cur.execute(sql)
                     for row in cur:
-                        logger.info(row)
-                    logger.info("Query execution status:")
-                    logger.info(cur.statusmessage)
+                        sql_logger.debug(row)
+                    sql_logger.debug("Query execution status:")
+                    sql_logger.debug(cur.statusmessage)
                 except Exception as e:
                     raise Exception("Caught exception on query execution")
 
                 sql = "SELECT * FROM hourly_merge_request_timelogs_unchecked;"
-                logger.info("Query:")
-                logger.info(sql)
+                sql_logger.debug("Query:")
+                sql_logger.debug(sql)
                 try:
                     cur.execute(sql)
                     for row in cur:
-                        logger.info(row)
-                    logger.info("Query execution status:")
-                    logger.info(cur.statusmessage)
+                        sql_logger.debug(row)
+                    sql_logger.debug("Query execution status:")
+                    sql_logger.debug(cur.statusmessage)
                 except Exception as e:
                     raise Exception("Caught exception on query execution")
 
@@ -3727,12 +3746,12 @@ if __name__ == "__main__":
                         hourly_merge_request_timelogs_unchecked
                 ;
                 """
-                logger.info("Query:")
-                logger.info(sql)
+                sql_logger.debug("Query:")
+                sql_logger.debug(sql)
                 try:
                     cur.execute(sql)
-                    logger.info("Query execution status:")
-                    logger.info(cur.statusmessage)
+                    sql_logger.debug("Query execution status:")
+                    sql_logger.debug(cur.statusmessage)
                 except Exception as e:
                     raise Exception("Caught exception on query execution")
 
@@ -4007,12 +4026,15 @@ if __name__ == "__main__":
                         tr_timelog_id
                 ;
                 """.format(GL_PG_DB_HOST, GL_PG_DB_USER, GL_PG_DB_PASS, GL_PG_DB_NAME)
-                logger.info("Query:")
-                logger.info(sql)
+                sql_logger.debug("Query:")
+                sql_logger.debug(sql)
                
                 # Dict of lists to store hourly details for clients (no sense to mix different clients in one list)
                 hourly_details = {}
 
+                # Dict of assets with their tariff timelines by fqdn per client, filled once per client on first label check
+                hourly_client_assets = {}
+
                 # imr belows stands for "issue or merge request"
 
                 # Read rows
@@ -4088,14 +4110,14 @@ if __name__ == "__main__":
                                 ) AS ns_path
                         ;
                         """.format(GL_PG_DB_HOST, GL_PG_DB_USER, GL_PG_DB_PASS, GL_PG_DB_NAME, row_project_namespace_id)
-                        logger.info("Query:")
-                        logger.info(sql)
+                        sql_logger.debug("Query:")
+                        sql_logger.debug(sql)
                         try:
                             sub_cur.execute(sql)
                             for sub_row in sub_cur:
                                 row_project_namespace_path = sub_row[0]
-                            logger.info("Query execution status:")
-                            logger.info(sub_cur.statusmessage)
+                            sql_logger.debug("Query execution status:")
+                            sql_logger.debug(sub_cur.statusmessage)
                         except Exception as e:
                             raise Exception("Caught exception on query execution")
 
@@ -4129,30 +4151,29 @@ if __name__ == "__main__":
                                 client_name = acc_yaml_dict["projects"][row_project_path_with_namespace]["client"].lower()
 
                                 # Load client YAML
-                                client_dict = load_client_yaml(WORK_DIR, "{0}/{1}.{2}".format(CLIENTS_SUBDIR, client_name, YAML_EXT), CLIENTS_SUBDIR, YAML_GLOB, logger)
+                                client_dict = client_registry.load("{0}/{1}.{2}".format(CLIENTS_SUBDIR, client_name, YAML_EXT))
                                 if client_dict is None:
                                     raise Exception("Config file error or missing: {0}/{1}/{2}.{3}".format(WORK_DIR, CLIENTS_SUBDIR, client_name, YAML_EXT))
 
                                 # Check if other label name is asset
                                 else:
 
-                                    asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now(), False)
-
-                                    # If there are assets
-                                    if len(asset_list) > 0:
+                                    if client_name not in hourly_client_assets:
+                                        hourly_client_assets[client_name] = {}
+                                        for client_asset in get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now(), False):
+                                            hourly_client_assets[client_name][client_asset["fqdn"]] = (client_asset, TariffTimeline(client_asset["tariffs"]))
 
-                                        # Iterate over assets in client
-                                        for client_asset in asset_list:
+                                    # Check if asset name matches label
+                                    if row_imr_labels_split_label in hourly_client_assets[client_name]:
 
-                                            # Check if asset name matches label
-                                            if client_asset["fqdn"] == row_imr_labels_split_label:
+                                        client_asset, client_asset_timeline = hourly_client_assets[client_name][row_imr_labels_split_label]
 
-                                                # Find checked tariff
-                                                try:
-                                                    checked_tariffs = activated_tariff(client_asset["tariffs"], row_timelog_updated, logger)["tariffs"]
-                                                except:
-                                                    logger.error("Asset {asset} imr {gitlab}/{imr} find active tariff error".format(asset=client_asset["fqdn"], gitlab=acc_yaml_dict["gitlab"]["url"], imr=row_imr_link))
-                                                    raise
+                                        # Find checked tariff via compiled tariff timeline of the asset
+                                        try:
+                                            checked_tariffs = client_asset_timeline.at(row_timelog_updated)["tariffs"]
+                                        except:
+                                            logger.error("Asset {asset} imr {gitlab}/{imr} find active tariff error".format(asset=client_asset["fqdn"], gitlab=acc_yaml_dict["gitlab"]["url"], imr=row_imr_link))
+                                            raise
 
                                 # Check if we have some tariff to check
                                 # It is ok if None - it means the label is not asset label (not monetazible)
@@ -4162,73 +4183,36 @@ if __name__ == "__main__":
                                     checked_tariff_rate = 0
                                     checked_tariff_currency = ""
 
-                                    # Take the first (upper and current) tariff and check it
+                                    # Take the first (upper and current) tariff and check it, file tariffs are taken from catalog, inline plan and service as is
                                     for checked_tariff in checked_tariffs:
 
-                                        # If tariff has file key - load it
-                                        if "file" in checked_tariff:
-                                            
-                                            tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, checked_tariff["file"]), logger)
-                                            if tariff_dict is None:
-                                                
-                                                raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, checked_tariff["file"]))
-
-                                            # Check if tariff has hourly
-                                            if "hourly" in tariff_dict:
-
-                                                # Only if no previous tariff found
-                                                if checked_tariff_rate == 0 and checked_tariff_currency == "":
-
-                                                    # Set found tariff
-                                                    checked_tariff_rate = tariff_dict["hourly"]["rate"]
-                                                    checked_tariff_currency = tariff_dict["hourly"]["currency"]
-                                                    checked_tariff_plan = tariff_dict["service"] + " " + tariff_dict["plan"] + " rev. " + str(tariff_dict["revision"])
-                                                    if "woocommerce_product_id" in tariff_dict["hourly"]:
-                                                        checked_woocommerce_product_id = tariff_dict["hourly"]["woocommerce_product_id"]
-                                                    else:
-                                                        checked_woocommerce_product_id = None
+                                        # Check if tariff has hourly
+                                        checked_tariff_hourly = tariff_catalog.rate(checked_tariff, "hourly")
+                                        if checked_tariff_hourly is not None:
 
-                                                # If there is a previous tarfiff found
+                                            # Only if no previous tariff found
+                                            if checked_tariff_rate == 0 and checked_tariff_currency == "":
+
+                                                # Set found tariff
+                                                checked_tariff_rate = checked_tariff_hourly["rate"]
+                                                checked_tariff_currency = checked_tariff_hourly["currency"]
+                                                checked_tariff_plan = tariff_catalog.plan_revision(checked_tariff)
+                                                if "woocommerce_product_id" in checked_tariff_hourly:
+                                                    checked_woocommerce_product_id = checked_tariff_hourly["woocommerce_product_id"]
                                                 else:
+                                                    checked_woocommerce_product_id = None
 
-                                                    # Check if hourly tariff is not the same as found
-                                                    if not (checked_tariff_rate == tariff_dict["hourly"]["rate"] and checked_tariff_currency == tariff_dict["hourly"]["currency"]):
+                                            # If there is a previous tarfiff found
+                                            else:
 
-                                                        error_text = "Error found on label {}, several tariffs may apply to the same label, but hourly rate should be the same, checked_tariff_rate = {}, tariff_dict_hourly_rate = {}, checked_tariff_currency = {}, tariff_dict_hourly_currency = {}".format(row_imr_labels_split_label, checked_tariff_rate, tariff_dict["hourly"]["rate"], checked_tariff_currency, tariff_dict["hourly"]["currency"])
-                                                        if args.no_exceptions_on_label_errors:
-                                                            print(error_text)
-                                                        else:
-                                                            raise Exception(error_text)
+                                                # Check if hourly tariff is not the same as found
+                                                if not (checked_tariff_rate == checked_tariff_hourly["rate"] and checked_tariff_currency == checked_tariff_hourly["currency"]):
 
-                                        # Also take inline plan and service
-                                        else:
-                                            
-                                            # Check if tariff has hourly
-                                            if "hourly" in checked_tariff:
-
-                                                # Only if no previous tariff found
-                                                if checked_tariff_rate == 0 and checked_tariff_currency == "":
-
-                                                    # Set found tariff
-                                                    checked_tariff_rate = checked_tariff["hourly"]["rate"]
-                                                    checked_tariff_currency = checked_tariff["hourly"]["currency"]
-                                                    checked_tariff_plan = checked_tariff["service"] + " " + checked_tariff["plan"] + " rev. " + str(checked_tariff["revision"])
-                                                    if "woocommerce_product_id" in checked_tariff["hourly"]:
-                                                        checked_woocommerce_product_id = checked_tariff["hourly"]["woocommerce_product_id"]
+                                                    error_text = "Error found on label {}, several tariffs may apply to the same label, but hourly rate should be the same, checked_tariff_rate = {}, tariff_hourly_rate = {}, checked_tariff_currency = {}, tariff_hourly_currency = {}".format(row_imr_labels_split_label, checked_tariff_rate, checked_tariff_hourly["rate"], checked_tariff_currency, checked_tariff_hourly["currency"])
+                                                    if args.no_exceptions_on_label_errors:
+                                                        print(error_text)
                                                     else:
-                                                        checked_woocommerce_product_id = None
-
-                                                # If there is a previous tarfiff found
-                                                else:
-
-                                                    # Check if hourly tariff is not the same as found
-                                                    if not (checked_tariff_rate == checked_tariff["hourly"]["rate"] and checked_tariff_currency == checked_tariff["hourly"]["currency"]):
-
-                                                        error_text = "Error found on label {}, several tariffs may apply to the same label, but hourly rate should be the same checked_tariff_rate = {}, checked_tariff_hourly_rate = {}, checked_tariff_currency = {}, checked_tariff_hourly_currency = {}".format(row_imr_labels_split_label, checked_tariff_rate, checked_tariff["hourly"]["rate"], checked_tariff_currency, checked_tariff["hourly"]["currency"])
-                                                        if args.no_exceptions_on_label_errors:
-                                                            print(error_text)
-                                                        else:
-                                                            raise Exception(error_text)
+                                                        raise Exception(error_text)
 
                                     # Only if no previous row tariff found
                                     if row_tariff_rate == 0 and row_tariff_currency == "":
@@ -4301,10 +4285,10 @@ if __name__ == "__main__":
                             hourly_details[client_name].append(hourly_details_new_item)
 
                         # Save raw data to log
-                        logger.info(row)
+                        sql_logger.debug(row)
 
-                    logger.info("Query execution status:")
-                    logger.info(cur.statusmessage)
+                    sql_logger.debug("Query execution status:")
+                    sql_logger.debug(cur.statusmessage)
                 except Exception as e:
                     raise Exception("Caught exception on query execution")
 
@@ -4322,12 +4306,12 @@ if __name__ == "__main__":
 
                     # For *.yaml in client dir
 
-                    for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+                    for client_file in client_registry.files():
 
                         logger.info("Found client file: {0}".format(client_file))
 
                         # Load client YAML
-                        client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                        client_dict = client_registry.load(client_file)
                         if client_dict is None:
                             raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
 
@@ -4359,7 +4343,7 @@ if __name__ == "__main__":
 
                     client_in_arg, month_in_arg = args.make_monthly_invoice_for_client
 
-                    client_dict = load_client_yaml(WORK_DIR, "{0}/{1}.{2}".format(CLIENTS_SUBDIR, client_in_arg.lower(), YAML_EXT), CLIENTS_SUBDIR, YAML_GLOB, logger)
+                    client_dict = client_registry.load("{0}/{1}.{2}".format(CLIENTS_SUBDIR, client_in_arg.lower(), YAML_EXT))
                     if client_dict is None:
                         raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
 
@@ -4403,20 +4387,20 @@ if __name__ == "__main__":
 
                                     client_asset_tariffs_dict[client][asset["fqdn"]] = []
 
-                                    # Find checked tariff
-                                    for asset_tariff in activated_tariff(asset["tariffs"], needed_month_for_tariff, logger)["tariffs"]:
+                                    # Find checked tariff, its activation and adding dates
+                                    asset_activated_tariff = activated_tariff(asset["tariffs"], needed_month_for_tariff, logger)
+                                    asset_activated_date = str(asset_activated_tariff["activated"].strftime("%Y-%m-%d"))
+                                    asset_added_date = str(asset_activated_tariff["added"].strftime("%Y-%m-%d"))
+                                    for asset_tariff in asset_activated_tariff["tariffs"]:
 
-                                        # If tariff has file key - load it
+                                        # If tariff has file key - take own copy from catalog as per asset keys are added
                                         if "file" in asset_tariff:
                                             
-                                            tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]), logger)
-                                            if tariff_dict is None:
-                                                
-                                                raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
+                                            tariff_dict = dict(tariff_catalog.get(asset_tariff["file"]))
 
                                             # Add tariff activation date per asset
-                                            tariff_dict["activated_date"] = str(activated_tariff(asset["tariffs"], needed_month_for_tariff, logger)["activated"].strftime("%Y-%m-%d"))
-                                            tariff_dict["added_date"] = str(activated_tariff(asset["tariffs"], needed_month_for_tariff, logger)["added"].strftime("%Y-%m-%d"))
+                                            tariff_dict["activated_date"] = asset_activated_date
+                                            tariff_dict["added_date"] = asset_added_date
                                         
                                             # Add migrated key
                                             if "migrated_from" in asset_tariff:
@@ -4431,12 +4415,14 @@ if __name__ == "__main__":
                                             # Add tariff to the tariff list for the asset
                                             client_asset_tariffs_dict[client][asset["fqdn"]].append(tariff_dict)
 
-                                        # Also take inline plan and service
+                                        # Also take own copy of inline plan and service as per asset keys are added
                                         else:
 
+                                            tariff_dict = dict(asset_tariff)
+
                                             # Add tariff activation date per asset
-                                            asset_tariff["activated_date"] = str(activated_tariff(asset["tariffs"], needed_month_for_tariff, logger)["activated"].strftime("%Y-%m-%d"))
-                                            asset_tariff["added_date"] = str(activated_tariff(asset["tariffs"], needed_month_for_tariff, logger)["added"].strftime("%Y-%m-%d"))
+                                            tariff_dict["activated_date"] = asset_activated_date
+                                            tariff_dict["added_date"] = asset_added_date
                                             
                                             # Add migrated key
                                             if "migrated_from" in asset_tariff:
@@ -4449,7 +4435,7 @@ if __name__ == "__main__":
                                                     tariff_dict["monthly_employee_share"][empl_email] = empl_share
                                 
                                             # Add tariff to the tariff list for the asset
-                                            client_asset_tariffs_dict[client][asset["fqdn"]].append(asset_tariff)
+                                            client_asset_tariffs_dict[client][asset["fqdn"]].append(tariff_dict)
 
                                 else:
                                     logger.info("Not active asset: {0}".format(asset["fqdn"]))
@@ -4491,7 +4477,7 @@ if __name__ == "__main__":
                     # Check invoice shift from client yaml if exist, if not = 0
                     
                     # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, "{0}/{1}.{2}".format(CLIENTS_SUBDIR, client.lower(), YAML_EXT), CLIENTS_SUBDIR, YAML_GLOB, logger)
+                    client_dict = client_registry.load("{0}/{1}.{2}".format(CLIENTS_SUBDIR, client.lower(), YAML_EXT))
                     if client_dict is None:
                         raise Exception("Config file error or missing: {0}/{1}/{2}.{3}".format(WORK_DIR, CLIENTS_SUBDIR, client, YAML_EXT))
 
@@ -4503,90 +4489,24 @@ if __name__ == "__main__":
                     needed_month_per_client[client] = datetime.today() + relativedelta(months=month_delta)
                     monthly_period = str(needed_month_per_client[client].strftime("%Y-%m"))
 
+                    # Last billing date of client is the same for all tariffs
+                    if client.lower() in invoices_dict:
+                        try:
+                            last_client_billing_date = datetime.strptime(invoices_dict[client.lower()][-1]["date_created"], "%Y-%m-%d")
+                        except IndexError:
+                            last_client_billing_date = datetime.strptime("1970-01-01", "%Y-%m-%d")
+                    else:
+                        last_client_billing_date = datetime.strptime("1970-01-01", "%Y-%m-%d")
+
                     # Iterate over client assets
                     for asset in client_asset_tariffs_dict[client]:
 
                         # Iterate over tariffs for the asset
                         for tariff in client_asset_tariffs_dict[client][asset]:
-                            
-                            # Calc period portion
-
-                            # Get crucial dates
-                            activated_date_date = datetime.strptime(tariff["activated_date"], "%Y-%m-%d")
-                            added_date_date = datetime.strptime(tariff["added_date"], "%Y-%m-%d")
-                            if client.lower() in invoices_dict:
-                                try:
-                                    last_client_billing_date = datetime.strptime(invoices_dict[client.lower()][-1]["date_created"], "%Y-%m-%d")
-                                except IndexError:
-                                    last_client_billing_date = datetime.strptime("1970-01-01", "%Y-%m-%d")
-                            else:
-                                last_client_billing_date = datetime.strptime("1970-01-01", "%Y-%m-%d")
-                            first_day_of_needed_month = needed_month_per_client[client].replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-                            last_day_of_needed_month = first_day_of_needed_month + relativedelta(months=1, days=-1)
-                            first_day_of_activated_date_month = activated_date_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-                            last_day_of_activated_date_month = first_day_of_activated_date_month + relativedelta(months=1, days=-1)
-
-                            # Just add 1 portion for migrated assets, they were certainly billed before
-                            if "migrated" in tariff:
-
-                                # Just add one whole month
-                                period_portion = 1
-
-                            else:
-
-                                # Calculate diff between activated_date_date and last_day_of_needed_month
-                                # We need +1 for each whole month and +0.x for partial month
-
-                                # Give +1 for each month between last_day_of_activated_date_month and last_day_of_needed_month
-                                whole_months = (last_day_of_needed_month.year - last_day_of_activated_date_month.year) * 12 + last_day_of_needed_month.month - last_day_of_activated_date_month.month
-
-                                # Give decimal for partial month
-                                partial_month = (last_day_of_activated_date_month.day - activated_date_date.day + 1) / (last_day_of_activated_date_month.day)
-
-                                # Period portion is a sum of all whole months and partial month
-                                period_portion = round(whole_months + partial_month, 2)
-
-                                # We need to decide if we need to bill portion > 1 if it is larger than 1
-                                if period_portion > 1:
-
-                                    # If added_date_date <= last_client_billing_date --- no, the gap of billing was billed last time
-                                    if (added_date_date - last_client_billing_date).days <= 0:
-
-                                        # Just add one whole month
-                                        period_portion = 1
-                                
-                                # If added_date_date > last_client_billing_date --- yes, we need to fill the gap of billing with portion > 1, so just leave portion as is
-
-                                # If period_portion < 0 --- then activation_date is after last_day_of_needed_month, just take 0
-                                if period_portion < 0:
-
-                                    period_portion = 0
-                            
-                            # Calc employee share
-                            price_in_period_employee_share = {}
-                            if "monthly_employee_share" in tariff:
-                                for empl_email, empl_share in tariff["monthly_employee_share"].items():
-                                    price_in_period_employee_share[empl_email] = round(empl_share * tariff["monthly"]["rate"] * period_portion / 100, 2)
-
-                            # Prepare row to save in monthly_details
-                            monthly_details_new_item = {
-                                "asset_fqdn":                       asset,
-                                "activated_date":                   tariff["activated_date"],
-                                "service":                          tariff["service"],
-                                "plan":                             tariff["plan"],
-                                "revision":                         tariff["revision"],
-                                "tariff_plan":                      tariff["service"] + " " + tariff["plan"] + " rev. " + str(tariff["revision"]),
-                                "tariff_currency":                  tariff["monthly"]["currency"],
-                                "tariff_rate":                      tariff["monthly"]["rate"],
-                                "period":                           monthly_period,
-                                "period_portion":                   period_portion,
-                                "price_in_period":                  round(tariff["monthly"]["rate"] * period_portion, 2),
-                                "woocommerce_product_id":           tariff["monthly"]["woocommerce_product_id"] if "woocommerce_product_id" in tariff["monthly"] else None,
-                                "price_in_period_employee_share":   price_in_period_employee_share
-                            }
 
-                            # Save monthly details for a client
-                            monthly_details[client].append(monthly_details_new_item)
+                            # Calc period portion and save monthly details for a client
+                            period_portion = monthly_period_portion(tariff, needed_month_per_client[client], last_client_billing_date)
+                            monthly_details[client].append(monthly_details_item(asset, tariff, monthly_period, period_portion))
 
                     # Sort details:
                     # - Activation date
@@ -4648,8 +4568,8 @@ if __name__ == "__main__":
                         client_asset_fqdn, storage_asset_fqdn, storage_asset_path
                 ;
                 """.format(month_shift=month_shift_back)
-                logger.info("Query:")
-                logger.info(sql)
+                sql_logger.debug("Query:")
+                sql_logger.debug(sql)
 
                 # Read rows and fill per asset dict
                 try:
@@ -4678,8 +4598,8 @@ if __name__ == "__main__":
                         logger.info("Storage usage for asset {asset}, storage_asset {storage_asset}, storage_path {storage_path}:".format(asset=row_client_asset_fqdn, storage_asset=row_storage_asset_fqdn, storage_path=row_storage_asset_path))
                         logger.info(asset_storage_usage_monthly[(row_client_asset_fqdn, row_storage_asset_fqdn, row_storage_asset_path)])
 
-                    logger.info("Query execution status:")
-                    logger.info(cur.statusmessage)
+                    sql_logger.debug("Query execution status:")
+                    sql_logger.debug(cur.statusmessage)
                 except Exception as e:
                     raise Exception("Caught exception on query execution")
 
@@ -4687,12 +4607,12 @@ if __name__ == "__main__":
                 storage_details = {}
 
                 # For *.yaml in client dir
-                for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+                for client_file in client_registry.files(needed_client):
                     
                     logger.info("Found client file: {0}".format(client_file))
 
                     # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                    client_dict = client_registry.load(client_file)
                     if client_dict is None:
                         raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
 
@@ -4717,7 +4637,7 @@ if __name__ == "__main__":
                                                                                                                                                                 )
                                                                                                                                                             ):
 
-                        asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now())
+                        asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now(), has_storage=True)
 
                         # If there are assets
                         if len(asset_list) > 0:
@@ -4733,51 +4653,25 @@ if __name__ == "__main__":
 
                                     storage_tariff_found = False
                                     
+                                    # File tariffs are taken from catalog, inline plan and service as is
                                     for tariff in activated_tariff(asset["tariffs"], needed_month_for_tariff, logger)["tariffs"]:
 
-                                        # If tariff has file key - load it
-                                        if "file" in tariff:
-                                            
-                                            tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, tariff["file"]), logger)
-                                            if tariff_dict is None:
-                                                
-                                                raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, tariff["file"]))
-
-                                            # Check if tariff has storage
-
-                                            if "storage" in tariff_dict:
+                                        # Check if tariff has storage
+                                        tariff_storage = tariff_catalog.rate(tariff, "storage")
+                                        if tariff_storage is not None:
 
-                                                # If storage tariff already found on prev step - error
-                                                if storage_tariff_found:
-                                                    raise Exception("Storage tariff found more than once for asset {asset}".format(asset=asset["fqdn"]))
+                                            # If storage tariff already found on prev step - error
+                                            if storage_tariff_found:
+                                                raise Exception("Storage tariff found more than once for asset {asset}".format(asset=asset["fqdn"]))
 
-                                                checked_tariff_rate = tariff_dict["storage"]["rate"]
-                                                checked_tariff_currency = tariff_dict["storage"]["currency"]
-                                                checked_tariff_plan = tariff_dict["service"] + " " + tariff_dict["plan"] + " rev. " + str(tariff_dict["revision"])
-                                                if "woocommerce_product_id" in tariff_dict["storage"]:
-                                                    checked_woocommerce_product_id = tariff_dict["storage"]["woocommerce_product_id"]
-                                                else:
-                                                    checked_woocommerce_product_id = None
-                                                storage_tariff_found = True
-
-                                        # Also take inline plan and service
-                                        else:
-                                            
-                                            # Check if tariff has storage
-                                            if "storage" in tariff:
-
-                                                # If storage tariff already found on prev step - error
-                                                if storage_tariff_found:
-                                                    raise Exception("Storage tariff found more than once for asset {asset}".format(asset=asset["fqdn"]))
-
-                                                checked_tariff_rate = tariff["storage"]["rate"]
-                                                checked_tariff_currency = tariff["storage"]["currency"]
-                                                checked_tariff_plan = tariff["service"] + " " + tariff["plan"] + " rev. " + str(tariff["revision"])
-                                                if "woocommerce_product_id" in tariff["storage"]:
-                                                    checked_woocommerce_product_id = tariff["storage"]["woocommerce_product_id"]
-                                                else:
-                                                    checked_woocommerce_product_id = None
-                                                storage_tariff_found = True
+                                            checked_tariff_rate = tariff_storage["rate"]
+                                            checked_tariff_currency = tariff_storage["currency"]
+                                            checked_tariff_plan = tariff_catalog.plan_revision(tariff)
+                                            if "woocommerce_product_id" in tariff_storage:
+                                                checked_woocommerce_product_id = tariff_storage["woocommerce_product_id"]
+                                            else:
+                                                checked_woocommerce_product_id = None
+                                            storage_tariff_found = True
                                     
                                     if not storage_tariff_found:
 
@@ -4868,7 +4762,7 @@ if __name__ == "__main__":
                 logger.info(json.dumps(invoice_details[client], indent=2))
                         
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, "{0}/{1}.{2}".format(CLIENTS_SUBDIR, client.lower(), YAML_EXT), CLIENTS_SUBDIR, YAML_GLOB, logger)
+                client_dict = client_registry.load("{0}/{1}.{2}".format(CLIENTS_SUBDIR, client.lower(), YAML_EXT))
                 if client_dict is None:
                     raise Exception("Config file error or missing: {0}/{1}/{2}.{3}".format(WORK_DIR, CLIENTS_SUBDIR, client, YAML_EXT))
 
@@ -5546,14 +5440,18 @@ if __name__ == "__main__":
                 cur.close()
 
         if args.list_assets_for_client is not None or args.list_assets_for_all_clients:
+
+            # Parse all client files concurrently
+            if args.list_assets_for_all_clients:
+                client_registry.preload()
             
             # For *.yaml in client dir
-            for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+            for client_file in client_registry.files(args.list_assets_for_client[0] if args.list_assets_for_client is not None else None):
                 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                client_dict = client_registry.load(client_file)
                 if client_dict is None:
                     raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
                 
@@ -5612,7 +5510,7 @@ if __name__ == "__main__":
                         ))
 
         # Skip connection close where not needed
-        if not (args.yaml_check or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
+        if not (args.yaml_check or args.build_config_snapshot or args.list_assets_for_client is not None or args.list_assets_for_all_clients):
             # Close connection
             conn.close()
 
@@ -124,3 +124,25 @@ CREATE INDEX IF NOT EXISTS jobs_log_asset_fqdn ON jobs_log (asset_fqdn);
 CREATE INDEX IF NOT EXISTS jobs_log_client ON jobs_log (client);
 CREATE INDEX IF NOT EXISTS jobs_log_job_id ON jobs_log (job_id);
 CREATE INDEX IF NOT EXISTS jobs_log_asset_fqdn_client_job_id_combo ON jobs_log (asset_fqdn, client, job_id);
+
+
+CREATE TABLE IF NOT EXISTS jobs_last_run (
+	client TEXT NOT NULL,
+	asset_fqdn TEXT NOT NULL,
+	job_id TEXT NOT NULL,
+	last_run_at TIMESTAMP WITH TIME ZONE NOT NULL,
+	PRIMARY KEY (client, asset_fqdn, job_id)
+);
+
+-- Backfill last runs from jobs_log history once, only while jobs_last_run is empty, i.e. right after it is created
+-- Later last runs are saved by jobs.py, so jobs_log is not read again on each structure update
+-- jobs_script_run_at is saved in job tz, so it is converted with job_tz
+INSERT INTO jobs_last_run (client, asset_fqdn, job_id, last_run_at)
+SELECT DISTINCT ON (client, asset_fqdn, job_id)
+	client,
+	asset_fqdn,
+	job_id,
+	jobs_script_run_at AT TIME ZONE job_tz
+FROM jobs_log
+WHERE NOT EXISTS (SELECT 1 FROM jobs_last_run)
+ORDER BY client, asset_fqdn, job_id, id DESC;
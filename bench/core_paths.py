@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Core paths benchmark on work dir made by bench/generate_config.py
+# Times client YAML loading, asset lists, tariff activation, jobs due decisions and monthly invoice details, results are saved as JSON to compare across commits
+
+import os
+import sys
+import argparse
+import subprocess
+import platform
+import statistics
+from time import perf_counter
+import json
+import logging
+import pytz
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+from sysadmws_common import *
+
+# Constants
+
+TARIFFS_SUBDIR = "tariffs"
+CLIENTS_SUBDIR = "clients"
+YAML_GLOB = "*.yaml"
+ACC_YAML = "accounting.yaml"
+MANIFEST_FILE = "bench.json"
+MINUTES_JITTER = 10 # The same as in jobs.py
+BENCH_NOW = datetime(2025, 3, 17, 9, 5, 0, tzinfo=pytz.utc) # Fixed now, so due decisions are the same on each run
+INVOICE_MONTH = datetime(2025, 3, 1)
+
+# Run func repeat times, return timing dict and the last result
+def measure(func, repeat):
+    timings = []
+    for run_index in range(repeat):
+        started = perf_counter()
+        result = func()
+        timings.append(perf_counter() - started)
+    return {"min_s": round(min(timings), 4), "median_s": round(statistics.median(timings), 4), "runs": repeat}, result
+
+# Load all client files with includes, without caches
+def bench_load_client_yaml(work_dir, client_files, logger):
+    return [load_client_yaml(work_dir, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger) for client_file in client_files]
+
+# Asset lists of all clients with activated tariffs at now
+def bench_get_asset_list(work_dir, client_dicts, logger):
+    return [get_asset_list(client_dict, work_dir, TARIFFS_SUBDIR, logger, BENCH_NOW.replace(tzinfo=None)) for client_dict in client_dicts]
+
+# Tariff activation lookups for all assets at each day of invoice month
+def bench_activated_tariff(asset_lists, logger):
+    found = 0
+    for asset_list in asset_lists:
+        for asset in asset_list:
+            for day in range(1, 29):
+                activated_tariff(asset["tariffs"], INVOICE_MONTH.replace(day=day), logger)
+                found += 1
+    return found
+
+# Jobs due decisions for all active server assets, the same effective jobs and checks as jobs.py before dispatch
+# Effective job tables are built without cache, last runs are taken as a fixed offset back from now instead of jobs_last_run
+def bench_jobs_due(work_dir, client_dicts, global_jobs, logger):
+    tariff_catalog = get_tariff_catalog(work_dir, TARIFFS_SUBDIR, logger)
+    job_last_run = BENCH_NOW.replace(hour=3)
+    due = 0
+    for client_dict in client_dicts:
+        job_table = get_effective_job_table(global_jobs, client_dict, MINUTES_JITTER, None, logger)
+        for asset in iter_asset_records(client_dict, tariff_catalog, BENCH_NOW.replace(tzinfo=None), kind="server", active=True):
+            for job in job_table.jobs(asset.fqdn):
+                if job.licenses is not None and not job.licenses <= asset.licenses:
+                    continue
+                now = BENCH_NOW.astimezone(job.schedule.tz)
+                if job_is_due(job, asset.fqdn, now, job_last_run, logger):
+                    due += 1
+    return due
+
+# Monthly invoice details of all clients, the same tariff selection and portions as accounting.py monthly invoice
+def bench_invoice_details(work_dir, client_dicts, logger):
+    tariff_catalog = get_tariff_catalog(work_dir, TARIFFS_SUBDIR, logger)
+    last_client_billing_date = datetime(2025, 2, 1)
+    monthly_period = INVOICE_MONTH.strftime("%Y-%m")
+    monthly_details = {}
+    for client_dict in client_dicts:
+        monthly_details[client_dict["name"]] = []
+        for asset in get_asset_list(client_dict, work_dir, TARIFFS_SUBDIR, logger, INVOICE_MONTH):
+            asset_activated_tariff = tariff_timeline(asset["tariffs"]).at(INVOICE_MONTH)
+            for asset_tariff in asset_activated_tariff["tariffs"]:
+                tariff_dict = dict(tariff_catalog.get(asset_tariff["file"])) if "file" in asset_tariff else dict(asset_tariff)
+                tariff_dict["activated_date"] = asset_activated_tariff["activated"].strftime("%Y-%m-%d")
+                tariff_dict["added_date"] = asset_activated_tariff["added"].strftime("%Y-%m-%d")
+                if "monthly_employee_share" in asset_tariff:
+                    tariff_dict["monthly_employee_share"] = dict(asset_tariff["monthly_employee_share"])
+                period_portion = monthly_period_portion(tariff_dict, INVOICE_MONTH, last_client_billing_date)
+                monthly_details[client_dict["name"]].append(monthly_details_item(asset["fqdn"], tariff_dict, monthly_period, period_portion))
+    return sum(len(details) for details in monthly_details.values())
+
+# Current git commit of repo, None outside of git
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Main
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Time core accounting paths on synthetic work dir.")
+    parser.add_argument("--work-dir", dest="work_dir", help="work dir made by bench/generate_config.py", required=True)
+    parser.add_argument("--output", dest="output", help="JSON results file, default bench_results.json", default="bench_results.json")
+    parser.add_argument("--repeat", dest="repeat", help="runs of each path, best and median are recorded, default 3", type=int, default=3)
+    parser.add_argument("--compare", dest="compare", help="previous JSON results file to print speedup against")
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(args.work_dir)
+    with open("{0}/{1}".format(work_dir, MANIFEST_FILE)) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    # Logs are not benchmarked, only warnings and errors are shown
+    logger = logging.getLogger("bench")
+    logger.setLevel(logging.WARNING)
+    logger.addHandler(logging.StreamHandler())
+
+    with open("{0}/{1}".format(work_dir, ACC_YAML)) as acc_yaml_file:
+        global_jobs = get_job_records(yaml.load(acc_yaml_file, Loader=YAML_SAFE_LOADER)["jobs"], "GLOBAL", MINUTES_JITTER)
+    client_files = sorted(os.path.relpath(client_file, work_dir) for client_file in glob.glob("{0}/{1}/{2}".format(work_dir, CLIENTS_SUBDIR, YAML_GLOB)))
+
+    results = {}
+    results["load_client_yaml"], client_dicts = measure(lambda: bench_load_client_yaml(work_dir, client_files, logger), args.repeat)
+    results["get_asset_list"], asset_lists = measure(lambda: bench_get_asset_list(work_dir, client_dicts, logger), args.repeat)
+    results["activated_tariff"], lookups = measure(lambda: bench_activated_tariff(asset_lists, logger), args.repeat)
+    results["jobs_due"], due = measure(lambda: bench_jobs_due(work_dir, client_dicts, global_jobs, logger), args.repeat)
+    results["invoice_details"], details = measure(lambda: bench_invoice_details(work_dir, client_dicts, logger), args.repeat)
+
+    output = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "scale": manifest,
+        "counts": {"assets": sum(len(asset_list) for asset_list in asset_lists), "activated_tariff_lookups": lookups, "jobs_due": due, "invoice_details": details},
+        "results": results
+    }
+    with open(args.output, "w") as output_file:
+        json.dump(output, output_file, indent=4)
+
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as compare_file:
+            previous = json.load(compare_file)
+        if previous["scale"] != manifest:
+            print("Scale of {0} differs from work dir, speedups are not comparable".format(args.compare), file=sys.stderr)
+
+    for name, result in results.items():
+        line = "{0:<20} min {1:>9.4f} s  median {2:>9.4f} s".format(name, result["min_s"], result["median_s"])
+        if previous is not None and name in previous["results"] and result["min_s"] > 0:
+            line += "  x{0:.2f} vs {1}".format(previous["results"][name]["min_s"] / result["min_s"], previous["commit"])
+        print(line)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Generate synthetic work dir for benchmarks: accounting.yaml with jobs, tariffs/*.yaml, clients/*.yaml with assets in include dirs
+# Output is deterministic for the same scale and seed, so results of bench/core_paths.py are comparable across commits
+
+import os
+import sys
+import argparse
+import random
+import json
+import yaml
+from datetime import date
+from datetime import timedelta
+
+# Constants
+
+OS_LIST = ["focal", "jammy", "bullseye", "bookworm", "2019Server", "unknown"]
+LICENSES = ["monitoring", "backup", "firewall"]
+WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+TIMEZONES = ["Etc/UTC", "Europe/Kiev", "Europe/Berlin", "America/New_York", "Asia/Tokyo"]
+MANIFEST_FILE = "bench.json"
+
+# Write YAML file, dirs are created as needed
+def write_yaml(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as yaml_file:
+        yaml.dump(data, yaml_file, default_flow_style=False, sort_keys=False)
+
+# Random job dict in accounting.yaml jobs format
+def make_job(rnd):
+    job = {
+        "type": "salt_cmd",
+        "cmd": "state.apply bench_{0} queue=True".format(rnd.randint(1, 1000)),
+        "timeout": rnd.choice([300, 900, 3600]),
+        "tz": rnd.choice(TIMEZONES)
+    }
+    schedule = rnd.choice(["each_hours", "daily", "weekly", "monthly"])
+    if schedule == "each_hours":
+        job["each"] = {"hours": rnd.choice([1, 2, 4, 6])}
+    elif schedule == "daily":
+        job["each"] = {"days": 1}
+        job["hours"] = [rnd.randint(0, 23)]
+        job["minutes"] = [rnd.choice([0, 10, 20, 30, 40, 50])]
+    elif schedule == "weekly":
+        job["each"] = {"days": 1}
+        job["weekdays"] = sorted(rnd.sample(WEEKDAYS, 2), key=WEEKDAYS.index)
+        job["hours"] = ["{0}-{1}".format(hour, hour + 2) for hour in [rnd.randint(0, 21)]]
+    else:
+        job["each"] = {"days": 20}
+        job["days"] = ["1-7"]
+        job["hours"] = [rnd.randint(0, 23)]
+        job["minutes"] = [0]
+    if rnd.random() < 0.7:
+        job["licenses"] = rnd.sample(LICENSES, rnd.randint(1, 2))
+    if rnd.random() < 0.3:
+        job["os"] = {"exclude": ["2019Server", "unknown"]}
+    return job
+
+# Random asset dict with tariff history of file and inline tariffs
+def make_asset(rnd, fqdn, tariff_files):
+    tariffs = []
+    activated = date(2024, 1, 1)
+    for history_index in range(rnd.randint(1, 4)):
+        if rnd.random() < 0.85:
+            asset_tariff = {"file": rnd.choice(tariff_files)}
+        else:
+            asset_tariff = {
+                "service": "Inline",
+                "plan": "Custom {0}".format(rnd.randint(1, 9)),
+                "revision": 1,
+                "monthly": {"rate": rnd.randint(1, 200), "currency": "USD"},
+                "licenses": rnd.sample(LICENSES, rnd.randint(0, 3))
+            }
+        if rnd.random() < 0.1:
+            asset_tariff["monthly_employee_share"] = {"employee@example.com": 10}
+        tariffs.insert(0, {"activated": activated, "added": activated, "tariffs": [asset_tariff]})
+        activated += timedelta(days=rnd.randint(30, 120))
+    asset = {
+        "fqdn": fqdn,
+        "active": rnd.random() < 0.9,
+        "kind": "server",
+        "os": rnd.choice(OS_LIST),
+        "location": "Bench DC",
+        "description": "Synthetic asset",
+        "tariffs": tariffs
+    }
+    if rnd.random() < 0.1:
+        asset["ssh"] = {"host": "10.0.{0}.{1}".format(rnd.randint(0, 255), rnd.randint(1, 254)), "port": 2222}
+    if rnd.random() < 0.05:
+        asset["jobs"] = {"asset_job_{0}".format(rnd.randint(1, 3)): make_job(rnd)}
+    return asset
+
+# Generate work dir, returns manifest dict
+def generate(work_dir, clients, assets, jobs, tariffs, include_files, seed):
+    rnd = random.Random(seed)
+
+    # Accounting YAML with global jobs
+    write_yaml("{0}/accounting.yaml".format(work_dir), {"jobs": {"job_{0:03d}".format(job_index): make_job(rnd) for job_index in range(jobs)}})
+
+    # Tariff files
+    tariff_files = []
+    for tariff_index in range(tariffs):
+        tariff_file = "bench-{0:03d}.yaml".format(tariff_index)
+        write_yaml("{0}/tariffs/{1}".format(work_dir, tariff_file), {
+            "service": "Bench {0}".format(tariff_index // 10),
+            "plan": "Plan {0}".format(tariff_index % 10),
+            "revision": 1,
+            "monthly": {"rate": rnd.randint(0, 500), "currency": "USD"},
+            "hourly": {"rate": rnd.randint(0, 50), "currency": "USD"},
+            "storage": {"rate": rnd.randint(0, 5), "currency": "USD"},
+            "licenses": rnd.sample(LICENSES, rnd.randint(0, 3))
+        })
+        tariff_files.append(tariff_file)
+
+    # Client files, assets are split between include files in client include dir
+    for client_index in range(clients):
+        client_name = "bench{0:04d}".format(client_index)
+        client_dict = {
+            "name": client_name,
+            "active": True,
+            "gitlab": {"salt_project": {"path": "bench/{0}-salt".format(client_name)}},
+            "billing": {"code": "B{0:04d}".format(client_index), "papers": {}},
+            "configuration_management": {"type": "salt-ssh"},
+            "include": {"dirs": [client_name]}
+        }
+        if rnd.random() < 0.2:
+            client_dict["jobs"] = {"job_{0:03d}".format(rnd.randrange(jobs)): make_job(rnd)} if jobs > 0 else {}
+        write_yaml("{0}/clients/{1}.yaml".format(work_dir, client_name), client_dict)
+        for include_index in range(include_files):
+            write_yaml("{0}/clients/{1}/assets_{2}.yaml".format(work_dir, client_name, include_index), {
+                "assets": [
+                    make_asset(rnd, "srv{0}.{1}.example.com".format(asset_index, client_name), tariff_files)
+                    for asset_index in range(include_index, assets, include_files)
+                ]
+            })
+
+    manifest = {"clients": clients, "assets": assets, "jobs": jobs, "tariffs": tariffs, "include_files": include_files, "seed": seed}
+    with open("{0}/{1}".format(work_dir, MANIFEST_FILE), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    return manifest
+
+# Main
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Generate synthetic accounting work dir for benchmarks.")
+    parser.add_argument("--work-dir", dest="work_dir", help="dir to write accounting.yaml, tariffs and clients to", required=True)
+    parser.add_argument("--clients", dest="clients", help="number of clients, default 500", type=int, default=500)
+    parser.add_argument("--assets", dest="assets", help="assets per client, default 200", type=int, default=200)
+    parser.add_argument("--jobs", dest="jobs", help="global jobs in accounting.yaml, default 20", type=int, default=20)
+    parser.add_argument("--tariffs", dest="tariffs", help="tariff files, default 50", type=int, default=50)
+    parser.add_argument("--include-files", dest="include_files", help="include files per client to split assets into, default 4", type=int, default=4)
+    parser.add_argument("--seed", dest="seed", help="random seed, default 1", type=int, default=1)
+    args = parser.parse_args()
+
+    if os.path.exists("{0}/clients".format(args.work_dir)):
+        print("Work dir {0} already has clients, use empty dir".format(args.work_dir), file=sys.stderr)
+        sys.exit(1)
+
+    manifest = generate(args.work_dir, args.clients, args.assets, args.jobs, args.tariffs, args.include_files, args.seed)
+    print("Generated {clients} clients x {assets} assets, {jobs} global jobs, {tariffs} tariffs".format(**manifest))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Startup benchmark: import time of each CLI subcommand recorded with python -X importtime
+# Subcommands are run with empty work dir and without credentials env vars, so they stop right after imports on config or env checks
+
+import os
+import sys
+import argparse
+import subprocess
+import tempfile
+import time
+import json
+
+# Constants
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SUBCOMMANDS = [
+    ["accounting.py", "--yaml-check"],
+    ["accounting.py", "--build-config-snapshot"],
+    ["accounting.py", "--list-assets-for-all-clients"],
+    ["accounting.py", "--db-structure"],
+    ["accounting.py", "--storage-usage"],
+    ["accounting.py", "--asset-labels"],
+    ["accounting.py", "--make-pdfs-for-all-clients"],
+    ["accounting.py", "--make-monthly-invoice-for-all-clients", "0"],
+    ["jobs.py", "--run-jobs", "ALL", "ALL"],
+    ["jobs.py", "--prune-run-tags", "ALL", "1"],
+    ["services.py", "--pipeline-salt-cmd-for-all-assets-for-all-clients", "test.ping"],
+    ["projects.py", "--setup-projects-for-all-clients"],
+    ["projects.py", "--template-salt-project-for-all-clients"]
+]
+
+# Parse python -X importtime stderr into list of (self us, cumulative us, module, nesting level)
+def parse_importtime(stderr):
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|", 2)
+        imports.append((int(self_us), int(cumulative_us), module.strip(), (len(module) - len(module.lstrip()) - 1) // 2))
+    return imports
+
+# Run subcommand under python -X importtime, return result dict
+def run_subcommand(python, subcommand, work_dir, log_dir):
+    env = {
+        "PATH": os.environ.get("PATH", ""),
+        "ACC_WORKDIR": work_dir,
+        "ACC_LOGDIR": log_dir,
+        "ACC_CACHEDIR": "{0}/.cache".format(work_dir),
+        "ACC_CONFIG_SNAPSHOT": "{0}/config.snapshot".format(work_dir)
+    }
+    started = time.monotonic()
+    run_result = subprocess.run([python, "-X", "importtime", "{0}/{1}".format(REPO_DIR, subcommand[0])] + subcommand[1:], cwd=work_dir, env=env, universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    wall_ms = (time.monotonic() - started) * 1000
+    imports = parse_importtime(run_result.stderr)
+    top_level = [imp for imp in imports if imp[3] == 0]
+    return {
+        "subcommand": " ".join(subcommand),
+        "wall_ms": round(wall_ms, 1),
+        "import_ms": round(sum(imp[1] for imp in top_level) / 1000, 1),
+        "modules": len(imports),
+        "top": [{"module": imp[2], "cumulative_ms": round(imp[1] / 1000, 1)} for imp in sorted(top_level, key=lambda imp: imp[1], reverse=True)]
+    }
+
+# Main
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Record python -X importtime startup cost of each subcommand.")
+    parser.add_argument("--python", dest="python", help="python interpreter to run subcommands with, default current", default=sys.executable)
+    parser.add_argument("--top", dest="top", help="show N heaviest top level imports per subcommand, default 5", type=int, default=5)
+    parser.add_argument("--json", dest="json", help="print results as JSON", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+
+        results = [run_subcommand(args.python, subcommand, work_dir, "{0}/log".format(work_dir)) for subcommand in SUBCOMMANDS]
+
+    if args.json:
+        for result in results:
+            result["top"] = result["top"][:args.top]
+        print(json.dumps(results, indent=4))
+    else:
+        for result in results:
+            print("{subcommand}: imports {import_ms} ms ({modules} modules), wall {wall_ms} ms".format(**result))
+            for top in result["top"][:args.top]:
+                print("    {cumulative_ms:>8} ms  {module}".format(**top))
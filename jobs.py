@@ -10,14 +10,24 @@ import subprocess
 import pytz
 from datetime import datetime
 from datetime import time
+from datetime import timedelta
 import psycopg2
-import base64
+import psycopg2.extras
+import concurrent.futures
+import threading
+import requests
+import heapq
+import signal
+from collections import Counter
+from time import perf_counter
 
 # Constants and envs
 
 LOGO="Jobs"
 WORK_DIR = os.environ.get("ACC_WORKDIR", "/opt/sysadmws/accounting")
 LOG_DIR = os.environ.get("ACC_LOGDIR", "/opt/sysadmws/accounting/log")
+CACHE_DIR = os.environ.get("ACC_CACHEDIR", "{0}/.cache".format(WORK_DIR))
+CONFIG_SNAPSHOT = os.environ.get("ACC_CONFIG_SNAPSHOT", "{0}/config.snapshot".format(WORK_DIR))
 LOG_FILE = "jobs.log"
 TARIFFS_SUBDIR = "tariffs"
 CLIENTS_SUBDIR = "clients"
@@ -26,6 +36,476 @@ YAML_EXT = "yaml"
 ACC_YAML = "accounting.yaml"
 LOCK_TIMEOUT = 600 # Supposed to be run each 10 minutes, so lock for 10 minutes
 MINUTES_JITTER = 10 # Jobs are run on some minute between 00 and 10 minutes each 10 minutes
+DISPATCH_WORKERS = int(os.environ.get("ACC_JOBS_DISPATCH_WORKERS", "8")) # Concurrent pipeline dispatches of run
+DISPATCH_CLIENT_LIMIT = int(os.environ.get("ACC_JOBS_DISPATCH_CLIENT_LIMIT", "4")) # Concurrent pipeline dispatches of one client
+DISPATCH_PROJECT_LIMIT = int(os.environ.get("ACC_JOBS_DISPATCH_PROJECT_LIMIT", "4")) # Concurrent pipeline dispatches to one salt project
+DISPATCH_BACKEND = os.environ.get("ACC_JOBS_DISPATCH_BACKEND", "script") # script - run .gitlab-server-job pipeline scripts, api - create pipelines via GitLab API in process for salt projects with api_dispatch set
+RUN_JOBS_INTERVAL = 10 # Minutes between run jobs runs, used to plan run jobs schedule
+DAEMON_MINUTES_JITTER = 1 # Daemon dispatches jobs on their due minute, so schedule minutes and each waits are exact
+DAEMON_RETRY_MINUTES = RUN_JOBS_INTERVAL # Daemon retries failed dispatches when run jobs would run next time
+DAEMON_CHECK_SECONDS = int(os.environ.get("ACC_JOBS_DAEMON_CHECK_SECONDS", "60")) # Daemon checks config files for changes this often
+JOB_NEVER_RUN = datetime.strptime("1970-01-01 00:00:00 +0000", "%Y-%m-%d %H:%M:%S %z") # Last run of jobs not found in jobs_last_run
+
+PIPELINE_HISTORY_COLUMNS = {
+    "pipeline_salt_cmd_history": ["target", "project", "timeout", "cmd", "pipeline_id", "pipeline_url", "pipeline_status"],
+    "pipeline_rsnapshot_backup_history": ["target", "project", "timeout", "rsnapshot_backup_type", "ssh_host", "ssh_port", "ssh_jump", "pipeline_id", "pipeline_url", "pipeline_status"]
+}
+
+# Functions
+
+# Connect to PG with PG_DB_* env vars
+def pg_connect():
+
+    # Check db vars
+    PG_DB_HOST = os.environ.get("PG_DB_HOST")
+    if PG_DB_HOST is None:
+        raise Exception("Env var PG_DB_HOST missing")
+
+    PG_DB_PORT = os.environ.get("PG_DB_PORT")
+    if PG_DB_PORT is None:
+        raise Exception("Env var PG_DB_PORT missing")
+
+    PG_DB_NAME = os.environ.get("PG_DB_NAME")
+    if PG_DB_NAME is None:
+        raise Exception("Env var PG_DB_NAME missing")
+
+    PG_DB_USER = os.environ.get("PG_DB_USER")
+    if PG_DB_USER is None:
+        raise Exception("Env var PG_DB_USER missing")
+
+    PG_DB_PASS = os.environ.get("PG_DB_PASS")
+    if PG_DB_PASS is None:
+        raise Exception("Env var PG_DB_PASS missing")
+
+    dsn = "host={host} port={port} dbname={dbname} user={user} password={password}".format(host=PG_DB_HOST, port=PG_DB_PORT, dbname=PG_DB_NAME, user=PG_DB_USER, password=PG_DB_PASS)
+    return psycopg2.connect(dsn)
+
+# PG connection with cursor kept by long running daemon, reconnected when it is closed or broken
+class PGConnection:
+
+    def __init__(self):
+        self.conn = pg_connect()
+        self.cur = self.conn.cursor()
+
+    # Close old connection if it is still open and connect again, returns new connection and cursor
+    def reconnect(self):
+        if not self.conn.closed:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+        self.conn = pg_connect()
+        self.cur = self.conn.cursor()
+        return self.conn, self.cur
+
+    def close(self):
+        self.cur.close()
+        self.conn.close()
+
+# Connect to GitLab, session connection pool is sized for dispatch workers as api dispatches share it
+def gitlab_connect(gitlab_url, private_token):
+    gl_session = requests.Session()
+    gl_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=DISPATCH_WORKERS))
+    gl_session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=DISPATCH_WORKERS))
+    gl = gitlab.Gitlab(gitlab_url, private_token=private_token, session=gl_session)
+    gl.auth()
+    return gl
+
+# Save buffered job logs of dispatched jobs, their last runs and pipeline history of api dispatches in one transaction
+# Rows are jobs_log column values followed by timezone aware last run, pipeline history rows are keyed by history table
+def save_jobs_log(conn, cur, jobs_log_rows, pipeline_history_rows, sql_logger):
+
+    if len(jobs_log_rows) == 0:
+        return
+
+    # One last run per key, the latest row wins
+    last_run_rows = list({(row[1], row[2], row[3]): row[1:4] + (row[9],) for row in jobs_log_rows}.values())
+
+    sql_jobs_log = """
+    INSERT INTO
+            jobs_log
+            (
+                    jobs_script_run_at
+            ,       client
+            ,       asset_fqdn
+            ,       job_id
+            ,       job_level
+            ,       job_type
+            ,       job_cmd
+            ,       job_timeout
+            ,       job_tz
+            )
+    VALUES
+            %s
+    ;
+    """
+    sql_jobs_last_run = """
+    INSERT INTO
+            jobs_last_run
+            (
+                    client
+            ,       asset_fqdn
+            ,       job_id
+            ,       last_run_at
+            )
+    VALUES
+            %s
+    ON CONFLICT (client, asset_fqdn, job_id) DO UPDATE
+    SET
+            last_run_at = EXCLUDED.last_run_at
+    ;
+    """
+    sql_logger.debug("Query:")
+    sql_logger.debug(sql_jobs_log)
+    sql_logger.debug("Rows: %s", len(jobs_log_rows))
+    sql_logger.debug("Query:")
+    sql_logger.debug(sql_jobs_last_run)
+    sql_logger.debug("Rows: %s", len(last_run_rows))
+    sql_pipeline_history = {}
+    for history_table, history_rows in pipeline_history_rows.items():
+        sql_pipeline_history[history_table] = """
+        INSERT INTO
+                {table}
+                (
+                        {columns}
+                )
+        VALUES
+                %s
+        ;
+        """.format(table=history_table, columns="\n                ,       ".join(PIPELINE_HISTORY_COLUMNS[history_table]))
+        sql_logger.debug("Query:")
+        sql_logger.debug(sql_pipeline_history[history_table])
+        sql_logger.debug("Rows: %s", len(history_rows))
+    try:
+        psycopg2.extras.execute_values(cur, sql_jobs_log, [row[:9] for row in jobs_log_rows])
+        psycopg2.extras.execute_values(cur, sql_jobs_last_run, last_run_rows)
+        for history_table, history_rows in pipeline_history_rows.items():
+            psycopg2.extras.execute_values(cur, sql_pipeline_history[history_table], history_rows)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise Exception("Caught exception on query execution")
+    sql_logger.debug("Query execution status:")
+    sql_logger.debug(cur.statusmessage)
+
+# Bounded pool of job pipeline dispatches
+# Dispatch slots are taken in the main thread before submit, so global, per client and per salt project limits hold and the queue does not grow
+class JobDispatcher:
+
+    def __init__(self, workers, client_limit, project_limit):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dispatch")
+        self.slots = threading.BoundedSemaphore(workers)
+        self.client_limit = client_limit
+        self.project_limit = project_limit
+        self.client_slots = {}
+        self.project_slots = {}
+        # client -> list of (future, job details, job log row)
+        self.pending = {}
+
+    # Run func(*func_args) in worker thread, blocks while any limit is reached
+    def submit(self, client, project, job_details, job_log_row, func, *func_args):
+        if client not in self.client_slots:
+            self.client_slots[client] = threading.BoundedSemaphore(self.client_limit)
+        if project not in self.project_slots:
+            self.project_slots[project] = threading.BoundedSemaphore(self.project_limit)
+        semaphores = [self.slots, self.client_slots[client], self.project_slots[project]]
+        for semaphore in semaphores:
+            semaphore.acquire()
+        try:
+            future = self.executor.submit(func, *func_args)
+        except Exception:
+            for semaphore in semaphores:
+                semaphore.release()
+            raise
+        future.add_done_callback(lambda done_future: [semaphore.release() for semaphore in semaphores])
+        self.pending.setdefault(client, []).append((future, job_details, job_log_row))
+
+    # Clients with all submitted dispatches finished
+    def done_clients(self):
+        return [client for client, client_pending in self.pending.items() if all(future.done() for future, job_details, job_log_row in client_pending)]
+
+    # Wait for dispatches of client, return list of (job details, job log row, func result, exception or None)
+    def results(self, client):
+        client_results = []
+        for future, job_details, job_log_row in self.pending.pop(client, []):
+            try:
+                client_results.append((job_details, job_log_row, future.result(), None))
+            except Exception as e:
+                client_results.append((job_details, job_log_row, None, e))
+        return client_results
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+# Heap of next due times of scheduled jobs, keyed by (client, asset fqdn, job id)
+# Last runs are kept in memory as jobs are popped, so the next due time is known without querying jobs_last_run
+# Jobs without minutes and each are due on minute 0 of their hours, not on each minute of them
+class JobSchedule:
+
+    def __init__(self):
+        # key -> (client dict, asset, job)
+        self.entries = {}
+        # key -> job schedule with default minutes
+        self.schedules = {}
+        # key -> last run at
+        self.last_runs = {}
+        # key -> last run before the job was popped last time, restored if its dispatch failed
+        self.previous_runs = {}
+        # key -> generation of its latest heap item, older items of the key are skipped
+        self.generations = {}
+        # (next due at in UTC, key, generation)
+        self.heap = []
+
+    # Replace scheduled jobs, loaded last runs are taken if newer than the ones in memory
+    def load(self, entries, last_runs, now):
+        self.entries = dict(entries)
+        self.schedules = {key: job.schedule.with_default_minutes() for key, (client_dict, asset, job) in self.entries.items()}
+        for key, last_run in last_runs.items():
+            if key not in self.last_runs or last_run > self.last_runs[key]:
+                self.last_runs[key] = last_run
+        self.heap = []
+        for key in self.entries:
+            self.push(key, now)
+
+    # Push next due time of job at or after after, replacing the one pushed before
+    def push(self, key, after):
+        self.generations[key] = self.generations.get(key, 0) + 1
+        due_at = self.schedules[key].next_due(after, self.last_runs.get(key, JOB_NEVER_RUN))
+        if due_at is not None:
+            heapq.heappush(self.heap, (due_at.astimezone(pytz.utc), key, self.generations[key]))
+
+    # Next due time in UTC, None if nothing is scheduled, replaced heap items on top are dropped
+    def next_due_at(self):
+        while len(self.heap) > 0 and self.heap[0][2] != self.generations[self.heap[0][1]]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if len(self.heap) > 0 else None
+
+    # Pop jobs due at or before now as list of (due at, key, (client dict, asset, job))
+    # Due time becomes the last run of the job and its next due time is pushed, use retry if the job is not dispatched
+    def pop_due(self, now):
+        due = []
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            due_at, key, generation = heapq.heappop(self.heap)
+            if generation != self.generations[key]:
+                continue
+            self.previous_runs[key] = self.last_runs.get(key, JOB_NEVER_RUN)
+            self.last_runs[key] = due_at
+            due.append((due_at, key, self.entries[key]))
+            self.push(key, max(due_at + timedelta(minutes=1), now))
+        return due
+
+    # Dispatch of popped job failed: its previous last run is restored and it is due again at or after after, as if it was not run
+    def retry(self, key, after):
+        if key in self.previous_runs:
+            self.last_runs[key] = self.previous_runs.pop(key)
+        if key in self.entries:
+            self.push(key, after)
+
+# Load last runs of all jobs from jobs_last_run table, keyed by (client, asset fqdn, job id)
+def load_jobs_last_run(cur, sql_logger):
+    sql = """
+    SELECT
+            client
+    ,       asset_fqdn
+    ,       job_id
+    ,       last_run_at
+    FROM
+            jobs_last_run
+    ;
+    """
+    sql_logger.debug("Query:")
+    sql_logger.debug(sql)
+    cur.execute(sql)
+    return {(row_client, row_asset_fqdn, row_job_id): row_last_run_at for row_client, row_asset_fqdn, row_job_id, row_last_run_at in cur}
+
+# Scheduled jobs of all clients, keyed by (client, asset fqdn, job id): (client dict, asset, job)
+# The same client, asset and license checks as run jobs, time conditions are left to the schedule
+# Returns entries and True if there were client errors, failed clients are logged and left out
+def schedule_entries(client_registry, tariff_catalog, global_jobs, tariff_datetime, minutes_jitter, cache_dir, ignore_jobs_disabled, logger, jobs_logger):
+    entries = {}
+    errors = False
+    client_registry.preload()
+    for client_file in client_registry.files():
+        try:
+            client_dict = client_registry.load(client_file)
+            if not client_dict["active"] or "salt_project" not in client_dict["gitlab"]:
+                continue
+            if "jobs_disabled" in client_dict and client_dict["jobs_disabled"] and not ignore_jobs_disabled:
+                continue
+            job_table = get_effective_job_table(global_jobs, client_dict, minutes_jitter, cache_dir, jobs_logger)
+            for asset in client_registry.assets(client_file, tariff_catalog, tariff_datetime):
+                if asset.kind != "server" or not asset.active or (asset.jobs_disabled and not ignore_jobs_disabled):
+                    continue
+                for job in job_table.jobs(asset.fqdn):
+                    if job.licenses is not None and not job.licenses <= asset.licenses:
+                        jobs_logger.info("Job %s/%s skipped because required licenses %s are not found in joined licenses %s of all of asset tariffs", asset.fqdn, job.id, job.licenses, asset.licenses)
+                        continue
+                    entries[(client_dict["name"], asset.fqdn, job.id)] = (client_dict, asset, job)
+        except Exception as e:
+            logger.error("Caught exception, but not interrupting")
+            logger.exception(e)
+            errors = True
+    return entries, errors
+
+# Plan dispatches of scheduled jobs from window_from to window_to (UTC) after last runs, nothing is dispatched
+# Without interval jobs are taken from schedule heap on their due minute as daemon does, with interval in minutes all jobs are checked each interval as run jobs does
+# Returns list of (due at in UTC, key) in time order
+def plan_dispatches(entries, last_runs, window_from, window_to, interval=None):
+    dispatches = []
+    if interval is None:
+        schedule = JobSchedule()
+        schedule.load(entries, last_runs, window_from)
+        while schedule.next_due_at() is not None and schedule.next_due_at() < window_to:
+            for due_at, key, entry in schedule.pop_due(schedule.next_due_at()):
+                dispatches.append((due_at, key))
+    else:
+        last_runs = dict(last_runs)
+        run_at = window_from.replace(second=0, microsecond=0)
+        if run_at < window_from:
+            run_at += timedelta(minutes=1)
+        run_at += timedelta(minutes=-(run_at.hour*60 + run_at.minute) % interval)
+        while run_at < window_to:
+            for key, (client_dict, asset, job) in entries.items():
+                if job.schedule.is_due(run_at.astimezone(job.schedule.tz), last_runs.get(key, JOB_NEVER_RUN)):
+                    last_runs[key] = run_at
+                    dispatches.append((run_at, key))
+            run_at += timedelta(minutes=interval)
+    return dispatches
+
+# Run job pipeline script, called in dispatcher worker thread
+# Pipeline scripts save pipeline history themselves, so nothing is returned
+def dispatch_script(script, dry_run):
+    if not dry_run:
+        subprocess.run(script, shell=True, universal_newlines=True, check=True, executable="/bin/bash")
+    return None
+
+# Create pipeline with job variables on default branch of salt project via GitLab API, called in dispatcher worker thread
+# No run tag is created, so exactly one pipeline is started per dispatch
+# Project object shares authenticated session of gl, so connections are reused between dispatches
+# Returns (pipeline history table, pipeline history row) or None on dry run
+def dispatch_pipeline(project, variables, history_table, history_row, dry_run):
+    if dry_run:
+        return None
+    pipeline = project.pipelines.create({"ref": project.default_branch, "variables": [{"key": key, "value": str(value)} for key, value in variables.items()]})
+    return history_table, history_row + (str(pipeline.id), pipeline.web_url, pipeline.status)
+
+# Api backend is used for clients which opted in with gitlab:salt_project:api_dispatch, the rest is dispatched by script
+def api_dispatch(client_dict, dispatch_backend):
+    return dispatch_backend == "api" and client_dict["gitlab"]["salt_project"].get("api_dispatch", False)
+
+# Build dispatch of job for asset at now (in job TZ) with selected backend
+# Script backend runs .gitlab-server-job pipeline scripts with job parameters as arguments
+# Api backend passes the same parameters as pipeline variables of default branch pipeline, it is opt-in per client with gitlab:salt_project:api_dispatch
+# as salt project CI has to run jobs by these variables, which pipeline scripts do not use, clients without it are dispatched by script:
+# - salt_cmd: JOB_TYPE=salt_cmd, SALT_TARGET, SALT_TIMEOUT, SALT_CMD
+# - rsnapshot_backup_ssh and rsnapshot_backup_salt: JOB_TYPE=rsnapshot_backup, RSNAPSHOT_BACKUP_TARGET, RSNAPSHOT_BACKUP_TIMEOUT, RSNAPSHOT_BACKUP_TYPE (SSH or SALT), SSH_HOST, SSH_PORT, SSH_JUMP (SSH only)
+# Returns (job details line, job log row, dispatch func, dispatch func args)
+def job_dispatch(client_dict, project, asset, job, now, dispatch_backend, dry_run, logger):
+
+    salt_project = client_dict["gitlab"]["salt_project"]["path"]
+    if job.type == "salt_cmd":
+        script = textwrap.dedent(
+            """
+            .gitlab-server-job/pipeline_salt_cmd.sh nowait {salt_project} {timeout} {asset} "{job_cmd}"
+            """
+        ).format(salt_project=salt_project, timeout=job.timeout, asset=asset.fqdn, job_cmd=job.cmd)
+        pipeline_variables = {"JOB_TYPE": "salt_cmd", "SALT_TARGET": asset.fqdn, "SALT_TIMEOUT": job.timeout if job.timeout is not None else "", "SALT_CMD": job.cmd}
+        history_table = "pipeline_salt_cmd_history"
+        history_row = (asset.fqdn, salt_project, str(job.timeout) if job.timeout is not None else "", job.cmd)
+    elif job.type == "rsnapshot_backup_ssh":
+        script = textwrap.dedent(
+            """
+            .gitlab-server-job/pipeline_rsnapshot_backup.sh nowait {salt_project} 0 {asset} SSH {ssh_host} {ssh_port} {ssh_jump}
+            """
+        ).format(salt_project=salt_project, asset=asset.fqdn, ssh_host=asset.ssh_host, ssh_port=asset.ssh_port, ssh_jump=asset.ssh_jump)
+        pipeline_variables = {"JOB_TYPE": "rsnapshot_backup", "RSNAPSHOT_BACKUP_TARGET": asset.fqdn, "RSNAPSHOT_BACKUP_TIMEOUT": 0, "RSNAPSHOT_BACKUP_TYPE": "SSH", "SSH_HOST": asset.ssh_host, "SSH_PORT": asset.ssh_port, "SSH_JUMP": asset.ssh_jump}
+        history_table = "pipeline_rsnapshot_backup_history"
+        history_row = (asset.fqdn, salt_project, "0", "SSH", str(asset.ssh_host), str(asset.ssh_port), str(asset.ssh_jump))
+    elif job.type == "rsnapshot_backup_salt":
+        script = textwrap.dedent(
+            """
+            .gitlab-server-job/pipeline_rsnapshot_backup.sh nowait {salt_project} {timeout} {asset} SALT
+            """
+        ).format(salt_project=salt_project, timeout=job.timeout, asset=asset.fqdn)
+        pipeline_variables = {"JOB_TYPE": "rsnapshot_backup", "RSNAPSHOT_BACKUP_TARGET": asset.fqdn, "RSNAPSHOT_BACKUP_TIMEOUT": job.timeout if job.timeout is not None else "", "RSNAPSHOT_BACKUP_TYPE": "SALT"}
+        history_table = "pipeline_rsnapshot_backup_history"
+        history_row = (asset.fqdn, salt_project, str(job.timeout) if job.timeout is not None else "", "SALT", None, None, None)
+    else:
+        raise Exception("Unknown job type: {jtype}".format(jtype=job.type))
+
+    if api_dispatch(client_dict, dispatch_backend):
+        logger.info("Creating pipeline in project {project} with variables:".format(project=salt_project))
+        logger.info(pipeline_variables)
+        dispatch_func, dispatch_args = dispatch_pipeline, (project, pipeline_variables, history_table, history_row, dry_run)
+    else:
+        logger.info("Running bash script:")
+        logger.info(script)
+        dispatch_func, dispatch_args = dispatch_script, (script, dry_run)
+
+    job_details = "Job: {client} {asset_fqdn} {job_id} {job_level} {job_type} {job_cmd} {job_timeout}".format(
+        client=client_dict["name"],
+        asset_fqdn=asset.fqdn,
+        job_id=job.id,
+        job_level=job.level,
+        job_type=job.type,
+        job_cmd=job.cmd if job.cmd is not None else "",
+        job_timeout=job.timeout if job.timeout is not None else ""
+    )
+    # jobs_script_run_at and last run are saved with seconds precision, the same as in jobs_log rows of previous runs
+    job_log_row = (
+        now.replace(microsecond=0, tzinfo=None),
+        client_dict["name"],
+        asset.fqdn,
+        job.id,
+        job.level,
+        job.type,
+        job.cmd.strip(" \t\n\r") if job.cmd is not None else "",
+        str(job.timeout) if job.timeout is not None else "",
+        job.tz,
+        now.replace(microsecond=0)
+    )
+    return job_details, job_log_row, dispatch_func, dispatch_args
+
+# Collect dispatch results of client: print dispatched jobs, log failed ones and save job logs of dispatched jobs in one transaction
+# Keys (client, asset fqdn, job id) of failed dispatches are appended to failed list if given
+# If reconnect func is given, failed save is retried once with connection and cursor it returns
+# Returns True if there were errors
+def save_dispatch_results(dispatcher, client, conn, cur, logger, sql_logger, failed=None, reconnect=None):
+    errors = False
+    jobs_log_rows = []
+    pipeline_history_rows = {}
+    for job_details, job_log_row, result, error in dispatcher.results(client):
+        if error is None:
+            if result is not None:
+                history_table, history_row = result
+                pipeline_history_rows.setdefault(history_table, []).append(history_row)
+                print("{0} {1}".format(job_details, history_row[-2]))
+            else:
+                print(job_details)
+            jobs_log_rows.append(job_log_row)
+        else:
+            logger.error("Caught exception, but not interrupting")
+            logger.error(error, exc_info=error)
+            errors = True
+            if failed is not None:
+                failed.append(tuple(job_log_row[1:4]))
+    try:
+        save_jobs_log(conn, cur, jobs_log_rows, pipeline_history_rows, sql_logger)
+    except Exception as e:
+        logger.error("Caught exception, but not interrupting")
+        logger.exception(e)
+        if reconnect is None:
+            return True
+        # Connection could be broken while daemon waited for jobs, reconnect and save again
+        try:
+            logger.info("Reconnecting to PG to save job logs again")
+            conn, cur = reconnect()
+            save_jobs_log(conn, cur, jobs_log_rows, pipeline_history_rows, sql_logger)
+        except Exception as e:
+            logger.error("Caught exception, but not interrupting")
+            logger.exception(e)
+            errors = True
+    return errors
 
 # Main
 
@@ -41,11 +521,17 @@ if __name__ == "__main__":
                           action="store_true")
     parser.add_argument("--dry-run-pipeline", dest="dry_run_pipeline", help="do not execute pipeline script", action="store_true")
     parser.add_argument("--at-date", dest="at_date", help="use DATETIME instead of now for tariff", nargs=1, metavar=("DATETIME"))
+    parser.add_argument("--plan-mode", dest="plan_mode", help="plan jobs as run by run jobs each {0} minutes (run-jobs) or by daemon (daemon), default run-jobs".format(RUN_JOBS_INTERVAL), choices=["run-jobs", "daemon"], default="run-jobs")
+    parser.add_argument("--plan-seed-db", dest="plan_seed_db", help="plan with job last runs from jobs_last_run table (latest jobs_log runs), otherwise as jobs never run", action="store_true")
+    parser.add_argument("--plan-counts-only", dest="plan_counts_only", help="print only dispatch counts per minute and totals, not each planned dispatch", action="store_true")
+    parser.add_argument("--dispatch-backend", dest="dispatch_backend", help="dispatch jobs with pipeline scripts (script) or in process via GitLab API (api) for clients with gitlab:salt_project:api_dispatch set, default from ACC_JOBS_DISPATCH_BACKEND or script", choices=["script", "api"], default=DISPATCH_BACKEND)
 
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--run-job", dest="run_job", help="run specific job id JOB for asset ASSET (use ALL for all assets) via GitLab pipelines for CLIENT (use ALL for all clients)", nargs=3, metavar=("CLIENT", "ASSET", "JOB"))
     group.add_argument("--run-jobs", dest="run_jobs", help="run jobs for asset ASSET (use ALL for all assets) via GitLab pipelines for CLIENT (use ALL for all clients)", nargs=2, metavar=("CLIENT", "ASSET"))
     group.add_argument("--force-run-job", dest="force_run_job", help="force run (omit time conditions) specific job id JOB for asset ASSET (use ALL for all assets) via GitLab pipelines for CLIENT (use ALL for all clients)", nargs=3, metavar=("CLIENT", "ASSET", "JOB"))
+    group.add_argument("--daemon", dest="daemon", help="run jobs for all assets of all clients as long running scheduler: each job is dispatched on its due minute, config is reloaded when its files change", action="store_true")
+    group.add_argument("--plan", dest="plan", help="print dispatches of all jobs of all clients from FROM to TO (UTC, YYYY-MM-DD or \"YYYY-MM-DD HH:MM\") and dispatch counts per minute without running anything", nargs=2, metavar=("FROM", "TO"))
     # This is deprecated but kept for history
     group.add_argument("--prune-run-tags", dest="prune_run_tags", help="prune all run_* tags older than AGE via GitLab API for CLIENT (use ALL for all clients)", nargs=2, metavar=("CLIENT", "AGE"))
 
@@ -61,8 +547,13 @@ if __name__ == "__main__":
     else:
         logger = set_logger(logging.ERROR, LOG_DIR, LOG_FILE)
 
+    # Subsystem loggers, levels can be set separately with ACC_LOG_LEVELS
+    sql_logger = logger.getChild("sql")
+    jobs_logger = logger.getChild("jobs")
+
+    # Plan does not touch GitLab
     GL_ADMIN_PRIVATE_TOKEN = os.environ.get("GL_ADMIN_PRIVATE_TOKEN")
-    if GL_ADMIN_PRIVATE_TOKEN is None:
+    if GL_ADMIN_PRIVATE_TOKEN is None and not args.plan:
         raise Exception("Env var GL_ADMIN_PRIVATE_TOKEN missing")
     
     errors = False
@@ -76,39 +567,26 @@ if __name__ == "__main__":
         # Chdir to work dir
         os.chdir(WORK_DIR)
 
+        # Prebuilt config snapshot, used for files unchanged since it was built
+        config_snapshot = ConfigSnapshot(CONFIG_SNAPSHOT, WORK_DIR, logger)
+
         # Read ACC_YAML
-        acc_yaml_dict = load_yaml("{0}/{1}".format(WORK_DIR, ACC_YAML), logger)
+        acc_yaml_dict = load_yaml_cached("{0}/{1}".format(WORK_DIR, ACC_YAML), CACHE_DIR, logger, config_snapshot)
         if acc_yaml_dict is None:
             raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, ACC_YAML))
+
+        # Client registry, each client YAML is loaded once per run, without key material as it is not needed here
+        client_registry = ClientRegistry(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, logger, CACHE_DIR, config_snapshot, secrets=False)
+
+        # Tariff catalog, each tariff file is loaded once per run
+        tariff_catalog = get_tariff_catalog(WORK_DIR, TARIFFS_SUBDIR, logger, CACHE_DIR, config_snapshot)
         
         # Do tasks
 
         if args.run_jobs or args.run_job or args.force_run_job:
 
-            # Check db vars
-            PG_DB_HOST = os.environ.get("PG_DB_HOST")
-            if PG_DB_HOST is None:
-                raise Exception("Env var PG_DB_HOST missing")
-
-            PG_DB_PORT = os.environ.get("PG_DB_PORT")
-            if PG_DB_PORT is None:
-                raise Exception("Env var PG_DB_PORT missing")
-
-            PG_DB_NAME = os.environ.get("PG_DB_NAME")
-            if PG_DB_NAME is None:
-                raise Exception("Env var PG_DB_NAME missing")
-
-            PG_DB_USER = os.environ.get("PG_DB_USER")
-            if PG_DB_USER is None:
-                raise Exception("Env var PG_DB_USER missing")
-
-            PG_DB_PASS = os.environ.get("PG_DB_PASS")
-            if PG_DB_PASS is None:
-                raise Exception("Env var PG_DB_PASS missing")
-
             # Connect to PG
-            dsn = "host={host} port={port} dbname={dbname} user={user} password={password}".format(host=PG_DB_HOST, port=PG_DB_PORT, dbname=PG_DB_NAME, user=PG_DB_USER, password=PG_DB_PASS)
-            conn = psycopg2.connect(dsn)
+            conn = pg_connect()
             cur = conn.cursor()
 
             # Save now once in UTC
@@ -116,11 +594,26 @@ if __name__ == "__main__":
             saved_now = datetime.now(pytz.timezone("UTC"))
             
             # Connect to GitLab
-            gl = gitlab.Gitlab(acc_yaml_dict["gitlab"]["url"], private_token=GL_ADMIN_PRIVATE_TOKEN)
-            gl.auth()
+            gl = gitlab_connect(acc_yaml_dict["gitlab"]["url"], GL_ADMIN_PRIVATE_TOKEN)
+
+            # Tariff date for asset tariffs and licenses
+            tariff_datetime = datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now()
+
+            # Global job records from accounting yaml, built once per run
+            global_jobs = get_job_records(acc_yaml_dict["jobs"], "GLOBAL", MINUTES_JITTER) if "jobs" in acc_yaml_dict else {}
+
+            # Client to run jobs for
+            run_client = (args.run_jobs or args.run_job or args.force_run_job)[0]
+
+            # Pipeline dispatch worker pool
+            dispatcher = JobDispatcher(DISPATCH_WORKERS, DISPATCH_CLIENT_LIMIT, DISPATCH_PROJECT_LIMIT)
+
+            # Parse all client files concurrently if all clients are needed, errors are reported per client below
+            if run_client == "ALL":
+                client_registry.preload()
 
             # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
+            for client_file in client_registry.files(None if run_client == "ALL" else run_client):
 
                 # Client file errors should not stop other clients
                 try:
@@ -128,7 +621,7 @@ if __name__ == "__main__":
                     logger.info("Found client file: {0}".format(client_file))
 
                     # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                    client_dict = client_registry.load(client_file)
                     if client_dict is None:
                         raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
                     
@@ -161,415 +654,114 @@ if __name__ == "__main__":
                     project = gl.projects.get(client_dict["gitlab"]["salt_project"]["path"])
                     logger.info("Salt project {project} for client {client} ssh_url_to_repo: {ssh_url_to_repo}, path_with_namespace: {path_with_namespace}".format(project=client_dict["gitlab"]["salt_project"]["path"], client=client_dict["name"], path_with_namespace=project.path_with_namespace, ssh_url_to_repo=project.ssh_url_to_repo))
 
-                    asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now())
+                    # Effective jobs of client assets, taken from cache while accounting and client jobs, asset os and jobs are unchanged
+                    job_table = get_effective_job_table(global_jobs, client_dict, MINUTES_JITTER, CACHE_DIR, jobs_logger)
+
+                    # Load last runs of all client jobs from jobs_last_run table with one query, keyed by asset and job id
+                    sql = """
+                    SELECT
+                            asset_fqdn
+                    ,       job_id
+                    ,       last_run_at
+                    FROM
+                            jobs_last_run
+                    WHERE
+                            client = '{client}'
+                    ;
+                    """.format(client=client_dict["name"])
+                    sql_logger.debug("Query:")
+                    sql_logger.debug(sql)
+                    cur.execute(sql)
+                    client_jobs_last_run = {(row_asset_fqdn, row_job_id): row_last_run_at for row_asset_fqdn, row_job_id, row_last_run_at in cur}
+
+                    # Single asset runs build the record of the needed asset only
+                    if run_asset != "ALL":
+                        asset_records = iter_asset_records(client_dict, tariff_catalog, tariff_datetime, fqdn=run_asset, kind="server", active=True)
+                    else:
+                        asset_records = client_registry.assets(client_file, tariff_catalog, tariff_datetime)
 
                     # For each asset
-                    for asset in asset_list:
+                    for asset in asset_records:
 
                         # Asset errors should not stop other assets
                         try:
 
                             # Skip assets if needed
-                            if run_asset != "ALL" and asset["fqdn"] != run_asset:
+                            if run_asset != "ALL" and asset.fqdn != run_asset:
                                 continue
 
                             # Skip non-server assets
-                            if asset["kind"] != "server":
+                            if asset.kind != "server":
                                 continue
                             
                             # Skip assets with jobs disabled
-                            if "jobs_disabled" in asset and asset["jobs_disabled"] and not args.ignore_jobs_disabled:
-                                logger.info("Jos disabled for asset {asset}, skipping".format(asset=asset["fqdn"]))
+                            if asset.jobs_disabled and not args.ignore_jobs_disabled:
+                                logger.info("Jos disabled for asset {asset}, skipping".format(asset=asset.fqdn))
                                 continue
                             
                             # Skip not active assets
-                            if "active" in asset and not asset["active"]:
-                                logger.info("Asset {asset} is not active, skipping".format(asset=asset["fqdn"]))
+                            if not asset.active:
+                                logger.info("Asset {asset} is not active, skipping".format(asset=asset.fqdn))
                                 continue
                             
-                            # Build job list
-                            job_list = []
-
-                            # Add global jobs from accounting yaml
-                            if "jobs" in acc_yaml_dict:
-                                
-                                for job_id, job_params in acc_yaml_dict["jobs"].items():
-                                    
-                                    # Do not add if the same job exists in client jobs or asset jobs
-                                    if not (("jobs" in client_dict and job_id in client_dict["jobs"]) or ("jobs" in asset and job_id in asset["jobs"])):
-                                        job_params["id"] = job_id
-                                        job_params["level"] = "GLOBAL"
-                                        job_list.append(job_params)
-
-                            # Add client jobs from client yaml
-                            if "jobs" in client_dict:
-                                
-                                for job_id, job_params in client_dict["jobs"].items():
-                                    
-                                    # Do not add if the same job exists in asset jobs
-                                    if not ("jobs" in asset and job_id in asset["jobs"]):
-                                        job_params["id"] = job_id
-                                        job_params["level"] = "CLIENT"
-                                        job_list.append(job_params)
-
-                            # Add asset jobs from asset def in client yaml
-                            if "jobs" in asset:
-                                
-                                for job_id, job_params in asset["jobs"].items():
-                                    job_params["id"] = job_id
-                                    job_params["level"] = "ASSET"
-                                    job_list.append(job_params)
+                            # Job list with global, client and asset jobs merged and os and disabled checks applied
+                            job_list = job_table.jobs(asset.fqdn)
 
                             # Run jobs from job list
 
-                            logger.info("Job list for asset {asset}:".format(asset=asset["fqdn"]))
-                            logger.info(json.dumps(job_list, indent=4, sort_keys=True))
+                            # Dump job list only if it goes to some log, it is expensive to format for each asset
+                            if jobs_logger.isEnabledFor(logging.DEBUG):
+                                jobs_logger.debug("Job list for asset %s:", asset.fqdn)
+                                jobs_logger.debug(json.dumps([job.as_dict() for job in job_list], indent=4, sort_keys=True))
 
                             for job in job_list:
 
-                                # Check os include
-                                if "os" in job and "include" in job["os"]:
-                                    if asset["os"] not in job["os"]["include"]:
-                                        logger.info("Job {asset}/{job} skipped because os {os} is not in job os include list".format(asset=asset["fqdn"], job=job["id"], os=asset["os"]))
-                                        continue
-
-                                # Check os exclude
-                                if "os" in job and "exclude" in job["os"]:
-                                    if asset["os"] in job["os"]["exclude"]:
-                                        logger.info("Job {asset}/{job} skipped because os {os} is in job os exclude list".format(asset=asset["fqdn"], job=job["id"], os=asset["os"]))
-                                        continue
-
-                                # Check job is disabled
-                                if "disabled" in job and job["disabled"]:
-                                    logger.info("Job {asset}/{job} skipped because it is disabled".format(asset=asset["fqdn"], job=job["id"]))
-                                    continue
-
-                                # Check licenses
-                                if "licenses" in job:
-                                    
-                                    logger.info("Job {asset}/{job} requires license list {lic_list_job}, loading licenses in tariffs".format(asset=asset["fqdn"], job=job["id"], lic_list_job=job["licenses"]))
-
-                                    # Load tariffs
-
-                                    # Take the first (upper and current) tariff
-                                    all_tar_lic_list = []
-                                    for asset_tariff in activated_tariff(asset["tariffs"], datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now(), logger)["tariffs"]:
-
-                                        # If tariff has file key - load it
-                                        if "file" in asset_tariff:
-                                            
-                                            tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]), logger)
-                                            if tariff_dict is None:
-                                                
-                                                raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
-
-                                            # Add tariff plan licenses to all tariffs lic list if exist
-                                            if "licenses" in tariff_dict:
-                                                all_tar_lic_list.extend(tariff_dict["licenses"])
-
-                                        # Also take inline plan and service
-                                        else:
-
-                                            # Add tariff plan licenses to all tariffs lic list if exist
-                                            if "licenses" in asset_tariff:
-                                                all_tar_lic_list.extend(asset_tariff["licenses"])
-
-                                    # Search for all needed licenses in tariff licenses and skip if not found
-                                    if not all(lic in all_tar_lic_list for lic in job["licenses"]):
-                                        logger.info("Job {asset}/{job} skipped because required license list {lic_list_job} is not found in joined licenses {lic_list_tar} of all of asset tariffs".format(asset=asset["fqdn"], job=job["id"], lic_list_job=job["licenses"], lic_list_tar=all_tar_lic_list))
+                                # Check licenses, asset licenses are joined licenses of all asset tariffs activated at tariff date
+                                if job.licenses is not None:
+                                    if not job.licenses <= asset.licenses:
+                                        jobs_logger.info("Job %s/%s skipped because required licenses %s are not found in joined licenses %s of all of asset tariffs", asset.fqdn, job.id, job.licenses, asset.licenses)
                                         continue
-                                    else:
-                                        logger.info("Job {asset}/{job} required license list {lic_list_job} is found in joined licenses {lic_list_tar} of all of asset tariffs".format(asset=asset["fqdn"], job=job["id"], lic_list_job=job["licenses"], lic_list_tar=all_tar_lic_list))
+                                    jobs_logger.info("Job %s/%s required licenses %s are found in joined licenses %s of all of asset tariffs", asset.fqdn, job.id, job.licenses, asset.licenses)
 
                                 # Check run_job
                                 if args.run_job:
-                                    if job["id"] != run_job:
-                                        logger.info("Job {asset}/{job} skipped because it is not needed job".format(asset=asset["fqdn"], job=job["id"]))
+                                    if job.id != run_job:
+                                        jobs_logger.info("Job %s/%s skipped because it is not needed job", asset.fqdn, job.id)
                                         continue
 
                                 # Job error should not stop other jobs
                                 try:
 
                                     # Make now from saved_now in job timezone
-                                    now = saved_now.astimezone(pytz.timezone(job["tz"]))
-                                    logger.info("Job {asset}/{job} now() in job TZ is {now}".format(asset=asset["fqdn"], job=job["id"], now=datetime.strftime(now, "%Y-%m-%d %H:%M:%S %z %Z")))
-
-                                    # Load last job run from jobs_log table
-                                    sql = """
-                                    SELECT
-                                            jobs_script_run_at
-                                    ,       job_tz
-                                    FROM
-                                            jobs_log
-                                    WHERE
-                                            client = '{client}'
-                                    AND
-                                            asset_fqdn = '{asset_fqdn}'
-                                    AND
-                                            job_id = '{job_id}'
-                                    ORDER BY
-                                            id DESC
-                                    LIMIT 1
-                                    ;
-                                    """.format(client=client_dict["name"], asset_fqdn=asset["fqdn"], job_id=job["id"])
-                                    logger.info("Query:")
-                                    logger.info(sql)
-
-                                    cur.execute(sql)
-
-                                    # Get job last run
-                                    if cur.rowcount > 0:
-                                        row = cur.fetchone()
-                                        row_jobs_script_run_at = row[0]
-                                        row_job_tz = row[1]
-                                        row_offset = datetime.now(pytz.timezone(row_job_tz)).strftime("%z") # now is just for an object
-                                        job_last_run_text = datetime.strftime(row_jobs_script_run_at, "%Y-%m-%d %H:%M:%S") + " " + row_offset
-                                        job_last_run = datetime.strptime(job_last_run_text, "%Y-%m-%d %H:%M:%S %z")
-                                    else:
-                                        job_last_run = datetime.strptime("1970-01-01 00:00:00 +0000", "%Y-%m-%d %H:%M:%S %z")
-                                    logger.info("Job {asset}/{job} last run: {time}".format(asset=asset["fqdn"], job=job["id"], time=datetime.strftime(job_last_run, "%Y-%m-%d %H:%M:%S %z %Z")))
+                                    now = saved_now.astimezone(job.schedule.tz)
+                                    jobs_logger.info("Job %s/%s now() in job TZ is %s", asset.fqdn, job.id, datetime.strftime(now, "%Y-%m-%d %H:%M:%S %z %Z"))
+
+                                    # Take last job run loaded for client
+                                    job_last_run = client_jobs_last_run.get((asset.fqdn, job.id), JOB_NEVER_RUN)
+                                    jobs_logger.info("Job %s/%s last run: %s", asset.fqdn, job.id, datetime.strftime(job_last_run, "%Y-%m-%d %H:%M:%S %z %Z"))
                                     
                                     # Check force run
 
                                     if args.force_run_job:
 
-                                        if job["id"] != run_job:
-                                            logger.info("Job {asset}/{job} skipped because job id didn't match force run parameter".format(asset=asset["fqdn"], job=job["id"]))
+                                        if job.id != run_job:
+                                            jobs_logger.info("Job %s/%s skipped because job id didn't match force run parameter", asset.fqdn, job.id)
                                             continue
-                                        logger.info("Job {asset}/{job} force run - time conditions omitted".format(asset=asset["fqdn"], job=job["id"]))
+                                        jobs_logger.info("Job %s/%s force run - time conditions omitted", asset.fqdn, job.id)
 
                                     else:
 
                                         # Decide if needed to run
-
-                                        if "each" in job:
-                                            seconds_between_now_and_job_last_run = (now - job_last_run).total_seconds()
-                                            logger.info("Job {asset}/{job} seconds between now and job last run: {secs}".format(asset=asset["fqdn"], job=job["id"], secs=seconds_between_now_and_job_last_run))
-                                            seconds_needed_to_wait = 0-2*MINUTES_JITTER*60
-                                            if "years" in job["each"]:
-                                                seconds_needed_to_wait += 60*60*24*365*job["each"]["years"]
-                                            if "months" in job["each"]:
-                                                seconds_needed_to_wait += 60*60*24*31*job["each"]["month"]
-                                            if "weeks" in job["each"]:
-                                                seconds_needed_to_wait += 60*60*24*7*job["each"]["weeks"]
-                                            if "days" in job["each"]:
-                                                seconds_needed_to_wait += 60*60*24*job["each"]["days"]
-                                            if "hours" in job["each"]:
-                                                seconds_needed_to_wait += 60*60*job["each"]["hours"]
-                                            if "minutes" in job["each"]:
-                                                seconds_needed_to_wait += 60*job["each"]["minutes"]
-                                            logger.info("Job {asset}/{job} seconds needed to wait from \"each\" key: {secs}".format(asset=asset["fqdn"], job=job["id"], secs=seconds_needed_to_wait))
-                                            if seconds_between_now_and_job_last_run < seconds_needed_to_wait:
-                                                logger.info("Job {asset}/{job} skipped because: {secs1} < {secs2}".format(asset=asset["fqdn"], job=job["id"], secs1=seconds_between_now_and_job_last_run, secs2=seconds_needed_to_wait))
-                                                continue
-
-                                        if "minutes" in job:
-                                            minutes_rewrited = []
-                                            for minutes in job["minutes"]:
-                                                if len(str(minutes).split("-")) > 1:
-                                                    for m in range(int(str(minutes).split("-")[0]), int(str(minutes).split("-")[1])+1):
-                                                        minutes_rewrited.append(m)
-                                                else:
-                                                    # Apply MINUTES_JITTER
-                                                    for m in range(minutes, minutes + MINUTES_JITTER):
-                                                        minutes_rewrited.append(m)
-                                            logger.info("Job {asset}/{job} should be run on minutes: {mins}".format(asset=asset["fqdn"], job=job["id"], mins=minutes_rewrited))
-                                            now_minute = int(datetime.strftime(now, "%M"))
-                                            logger.info("Job {asset}/{job} now minute is: {minute}".format(asset=asset["fqdn"], job=job["id"], minute=now_minute))
-                                            if now_minute not in minutes_rewrited:
-                                                logger.info("Job {asset}/{job} skipped because now minute is not in run minutes list".format(asset=asset["fqdn"], job=job["id"]))
-                                                continue
-
-                                        if "hours" in job:
-                                            hours_rewrited = []
-                                            for hours in job["hours"]:
-                                                if len(str(hours).split("-")) > 1:
-                                                    for h in range(int(str(hours).split("-")[0]), int(str(hours).split("-")[1])+1):
-                                                        hours_rewrited.append(h)
-                                                else:
-                                                    hours_rewrited.append(hours)
-                                            logger.info("Job {asset}/{job} should be run on hours: {hours}".format(asset=asset["fqdn"], job=job["id"], hours=hours_rewrited))
-                                            now_hour = int(datetime.strftime(now, "%H"))
-                                            logger.info("Job {asset}/{job} now hour is: {hour}".format(asset=asset["fqdn"], job=job["id"], hour=now_hour))
-                                            if now_hour not in hours_rewrited:
-                                                logger.info("Job {asset}/{job} skipped because now hour is not in run hours list".format(asset=asset["fqdn"], job=job["id"]))
-                                                continue
-                                        
-                                        if "days" in job:
-                                            days_rewrited = []
-                                            for days in job["days"]:
-                                                if len(str(days).split("-")) > 1:
-                                                    for d in range(int(str(days).split("-")[0]), int(str(days).split("-")[1])+1):
-                                                        days_rewrited.append(d)
-                                                else:
-                                                    days_rewrited.append(days)
-                                            logger.info("Job {asset}/{job} should be run on days: {days}".format(asset=asset["fqdn"], job=job["id"], days=days_rewrited))
-                                            now_day = int(datetime.strftime(now, "%d"))
-                                            logger.info("Job {asset}/{job} now day is: {day}".format(asset=asset["fqdn"], job=job["id"], day=now_day))
-                                            if now_day not in days_rewrited:
-                                                logger.info("Job {asset}/{job} skipped because now day is not in run days list".format(asset=asset["fqdn"], job=job["id"]))
-                                                continue
-                                        
-                                        if "months" in job:
-                                            months_rewrited = []
-                                            for months in job["months"]:
-                                                if len(str(months).split("-")) > 1:
-                                                    for m in range(int(str(months).split("-")[0]), int(str(months).split("-")[1])+1):
-                                                        months_rewrited.append(m)
-                                                else:
-                                                    months_rewrited.append(months)
-                                            logger.info("Job {asset}/{job} should be run on months: {months}".format(asset=asset["fqdn"], job=job["id"], months=months_rewrited))
-                                            now_month = int(datetime.strftime(now, "%m"))
-                                            logger.info("Job {asset}/{job} now month is: {month}".format(asset=asset["fqdn"], job=job["id"], month=now_month))
-                                            if now_month not in months_rewrited:
-                                                logger.info("Job {asset}/{job} skipped because now month is not in run months list".format(asset=asset["fqdn"], job=job["id"]))
-                                                continue
-                                        
-                                        if "years" in job:
-                                            years_rewrited = []
-                                            for years in job["years"]:
-                                                if len(str(years).split("-")) > 1:
-                                                    for y in range(int(str(years).split("-")[0]), int(str(years).split("-")[1])+1):
-                                                        years_rewrited.append(y)
-                                                else:
-                                                    years_rewrited.append(years)
-                                            logger.info("Job {asset}/{job} should be run on years: {years}".format(asset=asset["fqdn"], job=job["id"], years=years_rewrited))
-                                            now_year = int(datetime.strftime(now, "%Y"))
-                                            logger.info("Job {asset}/{job} now year is: {year}".format(asset=asset["fqdn"], job=job["id"], year=now_year))
-                                            if now_year not in years_rewrited:
-                                                logger.info("Job {asset}/{job} skipped because now year is not in run years list".format(asset=asset["fqdn"], job=job["id"]))
-                                                continue
-                                        
-                                        if "weekdays" in job:
-                                            logger.info("Job {asset}/{job} should be run on weekdays: {weekdays}".format(asset=asset["fqdn"], job=job["id"], weekdays=job["weekdays"]))
-                                            now_weekday = datetime.strftime(now, "%a")
-                                            logger.info("Job {asset}/{job} now weekday is: {weekday}".format(asset=asset["fqdn"], job=job["id"], weekday=now_weekday))
-                                            if now_weekday not in job["weekdays"]:
-                                                logger.info("Job {asset}/{job} skipped because now weekday is not in run weekdays list".format(asset=asset["fqdn"], job=job["id"]))
-                                                continue
+                                        if not job_is_due(job, asset.fqdn, now, job_last_run, jobs_logger):
+                                            continue
 
                                     # Run job
 
-                                    if job["type"] == "salt_cmd":
-                                        script = textwrap.dedent(
-                                            """
-                                            .gitlab-server-job/pipeline_salt_cmd.sh nowait {salt_project} {timeout} {asset} "{job_cmd}"
-                                            """
-                                        ).format(salt_project=client_dict["gitlab"]["salt_project"]["path"], timeout=job["timeout"], asset=asset["fqdn"], job_cmd=job["cmd"])
-                                        logger.info("Running bash script:")
-                                        logger.info(script)
-                                        if not args.dry_run_pipeline:
-                                            subprocess.run(script, shell=True, universal_newlines=True, check=True, executable="/bin/bash")
-                                    elif job["type"] == "rsnapshot_backup_ssh":
-                                        
-                                        # Decide which connect host:port to use
-                                        if "ssh" in asset:
-
-                                            if "host" in asset["ssh"]:
-                                                ssh_host = asset["ssh"]["host"]
-                                            else:
-                                                ssh_host = asset["fqdn"]
-
-                                            if "port" in asset["ssh"]:
-                                                ssh_port = asset["ssh"]["port"]
-                                            else:
-                                                ssh_port = "22"
-
-                                        else:
-
-                                            ssh_host = asset["fqdn"]
-                                            ssh_port = "22"
-
-                                        # Decide ssh jump
-                                        if "ssh" in asset and "jump" in asset["ssh"]:
-                                            ssh_jump = "{host}:{port}".format(host=asset["ssh"]["jump"]["host"], port=asset["ssh"]["jump"]["port"] if "port" in asset["ssh"]["jump"] else "22")
-                                        else:
-                                            ssh_jump = ""
-
-                                        script = textwrap.dedent(
-                                            """
-                                            .gitlab-server-job/pipeline_rsnapshot_backup.sh nowait {salt_project} 0 {asset} SSH {ssh_host} {ssh_port} {ssh_jump}
-                                            """
-                                        ).format(salt_project=client_dict["gitlab"]["salt_project"]["path"], asset=asset["fqdn"], ssh_host=ssh_host, ssh_port=ssh_port, ssh_jump=ssh_jump)
-                                        logger.info("Running bash script:")
-                                        logger.info(script)
-                                        if not args.dry_run_pipeline:
-                                            subprocess.run(script, shell=True, universal_newlines=True, check=True, executable="/bin/bash")
-                                    elif job["type"] == "rsnapshot_backup_salt":
-                                        script = textwrap.dedent(
-                                            """
-                                            .gitlab-server-job/pipeline_rsnapshot_backup.sh nowait {salt_project} {timeout} {asset} SALT
-                                            """
-                                        ).format(salt_project=client_dict["gitlab"]["salt_project"]["path"], timeout=job["timeout"], asset=asset["fqdn"])
-                                        logger.info("Running bash script:")
-                                        logger.info(script)
-                                        if not args.dry_run_pipeline:
-                                            subprocess.run(script, shell=True, universal_newlines=True, check=True, executable="/bin/bash")
-                                    else:
-                                        raise Exception("Unknown job type: {jtype}".format(jtype=job["type"]))
-
-                                    # Print job details
-                                    print(
-                                        "Job: {client} {asset_fqdn} {job_id} {job_level} {job_type} {job_cmd} {job_timeout}".format(
-                                            client=client_dict["name"],
-                                            asset_fqdn=asset["fqdn"],
-                                            job_id=job["id"],
-                                            job_level=job["level"],
-                                            job_type=job["type"],
-                                            job_cmd=job["cmd"] if "cmd" in job else "",
-                                            job_timeout=job["timeout"] if "timeout" in job else ""
-                                        )
-                                    )
-
-                                    # Save job log
-                                    sql = """
-                                    INSERT INTO
-                                            jobs_log
-                                            (
-                                                    jobs_script_run_at
-                                            ,       client
-                                            ,       asset_fqdn
-                                            ,       job_id
-                                            ,       job_level
-                                            ,       job_type
-                                            ,       job_cmd
-                                            ,       job_timeout
-                                            ,       job_tz
-                                            )
-                                    VALUES
-                                            (
-                                                    '{jobs_script_run_at}'
-                                            ,       '{client}'
-                                            ,       '{asset_fqdn}'
-                                            ,       '{job_id}'
-                                            ,       '{job_level}'
-                                            ,       '{job_type}'
-                                            ,       TRIM(e'\t\n\r\ ' FROM CONVERT_FROM(DECODE('{job_cmd_base64}', 'BASE64'), 'UTF-8'))
-                                            ,       '{job_timeout}'
-                                            ,       '{job_tz}'
-                                            )
-                                    ;
-                                    """.format(
-                                        jobs_script_run_at=datetime.strftime(now, "%Y-%m-%d %H:%M:%S"),
-                                        client=client_dict["name"],
-                                        asset_fqdn=asset["fqdn"],
-                                        job_id=job["id"],
-                                        job_level=job["level"],
-                                        job_type=job["type"],
-                                        job_cmd_base64=base64.b64encode(job["cmd"].encode("ascii")).decode("ascii") if "cmd" in job else "",
-                                        job_timeout=job["timeout"] if "timeout" in job else "",
-                                        job_tz=job["tz"]
-                                    )
-                                    logger.info("Query:")
-                                    logger.info(sql)
-                                    try:
-                                        cur.execute(sql)
-                                        logger.info("Query execution status:")
-                                        logger.info(cur.statusmessage)
-                                        conn.commit()
-                                    except Exception as e:
-                                        raise Exception("Caught exception on query execution")
-                                
+                                    job_details, job_log_row, dispatch_func, dispatch_args = job_dispatch(client_dict, project, asset, job, now, args.dispatch_backend, args.dry_run_pipeline, logger)
+
+                                    # Dispatch job in worker pool, dispatched job is printed and its job log is saved when all client dispatches are finished
+                                    dispatcher.submit(client_dict["name"], client_dict["gitlab"]["salt_project"]["path"], job_details, job_log_row, dispatch_func, *dispatch_args)
+
                                 except Exception as e:
                                     logger.error("Caught exception, but not interrupting")
                                     logger.exception(e)
@@ -585,6 +777,16 @@ if __name__ == "__main__":
                     logger.exception(e)
                     errors = True
 
+                # Save job logs of clients with all dispatches finished, dispatched jobs are saved even if client failed later
+                finally:
+                    for done_client in dispatcher.done_clients():
+                        errors = save_dispatch_results(dispatcher, done_client, conn, cur, logger, sql_logger) or errors
+
+            # Wait for the rest of dispatches and save their job logs
+            for pending_client in list(dispatcher.pending):
+                errors = save_dispatch_results(dispatcher, pending_client, conn, cur, logger, sql_logger) or errors
+            dispatcher.shutdown()
+
             # Close connection
             cur.close()
             conn.close()
@@ -600,7 +802,7 @@ if __name__ == "__main__":
             gl.auth()
 
             # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
+            for client_file in client_registry.files(None if args.prune_run_tags[0] == "ALL" else args.prune_run_tags[0]):
 
                 # Client file errors should not stop other clients
                 try:
@@ -608,7 +810,7 @@ if __name__ == "__main__":
                     logger.info("Found client file: {0}".format(client_file))
 
                     # Load client YAML
-                    client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                    client_dict = client_registry.load(client_file)
                     if client_dict is None:
                         raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
                     
@@ -670,6 +872,153 @@ if __name__ == "__main__":
             if errors:
                 raise Exception("There were errors")
 
+        if args.plan:
+
+            # Plan window
+            plan_window = []
+            for plan_datetime in args.plan:
+                for plan_format in ["%Y-%m-%d %H:%M", "%Y-%m-%d"]:
+                    try:
+                        plan_window.append(pytz.utc.localize(datetime.strptime(plan_datetime, plan_format)))
+                        break
+                    except ValueError:
+                        pass
+                else:
+                    raise Exception("Wrong plan datetime: {0}".format(plan_datetime))
+            plan_from, plan_to = plan_window
+
+            # Last runs from db or none
+            if args.plan_seed_db:
+                conn = pg_connect()
+                cur = conn.cursor()
+                plan_last_runs = load_jobs_last_run(cur, sql_logger)
+                cur.close()
+                conn.close()
+            else:
+                plan_last_runs = {}
+
+            # Schedule entries the same way as in planned mode, tariff date is plan start if not set
+            plan_minutes_jitter = DAEMON_MINUTES_JITTER if args.plan_mode == "daemon" else MINUTES_JITTER
+            tariff_datetime = datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else plan_from.replace(tzinfo=None)
+            global_jobs = get_job_records(acc_yaml_dict["jobs"], "GLOBAL", plan_minutes_jitter) if "jobs" in acc_yaml_dict else {}
+            entries, errors = schedule_entries(client_registry, tariff_catalog, global_jobs, tariff_datetime, plan_minutes_jitter, CACHE_DIR, args.ignore_jobs_disabled, logger, jobs_logger)
+
+            plan_started = perf_counter()
+            dispatches = plan_dispatches(entries, plan_last_runs, plan_from, plan_to, None if args.plan_mode == "daemon" else RUN_JOBS_INTERVAL)
+            plan_seconds = perf_counter() - plan_started
+
+            if not args.plan_counts_only:
+                for due_at, (client, asset_fqdn, job_id) in dispatches:
+                    job = entries[(client, asset_fqdn, job_id)][2]
+                    print("Plan: {due_at} {client} {asset_fqdn} {job_id} {job_level} {job_type} (job TZ {job_due_at})".format(
+                        due_at=due_at.strftime("%Y-%m-%d %H:%M"),
+                        client=client,
+                        asset_fqdn=asset_fqdn,
+                        job_id=job_id,
+                        job_level=job.level,
+                        job_type=job.type,
+                        job_due_at=due_at.astimezone(job.schedule.tz).strftime("%Y-%m-%d %H:%M %Z")
+                    ))
+
+            # Dispatch counts per minute, busiest minutes show pile-ups
+            minute_counts = Counter(due_at.strftime("%Y-%m-%d %H:%M") for due_at, key in dispatches)
+            for minute, count in sorted(minute_counts.items()):
+                print("Minute: {0} {1}".format(minute, count))
+            print("Planned {0} dispatches of {1} jobs from {2} to {3} in {4:.3f} s".format(len(dispatches), len(entries), plan_from.strftime("%Y-%m-%d %H:%M"), plan_to.strftime("%Y-%m-%d %H:%M"), plan_seconds))
+            for minute, count in sorted(minute_counts.items(), key=lambda item: item[1], reverse=True)[:10]:
+                print("Busiest minute: {0} {1}".format(minute, count))
+
+            # Exit with error if there were errors
+            if errors:
+                raise Exception("There were errors")
+
+        if args.daemon:
+
+            # Connect to PG and GitLab once, connections are kept while daemon runs
+            pg = PGConnection()
+            gl = gitlab_connect(acc_yaml_dict["gitlab"]["url"], GL_ADMIN_PRIVATE_TOKEN)
+
+            dispatcher = JobDispatcher(DISPATCH_WORKERS, DISPATCH_CLIENT_LIMIT, DISPATCH_PROJECT_LIMIT)
+            schedule = JobSchedule()
+            # client -> GitLab project, needed for api dispatch backend only, reset on reload
+            projects = {}
+            sources_state = None
+            schedule_date = None
+            next_check = None
+
+            # Stop on SIGTERM or SIGINT, started dispatches are finished and saved
+            stop = threading.Event()
+            signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+            signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+            while not stop.is_set():
+
+                # Loop errors should not stop daemon
+                try:
+
+                    saved_now = datetime.now(pytz.timezone("UTC"))
+
+                    # Reload schedule if config files changed, or on new day as asset licenses depend on tariff date
+                    if next_check is None or saved_now >= next_check:
+                        next_check = saved_now + timedelta(seconds=DAEMON_CHECK_SECONDS)
+                        new_sources_state = config_sources_state(WORK_DIR, ACC_YAML, TARIFFS_SUBDIR, CLIENTS_SUBDIR)
+                        tariff_datetime = datetime.now()
+                        if new_sources_state != sources_state or tariff_datetime.date() != schedule_date:
+                            logger.info("Loading jobs schedule")
+                            sources_state = new_sources_state
+                            schedule_date = tariff_datetime.date()
+                            if pg.conn.closed:
+                                pg.reconnect()
+                            acc_yaml_dict = load_yaml_cached("{0}/{1}".format(WORK_DIR, ACC_YAML), CACHE_DIR, logger, config_snapshot)
+                            if acc_yaml_dict is None:
+                                raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, ACC_YAML))
+                            global_jobs = get_job_records(acc_yaml_dict["jobs"], "GLOBAL", DAEMON_MINUTES_JITTER) if "jobs" in acc_yaml_dict else {}
+                            client_registry = ClientRegistry(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, logger, CACHE_DIR, config_snapshot, secrets=False)
+                            tariff_catalog = TariffCatalog(WORK_DIR, TARIFFS_SUBDIR, logger, CACHE_DIR, config_snapshot)
+                            entries, load_errors = schedule_entries(client_registry, tariff_catalog, global_jobs, tariff_datetime, DAEMON_MINUTES_JITTER, CACHE_DIR, args.ignore_jobs_disabled, logger, jobs_logger)
+                            schedule.load(entries, load_jobs_last_run(pg.cur, sql_logger), saved_now)
+                            projects = {}
+                            logger.info("Loaded jobs schedule of {0} jobs, next job is due at {1}".format(len(entries), schedule.next_due_at()))
+
+                    # Dispatch due jobs, job now is its due time in job TZ
+                    for due_at, (client, asset_fqdn, job_id), (client_dict, asset, job) in schedule.pop_due(saved_now):
+
+                        # Job error should not stop other jobs
+                        try:
+                            if api_dispatch(client_dict, args.dispatch_backend) and client not in projects:
+                                projects[client] = gl.projects.get(client_dict["gitlab"]["salt_project"]["path"])
+                            job_details, job_log_row, dispatch_func, dispatch_args = job_dispatch(client_dict, projects.get(client), asset, job, due_at.astimezone(job.schedule.tz), args.dispatch_backend, args.dry_run_pipeline, logger)
+                            dispatcher.submit(client, client_dict["gitlab"]["salt_project"]["path"], job_details, job_log_row, dispatch_func, *dispatch_args)
+                        except Exception as e:
+                            logger.error("Caught exception, but not interrupting")
+                            logger.exception(e)
+                            schedule.retry((client, asset_fqdn, job_id), saved_now + timedelta(minutes=DAEMON_RETRY_MINUTES))
+
+                    # Save job logs of clients with all dispatches finished, failed dispatches are retried
+                    failed = []
+                    for done_client in dispatcher.done_clients():
+                        save_dispatch_results(dispatcher, done_client, pg.conn, pg.cur, logger, sql_logger, failed, pg.reconnect)
+                    for failed_key in failed:
+                        schedule.retry(failed_key, saved_now + timedelta(minutes=DAEMON_RETRY_MINUTES))
+
+                except Exception as e:
+                    logger.error("Caught exception, but not interrupting")
+                    logger.exception(e)
+
+                # Sleep until the next due job or config check
+                wake_at = next_check if schedule.next_due_at() is None else min(next_check, schedule.next_due_at())
+                stop.wait(max(0, (wake_at - datetime.now(pytz.timezone("UTC"))).total_seconds()))
+
+            logger.info("Stopping jobs daemon")
+
+            # Wait for the rest of dispatches and save their job logs
+            for pending_client in list(dispatcher.pending):
+                save_dispatch_results(dispatcher, pending_client, pg.conn, pg.cur, logger, sql_logger, reconnect=pg.reconnect)
+            dispatcher.shutdown()
+
+            # Close connection
+            pg.close()
+
     # Reroute catched exception to log
     except Exception as e:
         logger.exception(e)
@@ -9,9 +9,6 @@ import textwrap
 import subprocess
 import re
 import yaml
-from ruamel.yaml import YAML
-from ruamel.yaml.scalarstring import PreservedScalarString as pss
-from jinja2 import Environment, FileSystemLoader, TemplateNotFound
 from datetime import datetime
 from datetime import time
 
@@ -20,6 +17,8 @@ from datetime import time
 LOGO="Projects"
 WORK_DIR = os.environ.get("ACC_WORKDIR", "/opt/sysadmws/accounting")
 LOG_DIR = os.environ.get("ACC_LOGDIR", "/opt/sysadmws/accounting/log")
+CACHE_DIR = os.environ.get("ACC_CACHEDIR", "{0}/.cache".format(WORK_DIR))
+CONFIG_SNAPSHOT = os.environ.get("ACC_CONFIG_SNAPSHOT", "{0}/config.snapshot".format(WORK_DIR))
 LOG_FILE = "projects.log"
 TARIFFS_SUBDIR = "tariffs"
 CLIENTS_SUBDIR = "clients"
@@ -94,10 +93,19 @@ if __name__ == "__main__":
         # Chdir to work dir
         os.chdir(WORK_DIR)
 
+        # Prebuilt config snapshot, used for files unchanged since it was built
+        config_snapshot = ConfigSnapshot(CONFIG_SNAPSHOT, WORK_DIR, logger)
+
         # Read ACC_YAML
-        acc_yaml_dict = load_yaml("{0}/{1}".format(WORK_DIR, ACC_YAML), logger)
+        acc_yaml_dict = load_yaml_cached("{0}/{1}".format(WORK_DIR, ACC_YAML), CACHE_DIR, logger, config_snapshot)
         if acc_yaml_dict is None:
             raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, ACC_YAML))
+
+        # Client registry, each client YAML is loaded once per run
+        client_registry = ClientRegistry(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, logger, CACHE_DIR, config_snapshot)
+
+        # Tariff catalog, each tariff file is loaded once per run
+        tariff_catalog = get_tariff_catalog(WORK_DIR, TARIFFS_SUBDIR, logger, CACHE_DIR, config_snapshot)
         
         # Do tasks
 
@@ -120,12 +128,12 @@ if __name__ == "__main__":
             gl.auth()
 
             # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
+            for client_file in client_registry.files(args.setup_projects_for_client[0] if args.setup_projects_for_client is not None else None):
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                client_dict = client_registry.load(client_file)
                 if client_dict is None:
                     raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
                 
@@ -333,12 +341,12 @@ if __name__ == "__main__":
             gl.auth()
 
             # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
+            for client_file in client_registry.files(args.clone_project_for_client[0] if args.clone_project_for_client is not None else None):
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                client_dict = client_registry.load(client_file)
                 if client_dict is None:
                     raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
                 
@@ -413,18 +421,23 @@ if __name__ == "__main__":
                     subprocess.run(script, shell=True, universal_newlines=True, check=True, executable="/bin/bash")
 
         if args.template_salt_project_for_client is not None or args.template_salt_project_for_all_clients:
+
+            # Templating modules are needed only here
+            from ruamel.yaml import YAML
+            from ruamel.yaml.scalarstring import PreservedScalarString as pss
+            from jinja2 import Environment, FileSystemLoader, TemplateNotFound
             
             # Connect to GitLab
             gl = gitlab.Gitlab(acc_yaml_dict["gitlab"]["url"], private_token=GL_ADMIN_PRIVATE_TOKEN)
             gl.auth()
 
             # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
+            for client_file in client_registry.files(args.template_salt_project_for_client[0] if args.template_salt_project_for_client is not None else None):
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                client_dict = client_registry.load(client_file)
                 if client_dict is None:
                     raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
                 
@@ -513,10 +526,10 @@ if __name__ == "__main__":
                     if "sub_clients" in client_dict["configuration_management"]:
 
                         # For *.yaml in client dir
-                        for template_var_client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+                        for template_var_client_file in client_registry.files():
 
                             # Load client YAML
-                            template_var_client_dict = load_client_yaml(WORK_DIR, template_var_client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                            template_var_client_dict = client_registry.load(template_var_client_file)
                             if template_var_client_dict is None:
                                 raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, template_var_client_file))
 
@@ -994,12 +1007,12 @@ if __name__ == "__main__":
             gl.auth()
 
             # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
+            for client_file in client_registry.files(args.update_admin_project_wiki_for_client[0] if args.update_admin_project_wiki_for_client is not None else None):
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                client_dict = client_registry.load(client_file)
                 if client_dict is None:
                     raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
 
@@ -3,14 +3,11 @@
 
 # Import common code
 from sysadmws_common import *
-import gitlab
 import glob
 import textwrap
 import subprocess
-import paramiko
 import sys
 import json
-from io import BytesIO
 import threading
 import re
 import time
@@ -21,6 +18,8 @@ from datetime import datetime
 LOGO="Services"
 WORK_DIR = os.environ.get("ACC_WORKDIR", "/opt/sysadmws/accounting")
 LOG_DIR = os.environ.get("ACC_LOGDIR", "/opt/sysadmws/accounting/log")
+CACHE_DIR = os.environ.get("ACC_CACHEDIR", "{0}/.cache".format(WORK_DIR))
+CONFIG_SNAPSHOT = os.environ.get("ACC_CONFIG_SNAPSHOT", "{0}/config.snapshot".format(WORK_DIR))
 LOG_FILE = "services.log"
 CLIENTS_SUBDIR = "clients"
 TARIFFS_SUBDIR = "tariffs"
@@ -93,10 +92,19 @@ if __name__ == "__main__":
         # Chdir to work dir
         os.chdir(WORK_DIR)
 
+        # Prebuilt config snapshot, used for files unchanged since it was built
+        config_snapshot = ConfigSnapshot(CONFIG_SNAPSHOT, WORK_DIR, logger)
+
         # Read ACC_YAML
-        acc_yaml_dict = load_yaml("{0}/{1}".format(WORK_DIR, ACC_YAML), logger)
+        acc_yaml_dict = load_yaml_cached("{0}/{1}".format(WORK_DIR, ACC_YAML), CACHE_DIR, logger, config_snapshot)
         if acc_yaml_dict is None:
             raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, ACC_YAML))
+
+        # Client registry, each client YAML is loaded once per run, without key material as it is not needed here
+        client_registry = ClientRegistry(WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, logger, CACHE_DIR, config_snapshot, secrets=False)
+
+        # Tariff catalog, each tariff file is loaded once per run
+        tariff_catalog = get_tariff_catalog(WORK_DIR, TARIFFS_SUBDIR, logger, CACHE_DIR, config_snapshot)
         
         # Do tasks
 
@@ -115,12 +123,12 @@ if __name__ == "__main__":
         if args.pipeline_salt_cmd_for_asset_for_client or args.pipeline_salt_cmd_for_all_assets_for_client or args.pipeline_salt_cmd_for_all_assets_for_all_clients:
             
             # For *.yaml in client dir
-            for client_file in glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB)):
+            for client_file in client_registry.files((args.pipeline_salt_cmd_for_asset_for_client or args.pipeline_salt_cmd_for_all_assets_for_client)[0] if not args.pipeline_salt_cmd_for_all_assets_for_all_clients else None):
 
                 logger.info("Found client file: {0}".format(client_file))
 
                 # Load client YAML
-                client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger)
+                client_dict = client_registry.load(client_file)
                 if client_dict is None:
                     raise Exception("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
                 
@@ -166,7 +174,8 @@ if __name__ == "__main__":
                     if not args.ignore_jobs_disabled and "jobs_disabled" in client_dict and client_dict["jobs_disabled"]:
                         continue
             
-                    asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now())
+                    # Pipelines are only for servers, other assets and other servers if specific asset is set are skipped before tariffs are resolved
+                    asset_list = iter_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, datetime.strptime(args.at_date[0], "%Y-%m-%d") if args.at_date is not None else datetime.now(), fqdn=needed_asset, kind="server", active=True)
 
                     # Threaded function
                     def pipeline_salt_cmd(salt_project, asset, cmd):
@@ -195,24 +204,16 @@ if __name__ == "__main__":
 
                     # For each asset
                     for asset in asset_list:
-                        
-                        # Pipelines are only for servers
-                        if asset["kind"] == "server":
-
-                            # Skip assets with disabled jobs
-                            if "jobs_disabled" in asset and asset["jobs_disabled"]:
-                                continue
-
-                            # Skip oher assets if specific asset is set
-                            if needed_asset is not None:
-                                if needed_asset != asset["fqdn"]:
-                                    continue
-
-                            # Run pipeline
-                            thread = threading.Thread(target=pipeline_salt_cmd, args=[client_dict["gitlab"]["salt_project"]["path"], asset["fqdn"], cmd])
-                            thread.start()
-                            # Give gitlab time to create tag and pipeline, otherwise it will be overloaded
-                            time.sleep(4)
+
+                        # Skip assets with disabled jobs
+                        if "jobs_disabled" in asset and asset["jobs_disabled"]:
+                            continue
+
+                        # Run pipeline
+                        thread = threading.Thread(target=pipeline_salt_cmd, args=[client_dict["gitlab"]["salt_project"]["path"], asset["fqdn"], cmd])
+                        thread.start()
+                        # Give gitlab time to create tag and pipeline, otherwise it will be overloaded
+                        time.sleep(4)
 
     # Reroute catched exception to log
     except Exception as e:
@@ -7,15 +7,33 @@ import datetime
 import yaml
 import logging
 from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
+import multiprocessing
+import atexit
 from collections import OrderedDict
 import json
 import argparse
 import glob
+import hashlib
+import copy
+import bisect
+import pickle
+import concurrent.futures
 from datetime import datetime
 from datetime import time
+from datetime import timedelta
 from mergedeep import merge
+from dateutil.relativedelta import relativedelta
+import pytz
 #import pdb
 
+# Use libyaml based safe loader if PyYAML was built with libyaml, pure Python safe loader otherwise
+if yaml.__with_libyaml__:
+    YAML_SAFE_LOADER = yaml.CSafeLoader
+else:
+    YAML_SAFE_LOADER = yaml.SafeLoader
+
 # Custom Exceptions
 class DictError(Exception):
     pass
@@ -23,6 +41,38 @@ class DictError(Exception):
 class LoadError(Exception):
     pass
 
+# Dict that cannot be changed after creation, used to share parsed objects within the run
+class ReadOnlyDict(dict):
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Read-only dict cannot be changed")
+
+    __setitem__ = _read_only
+    __delitem__ = _read_only
+    clear = _read_only
+    pop = _read_only
+    popitem = _read_only
+    setdefault = _read_only
+    update = _read_only
+    __ior__ = _read_only
+
+    def __reduce__(self):
+        return (ReadOnlyDict, (dict(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+# Make read-only copy of parsed YAML: dicts become ReadOnlyDict, lists become tuples
+def read_only(data):
+    if isinstance(data, dict):
+        return ReadOnlyDict((key, read_only(value)) for key, value in data.items())
+    if isinstance(data, list):
+        return tuple(read_only(value) for value in data)
+    return data
+
 # Check needed key in dict
 def check_key(key, c_dict):
     if not key in c_dict:
@@ -49,11 +99,60 @@ def load_yaml(f, l):
     l.info("Loading YAML from file {0}".format(f))
     try:
         with open(f, 'r') as yaml_file:
-            yaml_dict = yaml.load(yaml_file, Loader=yaml.SafeLoader)
+            yaml_dict = yaml.load(yaml_file, Loader=YAML_SAFE_LOADER)
+    except:
+        raise LoadError("Reading YAML from file '{0}' failed".format(f))
+    return yaml_dict
+
+# Load YAML via config snapshot or compiled cache in cache_dir, both are keyed by file content hash
+# Any of cache_dir and snapshot can be None
+def load_yaml_cached(f, cache_dir, l, snapshot=None):
+    try:
+        with open(f, 'rb') as yaml_file:
+            yaml_bytes = yaml_file.read()
+    except:
+        raise LoadError("Reading YAML from file '{0}' failed".format(f))
+    yaml_hash = hashlib.sha256(yaml_bytes).hexdigest()
+    if snapshot is not None and snapshot.has_yaml(f, yaml_hash):
+        l.info("Loaded YAML from file {0} via config snapshot {1}".format(f, snapshot.snapshot_file))
+        return snapshot.yaml[f][1]
+    if cache_dir is not None:
+        cache_file = "{0}/yaml/{1}.pickle".format(cache_dir, yaml_hash)
+        yaml_dict = load_cache_file(cache_file, l)
+        if yaml_dict is not None:
+            l.info("Loaded YAML from file {0} via cache {1}".format(f, cache_file))
+            return yaml_dict
+    l.info("Loading YAML from file {0}".format(f))
+    try:
+        yaml_dict = yaml.load(yaml_bytes, Loader=YAML_SAFE_LOADER)
     except:
         raise LoadError("Reading YAML from file '{0}' failed".format(f))
+    if cache_dir is not None:
+        save_cache_file(cache_file, yaml_dict, l)
     return yaml_dict
 
+# Load pickled cache file, None if missing or broken
+def load_cache_file(cache_file, l):
+    try:
+        with open(cache_file, 'rb') as pickle_file:
+            return pickle.load(pickle_file)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        l.warning("Cache file {0} is broken, ignoring: {1}".format(cache_file, e))
+        return None
+
+# Save pickled cache file atomically, cache errors should not stop anything
+def save_cache_file(cache_file, data, l):
+    try:
+        os.makedirs(os.path.dirname(cache_file), 0o700, exist_ok=True)
+        tmp_file = "{0}.{1}.tmp".format(cache_file, os.getpid())
+        with open(tmp_file, 'wb') as pickle_file:
+            pickle.dump(data, pickle_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except Exception as e:
+        l.warning("Saving cache file {0} failed: {1}".format(cache_file, e))
+
 # Load FILE
 def load_file_string(f, l):
     l.info("Loading string from file {0}".format(f))
@@ -67,35 +166,84 @@ def load_file_string(f, l):
 # Set logger
 def set_logger(console_level, log_dir, log_file):
     logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
+    # File log level, DEBUG by default
+    file_level = log_level(os.environ.get("ACC_LOG_LEVEL", "DEBUG"))
+    # Records below both file and console levels are dropped before formatting
+    logger.setLevel(min(file_level, console_level))
     if not os.path.isdir(log_dir):
         os.mkdir(log_dir, 0o755)
     log_handler = RotatingFileHandler("{0}/{1}".format(log_dir, log_file), maxBytes=10485760, backupCount=10, encoding="utf-8")
     os.chmod("{0}/{1}".format(log_dir, log_file), 0o600)
-    log_handler.setLevel(logging.DEBUG)
+    log_handler.setLevel(file_level)
     console_handler = logging.StreamHandler()
     console_handler.setLevel(console_level)
     formatter = logging.Formatter(fmt='%(asctime)s %(filename)s %(name)s %(process)d/%(threadName)s %(levelname)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S %Z")
     log_handler.setFormatter(formatter)
     console_handler.setFormatter(formatter)
-    logger.addHandler(log_handler)
-    logger.addHandler(console_handler)
+    # Handlers are run by background listener thread, so callers do not wait for file writes
+    # Multiprocessing queue also passes records from spawned preload processes to the same listener
+    log_queue = multiprocessing.get_context("spawn").Queue(-1)
+    log_listener = QueueListener(log_queue, log_handler, console_handler, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    logger.addHandler(QueueHandler(log_queue))
+    # Per subsystem levels, e.g. ACC_LOG_LEVELS="sql=WARNING,tariffs=INFO"
+    for subsystem_level in os.environ.get("ACC_LOG_LEVELS", "").split(","):
+        if subsystem_level.strip() == "":
+            continue
+        if "=" not in subsystem_level:
+            raise Exception("Env var ACC_LOG_LEVELS item {0} is not subsystem=LEVEL".format(subsystem_level))
+        subsystem, level = subsystem_level.split("=", 1)
+        logger.getChild(subsystem.strip()).setLevel(log_level(level))
     return logger
 
+# Convert level name like INFO to logging level
+def log_level(level_name):
+    level = logging.getLevelName(level_name.strip().upper())
+    if not isinstance(level, int):
+        raise Exception("Unknown log level {0}".format(level_name))
+    return level
+
 # Helps to find tariff in tariffs list which is activated for event date
 def activated_tariff(tariffs, event_date_time, logger):
-    event_tariff = None
-    for tariff in tariffs:
-        tariff_date_time = datetime.combine(tariff["activated"], time.min)
-        # Event datetime must be later than tariff datetime
-        if event_date_time >= tariff_date_time:
-            event_tariff = tariff
-            break
-    if event_tariff is not None:
-        logger.info("Found activated tariff {0} for event date time {1}".format(event_tariff, event_date_time))
-        return event_tariff
-    else:
-        raise Exception("Event date time {0} out of available tariffs date time".format(event_date_time))
+    event_tariff = TariffTimeline(tariffs).at(event_date_time)
+    logger.getChild("tariffs").debug("Found activated tariff %s for event date time %s", event_tariff, event_date_time)
+    return event_tariff
+
+# Tariff activation timeline of asset, compiled once from asset tariffs list
+# The first tariff in list order activated not later than event date time wins, the same as linear search over the list
+class TariffTimeline:
+
+    def __init__(self, tariffs):
+        # Activation datetimes sorted ascending with list positions
+        activations = sorted((datetime.combine(tariff["activated"], time.min), position) for position, tariff in enumerate(tariffs))
+        self.date_times = [date_time for date_time, position in activations]
+        # Winning tariff among all activated up to each sorted position
+        self.winners = []
+        winner_position = None
+        for date_time, position in activations:
+            if winner_position is None or position < winner_position:
+                winner_position = position
+            self.winners.append(tariffs[winner_position])
+
+    # Tariff activated at event date time
+    def at(self, event_date_time):
+        index = bisect.bisect_right(self.date_times, event_date_time)
+        if index == 0:
+            raise Exception("Event date time {0} out of available tariffs date time".format(event_date_time))
+        return self.winners[index - 1]
+
+    # Tariffs activated at many event date times, in the same order as event date times
+    def at_many(self, event_date_times):
+        event_tariffs = [None] * len(event_date_times)
+        index = 0
+        for event_position in sorted(range(len(event_date_times)), key=lambda position: event_date_times[position]):
+            while index < len(self.date_times) and self.date_times[index] <= event_date_times[event_position]:
+                index += 1
+            if index == 0:
+                raise Exception("Event date time {0} out of available tariffs date time".format(event_date_times[event_position]))
+            event_tariffs[event_position] = self.winners[index - 1]
+        return event_tariffs
 
 def get_active_assets(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime):
 
@@ -104,6 +252,7 @@ def get_active_assets(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime
     licenses = {}
 
     asset_list = get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime)
+    tariff_catalog = get_tariff_catalog(WORK_DIR, TARIFFS_SUBDIR, logger)
 
     # Iterate over assets in client
     for asset in asset_list:
@@ -114,92 +263,113 @@ def get_active_assets(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime
             tariffs[asset["fqdn"]] = []
             licenses[asset["fqdn"]] = []
 
-            # Iterate over tariffs
+            # Iterate over tariffs, file tariffs are taken from catalog, inline plan and service as is
             for asset_tariff in activated_tariff(asset["tariffs"], at_datetime, logger)["tariffs"]:
 
-                # If tariff has file key - load it
-                if "file" in asset_tariff:
-
-                    tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]), logger)
-                    if tariff_dict is None:
-                        raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
+                # Add tariff to the tariff list for the asset
+                tariffs[asset["fqdn"]].append(tariff_catalog.resolve(asset_tariff))
 
-                    # Add tariff to the tariff list for the asset
-                    tariffs[asset["fqdn"]].append(tariff_dict)
-
-                    # Add tariff plan licenses to all tariffs lic list if exist
-                    if "licenses" in tariff_dict:
-                        licenses[asset["fqdn"]].extend(tariff_dict["licenses"])
-
-                # Also take inline plan and service
-                else:
-
-                    # Add tariff to the tariff list for the asset
-                    tariffs[asset["fqdn"]].append(asset_tariff)
-
-                    # Add tariff plan licenses to all tariffs lic list if exist
-                    if "licenses" in asset_tariff:
-                        licenses[asset["fqdn"]].extend(asset_tariff["licenses"])
+                # Add tariff plan licenses to all tariffs lic list if exist
+                licenses[asset["fqdn"]].extend(tariff_catalog.licenses(asset_tariff))
 
     return assets, tariffs, licenses
 
-# Get asset list
-def get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime, only_active=True):
+# Assets of client as in YAML: servers (deprecated), assets and salt masters
+def client_asset_dicts(client_dict):
 
-    # Prepare asset list from servers (deprecated) and assets
-    asset_list_to_process = []
     if "servers" in client_dict:
-        asset_list_to_process.extend(client_dict["servers"])
+        yield from client_dict["servers"]
     if "assets" in client_dict:
-        asset_list_to_process.extend(client_dict["assets"])
+        yield from client_dict["assets"]
 
-    # Include salt masters in list
+    # Include salt masters
     if client_dict["configuration_management"]["type"] == "salt":
-        asset_list_to_process.extend(client_dict["configuration_management"]["salt"]["masters"])
+        yield from client_dict["configuration_management"]["salt"]["masters"]
+
+# Check asset dict against asset filters, None filter matches any asset
+def asset_matches(asset, fqdn=None, kind=None, active=None, asset_os=None, has_storage=None):
+    if fqdn is not None and asset["fqdn"] != fqdn:
+        return False
+    if kind is not None and asset.get("kind", "server") != kind:
+        return False
+    if active is not None and bool(asset["active"]) != active:
+        return False
+    if asset_os is not None and asset.get("os") != asset_os:
+        return False
+    if has_storage is not None and ("storage" in asset) != has_storage:
+        return False
+    return True
 
-    asset_list = []
-    # Set additional or default fields in assets
+# Get assets one by one, filters (see asset_matches) are checked before activated tariffs are resolved
+def iter_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime, **filters):
 
-    for asset in asset_list_to_process:
+    tariff_catalog = get_tariff_catalog(WORK_DIR, TARIFFS_SUBDIR, logger)
 
-        # Skip not active assets if only_active
-        if only_active:
-            if not asset["active"]:
-                continue
+    for asset in client_asset_dicts(client_dict):
+
+        # Skip not needed assets
+        if not asset_matches(asset, **filters):
+            continue
+
+        # Own shallow copy, raw client dicts are shared within the run and are not changed
+        asset = dict(asset)
 
         # Default kind: server
         if "kind" not in asset:
             asset["kind"] = "server"
 
-        # Set activated tariff
+        # Set activated tariff, file tariffs are taken from catalog, inline plan and service as is
         asset["activated_tariff"] = []
         for asset_tariff in activated_tariff(asset["tariffs"], at_datetime, logger)["tariffs"]:
+            asset["activated_tariff"].append(tariff_catalog.resolve(asset_tariff))
 
-            # If tariff has file key - load it
-            if "file" in asset_tariff:
-
-                tariff_dict = load_yaml("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, asset_tariff["file"]), logger)
-                if tariff_dict is None:
-
-                    raise Exception("Tariff file error or missing: {0}/{1}".format(WORK_DIR, asset_tariff["file"]))
+        yield asset
 
-                asset["activated_tariff"].append(tariff_dict)
-
-            # Also take inline plan and service
-            else:
+# Get asset list
+def get_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime, only_active=True, **filters):
+    return list(iter_asset_list(client_dict, WORK_DIR, TARIFFS_SUBDIR, logger, at_datetime, active=True if only_active else None, **filters))
 
-               asset["activated_tariff"].append(asset_tariff)
+# Read YAML from file, record file content hash in sources if needed
+def read_yaml_source(f, sources=None):
+    with open(f, 'rb') as yaml_file:
+        yaml_bytes = yaml_file.read()
+    if sources is not None:
+        sources["files"][f] = hashlib.sha256(yaml_bytes).hexdigest()
+    return yaml.load(yaml_bytes, Loader=YAML_SAFE_LOADER)
 
-        asset_list.append(asset)
+# Parsed include fragments within the process, keyed by path: (mtime_ns, size, content hash, parsed YAML)
+include_fragments = {}
 
-    return asset_list
+# Read included YAML fragment, parsed once per process while file mtime and size are unchanged and, with cache_dir, once per content hash
+# Returns own deep copy as merging changes dicts and shared includes are used by many clients
+def read_include_yaml(f, sources=None, cache_dir=None, logger=None):
+    include_stat = os.stat(f)
+    fragment = include_fragments.get(f)
+    if fragment is None or fragment[0] != include_stat.st_mtime_ns or fragment[1] != include_stat.st_size:
+        with open(f, 'rb') as yaml_file:
+            yaml_bytes = yaml_file.read()
+        yaml_hash = hashlib.sha256(yaml_bytes).hexdigest()
+        yaml_dict = None
+        if cache_dir is not None:
+            cache_file = "{0}/yaml/{1}.pickle".format(cache_dir, yaml_hash)
+            yaml_dict = load_cache_file(cache_file, logger)
+        if yaml_dict is None:
+            yaml_dict = yaml.load(yaml_bytes, Loader=YAML_SAFE_LOADER)
+            if cache_dir is not None:
+                save_cache_file(cache_file, yaml_dict, logger)
+        fragment = (include_stat.st_mtime_ns, include_stat.st_size, yaml_hash, yaml_dict)
+        include_fragments[f] = fragment
+    if sources is not None:
+        sources["files"][f] = fragment[2]
+    return copy.deepcopy(fragment[3])
 
 # Load asset YAML
-def load_client_yaml(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, logger):
+# If sources dict is given, all contributing files with their hashes and include dir globs are recorded into it
+# Included fragments are shared between clients via read_include_yaml, persistent with cache_dir
+def load_client_yaml(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, logger, sources=None, cache_dir=None):
     logger.info("Loading asset YAML from file {0}/{1}".format(WORK_DIR, f))
     try:
-        with open("{0}/{1}".format(WORK_DIR, f), 'r') as yaml_file:
-            yaml_dict = yaml.load(yaml_file, Loader=yaml.SafeLoader)
+        yaml_dict = read_yaml_source("{0}/{1}".format(WORK_DIR, f), sources)
     except:
         raise LoadError("Reading YAML from file {0}/{1} failed".format(WORK_DIR, f))
     
@@ -212,7 +382,11 @@ def load_client_yaml(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, logger):
             for dir_name in yaml_dict["include"]["dirs"]:
 
                 # Include dir_name/*.yaml
-                for include_file in sorted(glob.glob("{0}/{1}/{2}/{3}".format(WORK_DIR, CLIENTS_SUBDIR, dir_name, YAML_GLOB))):
+                include_glob = "{0}/{1}/{2}/{3}".format(WORK_DIR, CLIENTS_SUBDIR, dir_name, YAML_GLOB)
+                include_files = sorted(glob.glob(include_glob))
+                if sources is not None:
+                    sources["globs"][include_glob] = include_files
+                for include_file in include_files:
 
                     logger.info("Found include file: {0}".format(include_file))
 
@@ -224,8 +398,7 @@ def load_client_yaml(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, logger):
                                 should_open = False
                     if should_open:
                         try:
-                            with open(include_file, 'r') as included_yaml_file:
-                                included_yaml_dict = yaml.load(included_yaml_file, Loader=yaml.SafeLoader)
+                            included_yaml_dict = read_include_yaml(include_file, sources, cache_dir, logger)
                         except:
                             raise LoadError("Reading YAML from file {0} failed".format(include_file))
                     else:
@@ -265,8 +438,7 @@ def load_client_yaml(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, logger):
                 for include_file in yaml_dict["include"]["files"]:
 
                     try:
-                        with open("{0}/{1}".format(CLIENTS_SUBDIR, include_file), 'r') as included_yaml_file:
-                            included_yaml_dict = yaml.load(included_yaml_file, Loader=yaml.SafeLoader)
+                        included_yaml_dict = read_include_yaml("{0}/{1}".format(CLIENTS_SUBDIR, include_file), sources, cache_dir, logger)
                     except:
                         raise LoadError("Reading YAML from file {0} failed".format(include_file))
 
@@ -298,3 +470,807 @@ def load_client_yaml(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, logger):
                     yaml_dict["assets"] = old_assets + new_assets
 
     return yaml_dict
+
+# Client YAML keys with key material, only projects templating and setup need them
+SECRET_KEYS = frozenset(["pki", "root_ed25519", "root_rsa", "SALTSSH_ROOT_ED25519_PRIV"])
+
+# Split secret sections (SECRET_KEYS at any depth) out of parsed YAML
+# Returns copy without secret sections and list of (path, secret section), path is tuple of dict keys and list indexes
+def split_secrets(data, path=()):
+    secrets = []
+    if isinstance(data, dict):
+        stripped = {}
+        for key, value in data.items():
+            if key in SECRET_KEYS:
+                secrets.append((path + (key,), value))
+            else:
+                stripped[key], value_secrets = split_secrets(value, path + (key,))
+                secrets.extend(value_secrets)
+        return stripped, secrets
+    if isinstance(data, list):
+        stripped = []
+        for index, value in enumerate(data):
+            stripped_value, value_secrets = split_secrets(value, path + (index,))
+            stripped.append(stripped_value)
+            secrets.extend(value_secrets)
+        return stripped, secrets
+    return data, secrets
+
+# Put secret sections split by split_secrets back into data
+def join_secrets(data, secrets):
+    for path, value in secrets:
+        node = data
+        for key in path[:-1]:
+            node = node[key]
+        node[path[-1]] = value
+    return data
+
+# Load asset YAML via compiled cache in cache_dir
+# Cache entry holds fully merged client dict without secret sections and is valid while all contributing files and include dirs are unchanged
+# Secret sections are kept in side cache file and are read only if secrets are needed
+def load_client_yaml_cached(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, cache_dir, logger, secrets=True):
+    cache_file = "{0}/clients/{1}.pickle".format(cache_dir, hashlib.sha256(f.encode("utf-8")).hexdigest())
+    secrets_file = "{0}/clients/{1}.secrets.pickle".format(cache_dir, hashlib.sha256(f.encode("utf-8")).hexdigest())
+    cache_entry = load_cache_file(cache_file, logger)
+    if cache_entry is not None and client_cache_entry_valid(cache_entry):
+        if not secrets:
+            logger.info("Loaded asset YAML from file {0}/{1} via cache {2} without secrets".format(WORK_DIR, f, cache_file))
+            return cache_entry["dict"]
+        secrets_entry = load_cache_file(secrets_file, logger)
+        if secrets_entry is not None and secrets_entry["files"] == cache_entry["files"]:
+            logger.info("Loaded asset YAML from file {0}/{1} via cache {2}".format(WORK_DIR, f, cache_file))
+            return join_secrets(cache_entry["dict"], secrets_entry["secrets"])
+    sources = {"files": {}, "globs": {}}
+    yaml_dict = load_client_yaml(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, logger, sources, cache_dir)
+    stripped_dict, yaml_secrets = split_secrets(yaml_dict)
+    save_cache_file(secrets_file, {"files": sources["files"], "secrets": yaml_secrets}, logger)
+    save_cache_file(cache_file, {"files": sources["files"], "globs": sources["globs"], "dict": stripped_dict}, logger)
+    return yaml_dict if secrets else stripped_dict
+
+# Check client cache entry against current files
+def client_cache_entry_valid(cache_entry):
+    for include_glob, include_files in cache_entry["globs"].items():
+        if sorted(glob.glob(include_glob)) != include_files:
+            return False
+    for source_file, source_hash in cache_entry["files"].items():
+        try:
+            with open(source_file, 'rb') as hashed_file:
+                if hashlib.sha256(hashed_file.read()).hexdigest() != source_hash:
+                    return False
+        except OSError:
+            return False
+    return True
+
+# Logger with QueueHandler of set_logger for logger or its parents, returns logger name, queue and levels of it and its children
+def log_queue_of(logger):
+    queue_logger = logger
+    while queue_logger is not None:
+        for handler in queue_logger.handlers:
+            if isinstance(handler, QueueHandler):
+                log_levels = {queue_logger.name: queue_logger.level}
+                for logger_name, child_logger in logging.root.manager.loggerDict.items():
+                    if logger_name.startswith(queue_logger.name + ".") and isinstance(child_logger, logging.Logger):
+                        log_levels[logger_name] = child_logger.level
+                return queue_logger.name, handler.queue, log_levels
+        queue_logger = queue_logger.parent
+    return None, None, {}
+
+# Init worker process of ClientRegistry.preload, spawned workers do not inherit handlers and levels, so records are put to the parent log queue
+def load_client_yaml_worker_init(logger_name, log_queue, log_levels):
+    for level_logger_name, level in log_levels.items():
+        logging.getLogger(level_logger_name).setLevel(level)
+    if log_queue is not None:
+        logging.getLogger(logger_name).handlers = [QueueHandler(log_queue)]
+
+# Load asset YAML in worker process of ClientRegistry.preload, exception is returned instead of raised
+def load_client_yaml_worker(worker_args):
+    WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, logger, cache_dir, secrets = worker_args
+    try:
+        if cache_dir is not None:
+            return load_client_yaml_cached(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, cache_dir, logger, secrets), None
+        elif secrets:
+            return load_client_yaml(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, logger), None
+        else:
+            return split_secrets(load_client_yaml(WORK_DIR, f, CLIENTS_SUBDIR, YAML_GLOB, logger))[0], None
+    except LoadError as e:
+        return None, e
+    except Exception as e:
+        return None, LoadError("Loading client file {0}/{1} failed: {2}".format(WORK_DIR, f, e))
+
+# Client registry, loads each client YAML (with includes) once per run and serves later lookups from memory
+class ClientRegistry:
+
+    def __init__(self, WORK_DIR, CLIENTS_SUBDIR, YAML_GLOB, logger, cache_dir=None, snapshot=None, secrets=True):
+        self.WORK_DIR = WORK_DIR
+        self.CLIENTS_SUBDIR = CLIENTS_SUBDIR
+        self.YAML_GLOB = YAML_GLOB
+        self.logger = logger
+        # Persistent compiled cache dir, None to parse YAML every run
+        self.cache_dir = cache_dir
+        # Prebuilt ConfigSnapshot, None if not used
+        self.snapshot = snapshot
+        # Load secret sections (SECRET_KEYS) of clients, commands which do not need key material never read them
+        self.secrets = secrets
+        # client_file -> client_dict
+        self.by_file = {}
+        # client name lowercase -> client_file
+        self.by_name = {}
+        # client_file -> exception caught while preloading, raised on client access
+        self.errors = {}
+        # (client_file, tariff date) -> tuple of Asset records
+        self.asset_records = {}
+        # client name lowercase -> client_file from config snapshot and cache of previous runs, read on first use
+        self.name_index = None
+
+    # Client files in clients dir, with name only the file of client with this name
+    # Client file is looked up in name index, all client files are loaded and the index is rebuilt if the name is not found there
+    # Files with load errors are returned too, so the error is raised to the caller on load as without name
+    def files(self, name=None):
+        client_files = sorted(glob.glob("{0}/{1}".format(self.CLIENTS_SUBDIR, self.YAML_GLOB)))
+        if name is None:
+            return client_files
+        name = name.lower()
+        if self.name_index is None:
+            self.name_index = self.load_name_index()
+        if name in self.name_index and self.name_index[name] in client_files:
+            try:
+                if self.load(self.name_index[name])["name"].lower() == name:
+                    self.logger.info("Found client {0} in name index: {1}".format(name, self.name_index[name]))
+                    return [self.name_index[name]]
+            except Exception as e:
+                self.logger.warning("Loading client file {0} from name index failed: {1}".format(self.name_index[name], e))
+        self.logger.info("Client {0} not found in name index, loading all client files".format(name))
+        self.preload()
+        failed_files = []
+        for client_file in client_files:
+            try:
+                self.load(client_file)
+            except Exception as e:
+                self.logger.warning("Loading client file {0} failed while looking for client {1}: {2}".format(client_file, name, e))
+                failed_files.append(client_file)
+        self.name_index = dict(self.by_name)
+        self.save_name_index()
+        return [client_file for client_file in client_files if client_file in failed_files or self.by_file[client_file]["name"].lower() == name]
+
+    # Read client name index from config snapshot and cache
+    def load_name_index(self):
+        name_index = {}
+        if self.snapshot is not None:
+            for client_file, cache_entry in self.snapshot.clients.items():
+                name_index[cache_entry["dict"]["name"].lower()] = client_file
+        if self.cache_dir is not None:
+            name_index.update(load_cache_file("{0}/clients/name_index.pickle".format(self.cache_dir), self.logger) or {})
+        return name_index
+
+    # Save client name index to cache
+    def save_name_index(self):
+        if self.cache_dir is not None:
+            save_cache_file("{0}/clients/name_index.pickle".format(self.cache_dir), self.name_index, self.logger)
+
+    # Load client files in process pool to parse and merge include trees concurrently
+    # Errors are not raised here but on access to the client via load, the same way as without preloading
+    # Workers are spawned, not forked, as every process runs log listener thread and forking it can deadlock on locks held by the thread
+    def preload(self, processes=None):
+        client_files = [client_file for client_file in self.files() if client_file not in self.by_file and client_file not in self.errors]
+        # Clients with unchanged files are taken from config snapshot, only the rest is parsed
+        if self.snapshot is not None:
+            for client_file in client_files:
+                self.load_snapshot(client_file)
+            client_files = [client_file for client_file in client_files if client_file not in self.by_file]
+        if processes is None:
+            processes = int(os.environ.get("ACC_LOAD_PROCESSES", os.cpu_count() or 1))
+        if processes < 2 or len(client_files) < 2:
+            return
+        self.logger.info("Preloading {0} client files in {1} processes".format(len(client_files), processes))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(processes, len(client_files)), mp_context=multiprocessing.get_context("spawn"), initializer=load_client_yaml_worker_init, initargs=log_queue_of(self.logger)) as executor:
+            for client_file, (client_dict, error) in zip(client_files, executor.map(load_client_yaml_worker, [(self.WORK_DIR, client_file, self.CLIENTS_SUBDIR, self.YAML_GLOB, self.logger, self.cache_dir, self.secrets) for client_file in client_files])):
+                if error is not None:
+                    self.errors[client_file] = error
+                elif client_dict is None:
+                    self.errors[client_file] = LoadError("Config file error or missing: {0}/{1}".format(self.WORK_DIR, client_file))
+                else:
+                    self.by_file[client_file] = client_dict
+                    self.by_name[client_dict["name"].lower()] = client_file
+
+    # Load client YAML once, later calls are served from memory
+    def load(self, client_file):
+        if client_file in self.errors:
+            raise self.errors[client_file]
+        if client_file not in self.by_file and self.snapshot is not None:
+            self.load_snapshot(client_file)
+        if client_file not in self.by_file:
+            if self.cache_dir is not None:
+                client_dict = load_client_yaml_cached(self.WORK_DIR, client_file, self.CLIENTS_SUBDIR, self.YAML_GLOB, self.cache_dir, self.logger, self.secrets)
+            else:
+                client_dict = load_client_yaml(self.WORK_DIR, client_file, self.CLIENTS_SUBDIR, self.YAML_GLOB, self.logger)
+                if client_dict is not None and not self.secrets:
+                    client_dict = split_secrets(client_dict)[0]
+            if client_dict is None:
+                raise LoadError("Config file error or missing: {0}/{1}".format(self.WORK_DIR, client_file))
+            self.by_file[client_file] = client_dict
+            self.by_name[client_dict["name"].lower()] = client_file
+        return self.by_file[client_file]
+
+    # Take client from config snapshot if all its files are unchanged
+    def load_snapshot(self, client_file):
+        client_dict = self.snapshot.client(client_file, self.secrets)
+        if client_dict is not None:
+            self.logger.info("Loaded asset YAML from file {0}/{1} via config snapshot {2}".format(self.WORK_DIR, client_file, self.snapshot.snapshot_file))
+            self.by_file[client_file] = client_dict
+            self.by_name[client_dict["name"].lower()] = client_file
+
+    # Find client by name, client files are loaded until the name is found
+    def get(self, name):
+        if name.lower() not in self.by_name:
+            for client_file in self.files():
+                if client_file not in self.by_file:
+                    self.load(client_file)
+                    if name.lower() in self.by_name:
+                        break
+        if name.lower() not in self.by_name:
+            raise LoadError("Client {0} not found in {1}/{2}".format(name, self.WORK_DIR, self.CLIENTS_SUBDIR))
+        return self.by_file[self.by_name[name.lower()]]
+
+    # Active asset records of client, built once per client and tariff date
+    # Not active assets are left out before tariffs are resolved, so their tariff errors do not fail the client
+    def assets(self, client_file, tariff_catalog, at_datetime):
+        if (client_file, at_datetime) not in self.asset_records:
+            self.asset_records[(client_file, at_datetime)] = get_asset_records(self.load(client_file), tariff_catalog, at_datetime)
+        return self.asset_records[(client_file, at_datetime)]
+
+# Tariff catalog, loads each tariff file once per run and shares read-only tariff objects
+class TariffCatalog:
+
+    def __init__(self, WORK_DIR, TARIFFS_SUBDIR, logger, cache_dir=None, snapshot=None):
+        self.WORK_DIR = WORK_DIR
+        self.TARIFFS_SUBDIR = TARIFFS_SUBDIR
+        self.logger = logger
+        self.cache_dir = cache_dir
+        self.snapshot = snapshot
+        # tariff file -> read-only tariff dict
+        self.by_file = {}
+        # tariff file -> Tariff record
+        self.records = {}
+
+    # Load tariff file once, later calls are served from memory
+    def get(self, tariff_file):
+        if tariff_file not in self.by_file:
+            tariff_path = "{0}/{1}/{2}".format(self.WORK_DIR, self.TARIFFS_SUBDIR, tariff_file)
+            if self.cache_dir is not None or self.snapshot is not None:
+                tariff_dict = load_yaml_cached(tariff_path, self.cache_dir, self.logger, self.snapshot)
+            else:
+                tariff_dict = load_yaml(tariff_path, self.logger)
+            if tariff_dict is None:
+                raise LoadError("Tariff file error or missing: {0}".format(tariff_path))
+            self.by_file[tariff_file] = read_only(tariff_dict)
+        return self.by_file[tariff_file]
+
+    # Tariff dict for asset tariff item: file tariffs from catalog, inline plan and service as is
+    def resolve(self, asset_tariff):
+        if "file" in asset_tariff:
+            return self.get(asset_tariff["file"])
+        return asset_tariff
+
+    # Rate dict (rate, currency, optional woocommerce_product_id) of kind monthly, hourly or storage, None if tariff has no such rate
+    def rate(self, asset_tariff, kind):
+        return self.resolve(asset_tariff).get(kind)
+
+    # Tariff record for asset tariff item, file tariff records are built once per run
+    def record(self, asset_tariff):
+        if "file" in asset_tariff:
+            if asset_tariff["file"] not in self.records:
+                self.records[asset_tariff["file"]] = Tariff.from_dict(self.get(asset_tariff["file"]), asset_tariff["file"])
+            return self.records[asset_tariff["file"]]
+        return Tariff.from_dict(asset_tariff)
+
+    # Licenses of tariff
+    def licenses(self, asset_tariff):
+        return self.resolve(asset_tariff).get("licenses", [])
+
+    # Plan and service text for asset labels
+    def plan_label(self, asset_tariff):
+        tariff_dict = self.resolve(asset_tariff)
+        return "{0} {1}".format(tariff_dict["plan"], tariff_dict["service"])
+
+    # Service, plan and revision text for invoice rows
+    def plan_revision(self, asset_tariff):
+        tariff_dict = self.resolve(asset_tariff)
+        return tariff_dict["service"] + " " + tariff_dict["plan"] + " rev. " + str(tariff_dict["revision"])
+
+# Tariff catalogs shared within the process, keyed by tariffs dir
+tariff_catalogs = {}
+
+# Get shared tariff catalog for tariffs dir, cache_dir and snapshot are taken from the first call
+def get_tariff_catalog(WORK_DIR, TARIFFS_SUBDIR, logger, cache_dir=None, snapshot=None):
+    if (WORK_DIR, TARIFFS_SUBDIR) not in tariff_catalogs:
+        tariff_catalogs[(WORK_DIR, TARIFFS_SUBDIR)] = TariffCatalog(WORK_DIR, TARIFFS_SUBDIR, logger, cache_dir, snapshot)
+    return tariff_catalogs[(WORK_DIR, TARIFFS_SUBDIR)]
+
+# Config snapshot format version, snapshots of other versions are ignored
+CONFIG_SNAPSHOT_VERSION = 2
+
+# Path relative to WORK_DIR, paths outside of it are kept as is
+def work_dir_relative(path, WORK_DIR):
+    if path.startswith("{0}/".format(WORK_DIR)):
+        return path[len(WORK_DIR)+1:]
+    return path
+
+# Path under WORK_DIR for path relative to it, absolute paths are kept as is
+def work_dir_absolute(path, WORK_DIR):
+    if os.path.isabs(path):
+        return path
+    return "{0}/{1}".format(WORK_DIR, path)
+
+# Client cache entry with source files and include globs converted by path func, e.g. to keep them relative to WORK_DIR in snapshot
+def convert_client_entry_paths(cache_entry, path_func, WORK_DIR):
+    converted_entry = dict(cache_entry)
+    converted_entry["files"] = {path_func(source_file, WORK_DIR): source_hash for source_file, source_hash in cache_entry["files"].items()}
+    if "globs" in cache_entry:
+        converted_entry["globs"] = {path_func(include_glob, WORK_DIR): [path_func(include_file, WORK_DIR) for include_file in include_files] for include_glob, include_files in cache_entry["globs"].items()}
+    return converted_entry
+
+# Prebuilt config snapshot, accounting, tariff and client YAML files compiled into one pickle file
+# Each entry is used only while its source files have the same content hashes, changed files are loaded as usual
+# Client secret sections are kept in side file snapshot_file.secrets, read only if secrets are needed
+# Paths are kept relative to WORK_DIR in snapshot files, so snapshot built in one dir can be used in another, in memory they are under WORK_DIR
+class ConfigSnapshot:
+
+    def __init__(self, snapshot_file, WORK_DIR, logger):
+        self.snapshot_file = snapshot_file
+        self.WORK_DIR = WORK_DIR
+        self.logger = logger
+        snapshot = load_cache_file(snapshot_file, logger)
+        if snapshot is not None and snapshot.get("version") != CONFIG_SNAPSHOT_VERSION:
+            logger.warning("Config snapshot {0} version is not {1}, ignoring".format(snapshot_file, CONFIG_SNAPSHOT_VERSION))
+            snapshot = None
+        if snapshot is None:
+            snapshot = {"version": CONFIG_SNAPSHOT_VERSION, "yaml": {}, "clients": {}}
+        else:
+            logger.info("Loaded config snapshot {0} with {1} YAML files and {2} clients".format(snapshot_file, len(snapshot["yaml"]), len(snapshot["clients"])))
+        # YAML file -> (content hash, parsed YAML)
+        self.yaml = {work_dir_absolute(yaml_file, WORK_DIR): yaml_entry for yaml_file, yaml_entry in snapshot["yaml"].items()}
+        # client file -> client cache entry (files, globs, dict without secret sections)
+        self.clients = {client_file: convert_client_entry_paths(cache_entry, work_dir_absolute, WORK_DIR) for client_file, cache_entry in snapshot["clients"].items()}
+        # client file -> secrets entry (files, secret sections), read from side file on first use
+        self.secrets = None
+
+    # Check snapshot has YAML file with content hash
+    def has_yaml(self, f, yaml_hash):
+        return f in self.yaml and self.yaml[f][0] == yaml_hash
+
+    # Merged client dict if all client files are unchanged, None otherwise
+    def client(self, client_file, secrets=True):
+        if client_file in self.clients and client_cache_entry_valid(self.clients[client_file]):
+            if not secrets:
+                return self.clients[client_file]["dict"]
+            if self.secrets is None:
+                self.secrets = {secrets_client_file: convert_client_entry_paths(secrets_entry, work_dir_absolute, self.WORK_DIR) for secrets_client_file, secrets_entry in (load_cache_file("{0}.secrets".format(self.snapshot_file), self.logger) or {}).items()}
+            if client_file in self.secrets and self.secrets[client_file]["files"] == self.clients[client_file]["files"]:
+                return join_secrets(copy.deepcopy(self.clients[client_file]["dict"]), self.secrets[client_file]["secrets"])
+        return None
+
+# Build config snapshot from accounting YAML, all tariff and client files, loading them on the way
+# Errors are raised, broken config should not get into the snapshot
+def build_config_snapshot(snapshot_file, WORK_DIR, ACC_YAML, TARIFFS_SUBDIR, CLIENTS_SUBDIR, YAML_GLOB, logger):
+
+    snapshot = {"version": CONFIG_SNAPSHOT_VERSION, "yaml": {}, "clients": {}}
+    snapshot_secrets = {}
+
+    # Accounting YAML and tariffs
+    for yaml_path in ["{0}/{1}".format(WORK_DIR, ACC_YAML)] + sorted(glob.glob("{0}/{1}/{2}".format(WORK_DIR, TARIFFS_SUBDIR, YAML_GLOB))):
+        logger.info("Compiling YAML file {0} into config snapshot".format(yaml_path))
+        try:
+            with open(yaml_path, 'rb') as yaml_file:
+                yaml_bytes = yaml_file.read()
+            yaml_dict = yaml.load(yaml_bytes, Loader=YAML_SAFE_LOADER)
+        except:
+            raise LoadError("Reading YAML from file '{0}' failed".format(yaml_path))
+        if yaml_dict is None:
+            raise LoadError("Config file error or missing: {0}".format(yaml_path))
+        snapshot["yaml"][work_dir_relative(yaml_path, WORK_DIR)] = (hashlib.sha256(yaml_bytes).hexdigest(), yaml_dict)
+
+    # Clients with all their includes
+    for client_file in sorted(glob.glob("{0}/{1}".format(CLIENTS_SUBDIR, YAML_GLOB))):
+        logger.info("Compiling client file {0}/{1} into config snapshot".format(WORK_DIR, client_file))
+        sources = {"files": {}, "globs": {}}
+        client_dict = load_client_yaml(WORK_DIR, client_file, CLIENTS_SUBDIR, YAML_GLOB, logger, sources)
+        if client_dict is None:
+            raise LoadError("Config file error or missing: {0}/{1}".format(WORK_DIR, client_file))
+        stripped_dict, client_secrets = split_secrets(client_dict)
+        snapshot_secrets[client_file] = convert_client_entry_paths({"files": sources["files"], "secrets": client_secrets}, work_dir_relative, WORK_DIR)
+        snapshot["clients"][client_file] = convert_client_entry_paths({"files": sources["files"], "globs": sources["globs"], "dict": stripped_dict}, work_dir_relative, WORK_DIR)
+
+    # Save atomically, secrets first as snapshot without its secrets file is not used by commands needing secrets
+    save_cache_file("{0}.secrets".format(snapshot_file), snapshot_secrets, logger)
+    save_cache_file(snapshot_file, snapshot, logger)
+    logger.info("Saved config snapshot {0} with {1} YAML files and {2} clients".format(snapshot_file, len(snapshot["yaml"]), len(snapshot["clients"])))
+
+# Immutable record with __slots__, all fields are set once on creation and missing fields are None
+# Records are shared within the whole run and take much less memory than nested dicts
+class Record:
+
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields.get(name))
+
+    def _read_only(self, *args, **kwargs):
+        raise AttributeError("{0} record cannot be changed".format(type(self).__name__))
+
+    __setattr__ = _read_only
+    __delattr__ = _read_only
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__, ", ".join("{0}={1!r}".format(name, getattr(self, name)) for name in self.__slots__ if name != "data"))
+
+# Tariff record, file is None for inline tariffs
+class Tariff(Record):
+
+    __slots__ = ("file", "service", "plan", "revision", "monthly", "hourly", "storage", "licenses", "data")
+
+    @classmethod
+    def from_dict(cls, tariff_dict, tariff_file=None):
+        data = read_only(tariff_dict)
+        return cls(
+            file=tariff_file,
+            service=data.get("service"),
+            plan=data.get("plan"),
+            revision=data.get("revision"),
+            monthly=data.get("monthly"),
+            hourly=data.get("hourly"),
+            storage=data.get("storage"),
+            licenses=frozenset(data.get("licenses", [])),
+            data=data
+        )
+
+# Asset record with effective SSH connect params, tariff timeline and tariffs with licenses activated at the record tariff date
+class Asset(Record):
+
+    __slots__ = ("fqdn", "kind", "active", "os", "location", "description", "ssh_host", "ssh_port", "ssh_jump", "jobs_disabled", "jobs", "timeline", "tariffs", "licenses", "data")
+
+    @classmethod
+    def from_dict(cls, asset_dict, tariff_catalog, at_datetime):
+        data = read_only(asset_dict)
+        ssh = data.get("ssh", {})
+        if "jump" in ssh:
+            ssh_jump = "{host}:{port}".format(host=ssh["jump"]["host"], port=ssh["jump"]["port"] if "port" in ssh["jump"] else "22")
+        else:
+            ssh_jump = ""
+        timeline = TariffTimeline(data["tariffs"])
+        tariffs = tuple(tariff_catalog.record(asset_tariff) for asset_tariff in timeline.at(at_datetime)["tariffs"])
+        return cls(
+            fqdn=data["fqdn"],
+            kind=data.get("kind", "server"),
+            active=data["active"],
+            os=data.get("os"),
+            location=data.get("location"),
+            description=data.get("description"),
+            ssh_host=ssh.get("host", data["fqdn"]),
+            ssh_port=ssh.get("port", "22"),
+            ssh_jump=ssh_jump,
+            jobs_disabled=bool(data.get("jobs_disabled", False)),
+            jobs=data.get("jobs", ReadOnlyDict()),
+            timeline=timeline,
+            tariffs=tariffs,
+            licenses=frozenset().union(*[tariff.licenses for tariff in tariffs]),
+            data=data
+        )
+
+# Job record, level is GLOBAL, CLIENT or ASSET
+class Job(Record):
+
+    __slots__ = ("id", "level", "type", "cmd", "timeout", "tz", "each", "minutes", "hours", "days", "months", "years", "weekdays", "os_include", "os_exclude", "disabled", "licenses", "schedule", "data")
+
+    @classmethod
+    def from_dict(cls, job_id, job_level, job_dict, minutes_jitter):
+        data = read_only(job_dict)
+        job_os = data.get("os", {})
+        return cls(
+            id=job_id,
+            level=job_level,
+            type=data["type"],
+            cmd=data.get("cmd"),
+            timeout=data.get("timeout"),
+            tz=data["tz"],
+            each=data.get("each"),
+            minutes=data.get("minutes"),
+            hours=data.get("hours"),
+            days=data.get("days"),
+            months=data.get("months"),
+            years=data.get("years"),
+            weekdays=data.get("weekdays"),
+            os_include=job_os.get("include"),
+            os_exclude=job_os.get("exclude"),
+            disabled=bool(data.get("disabled", False)),
+            licenses=frozenset(data["licenses"]) if data.get("licenses") is not None else None,
+            schedule=CompiledSchedule.from_dict(data, minutes_jitter),
+            data=data
+        )
+
+    # Job dict with id and level as it is shown in logs
+    def as_dict(self):
+        return dict(self.data, id=self.id, level=self.level)
+
+# Job records of job dict, keyed by job id, schedules are compiled with minutes jitter
+def get_job_records(jobs_dict, job_level, minutes_jitter):
+    return {job_id: Job.from_dict(job_id, job_level, job_params, minutes_jitter) for job_id, job_params in jobs_dict.items()}
+
+# Get asset records one by one, filters (see asset_matches) are checked before records are built
+def iter_asset_records(client_dict, tariff_catalog, at_datetime, **filters):
+    for asset in client_asset_dicts(client_dict):
+        if asset_matches(asset, **filters):
+            yield Asset.from_dict(asset, tariff_catalog, at_datetime)
+
+# Get asset records of client, the same assets as get_asset_list but as immutable Asset records
+def get_asset_records(client_dict, tariff_catalog, at_datetime, only_active=True, **filters):
+    return tuple(iter_asset_records(client_dict, tariff_catalog, at_datetime, active=True if only_active else None, **filters))
+
+# Expand schedule list items like 5 or "1-5" to values, single values get jitter more values after them
+def expand_schedule_list(items, jitter=1):
+    values = []
+    for item in items:
+        if len(str(item).split("-")) > 1:
+            for value in range(int(str(item).split("-")[0]), int(str(item).split("-")[1])+1):
+                values.append(value)
+        else:
+            for value in range(item, item + jitter):
+                values.append(value)
+    return values
+
+# Weekday names of job weekdays lists by datetime.weekday()
+WEEKDAY_NAMES = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+# Job schedule compiled once per job definition
+# Run lists are expanded to frozensets, "each" is converted to seconds and job tz object is cached, fields without conditions are None
+class CompiledSchedule(Record):
+
+    __slots__ = ("tz", "each_seconds", "minutes", "hours", "days", "months", "years", "weekdays")
+
+    @classmethod
+    def from_dict(cls, job_dict, minutes_jitter):
+        each = job_dict.get("each")
+        if each is not None:
+            # Jobs are run on some minute within jitter, so wait less by double jitter, exact minutes (jitter 1) need no slack
+            each_seconds = 0-2*minutes_jitter*60 if minutes_jitter > 1 else 0
+            each_seconds += 60*60*24*365*each.get("years", 0)
+            each_seconds += 60*60*24*31*each.get("months", 0)
+            each_seconds += 60*60*24*7*each.get("weeks", 0)
+            each_seconds += 60*60*24*each.get("days", 0)
+            each_seconds += 60*60*each.get("hours", 0)
+            each_seconds += 60*each.get("minutes", 0)
+        else:
+            each_seconds = None
+        return cls(
+            tz=pytz.timezone(job_dict["tz"]),
+            each_seconds=each_seconds,
+            # Minutes get jitter, hours, days, months and years are exact
+            minutes=frozenset(expand_schedule_list(job_dict["minutes"], minutes_jitter)) if job_dict.get("minutes") is not None else None,
+            hours=frozenset(expand_schedule_list(job_dict["hours"])) if job_dict.get("hours") is not None else None,
+            days=frozenset(expand_schedule_list(job_dict["days"])) if job_dict.get("days") is not None else None,
+            months=frozenset(expand_schedule_list(job_dict["months"])) if job_dict.get("months") is not None else None,
+            years=frozenset(expand_schedule_list(job_dict["years"])) if job_dict.get("years") is not None else None,
+            weekdays=frozenset(job_dict["weekdays"]) if job_dict.get("weekdays") is not None else None
+        )
+
+    # Name of the first time condition not met by now (in schedule tz) after last run, None if job is due
+    def skip_reason(self, now, last_run):
+        if self.each_seconds is not None and (now - last_run).total_seconds() < self.each_seconds:
+            return "each"
+        if self.minutes is not None and now.minute not in self.minutes:
+            return "minutes"
+        if self.hours is not None and now.hour not in self.hours:
+            return "hours"
+        if self.days is not None and now.day not in self.days:
+            return "days"
+        if self.months is not None and now.month not in self.months:
+            return "months"
+        if self.years is not None and now.year not in self.years:
+            return "years"
+        if self.weekdays is not None and WEEKDAY_NAMES[now.weekday()] not in self.weekdays:
+            return "weekdays"
+        return None
+
+    # The same schedule due on minute 0 only if neither minutes nor each are set, for schedulers checking each minute instead of each run
+    def with_default_minutes(self):
+        if self.minutes is not None or self.each_seconds is not None:
+            return self
+        return CompiledSchedule(**dict({name: getattr(self, name) for name in self.__slots__}, minutes=frozenset([0])))
+
+    # Decide if job should be run at now (in schedule tz) after last run
+    def is_due(self, now, last_run):
+        return self.skip_reason(now, last_run) is None
+
+    # First whole minute at or after after, when job is due after last run, in schedule tz, None if there is none within horizon days
+    # Date conditions are checked first and not matching days and hours are skipped whole, so sparse schedules take few steps
+    def next_due(self, after, last_run, horizon_days=366*4):
+        candidate = after.astimezone(pytz.utc)
+        if self.each_seconds is not None:
+            candidate = max(candidate, last_run.astimezone(pytz.utc) + timedelta(seconds=self.each_seconds))
+        if candidate.second != 0 or candidate.microsecond != 0:
+            candidate = candidate.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = candidate + timedelta(days=horizon_days)
+        while candidate < limit:
+            now = candidate.astimezone(self.tz)
+            if (
+                (self.years is not None and now.year not in self.years) or
+                (self.months is not None and now.month not in self.months) or
+                (self.days is not None and now.day not in self.days) or
+                (self.weekdays is not None and WEEKDAY_NAMES[now.weekday()] not in self.weekdays)
+            ):
+                candidate = self.next_local(candidate, datetime.combine(now.date() + timedelta(days=1), time()))
+            elif self.hours is not None and now.hour not in self.hours:
+                candidate = self.next_local(candidate, datetime.combine(now.date(), time(now.hour)) + timedelta(hours=1))
+            elif self.minutes is not None and now.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return now
+        return None
+
+    # First UTC time after candidate at naive local time in schedule tz
+    # Local times repeated on DST change give the earlier one, skipped local times give the moment of the change
+    def next_local(self, candidate, local_datetime):
+        local_times = [self.tz.localize(local_datetime, is_dst=is_dst).astimezone(pytz.utc) for is_dst in [True, False]]
+        local_times = [local_time for local_time in local_times if local_time > candidate]
+        return min(local_times) if len(local_times) > 0 else candidate + timedelta(minutes=1)
+
+# Decide if job should be run at now (in job TZ) after job last run, time conditions only, skip reason is logged
+def job_is_due(job, asset_fqdn, now, job_last_run, logger):
+    reason = job.schedule.skip_reason(now, job_last_run)
+    if reason is None:
+        return True
+    if reason == "each":
+        logger.debug("Job %s/%s skipped because: %s seconds since last run < %s seconds needed to wait from \"each\" key", asset_fqdn, job.id, (now - job_last_run).total_seconds(), job.schedule.each_seconds)
+    else:
+        logger.debug("Job %s/%s skipped because now %s is not in run %s list", asset_fqdn, job.id, reason[:-1], reason)
+    return False
+
+# Mtimes and sizes of accounting, tariff and client YAML files with include dirs, to notice config changes in long running processes
+def config_sources_state(WORK_DIR, ACC_YAML, TARIFFS_SUBDIR, CLIENTS_SUBDIR):
+    paths = ["{0}/{1}".format(WORK_DIR, ACC_YAML)]
+    for subdir in [TARIFFS_SUBDIR, CLIENTS_SUBDIR]:
+        for dir_path, dir_names, file_names in os.walk("{0}/{1}".format(WORK_DIR, subdir)):
+            paths.extend(os.path.join(dir_path, file_name) for file_name in file_names)
+    state = {}
+    for path in paths:
+        try:
+            path_stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        state[path] = (path_stat.st_mtime_ns, path_stat.st_size)
+    return state
+
+# Effective job table format version, cached tables of other versions are rebuilt
+EFFECTIVE_JOB_TABLE_VERSION = 3
+
+# Effective jobs of client assets, keyed by asset fqdn: global jobs not overridden by client or asset jobs, client jobs not overridden by asset jobs, then asset jobs
+# Jobs excluded by asset os and disabled jobs are left out, licenses depend on tariff date and are checked per run
+class EffectiveJobTable:
+
+    def __init__(self, global_jobs, client_dict, minutes_jitter, logger):
+        client_jobs = get_job_records(client_dict["jobs"], "CLIENT", minutes_jitter) if "jobs" in client_dict else {}
+        self.assets = {}
+        for asset_dict in client_asset_dicts(client_dict):
+            if asset_dict["fqdn"] in self.assets:
+                raise LoadError("Asset {0} is listed more than once in client {1}".format(asset_dict["fqdn"], client_dict["name"]))
+            asset_jobs = get_job_records(asset_dict["jobs"], "ASSET", minutes_jitter) if "jobs" in asset_dict else {}
+            job_list = [job for job_id, job in global_jobs.items() if not (job_id in client_jobs or job_id in asset_jobs)]
+            job_list.extend(job for job_id, job in client_jobs.items() if job_id not in asset_jobs)
+            job_list.extend(asset_jobs.values())
+            effective_jobs = []
+            for job in job_list:
+                if job.os_include is not None and asset_dict.get("os") not in job.os_include:
+                    logger.debug("Job %s/%s left out because os %s is not in job os include list", asset_dict["fqdn"], job.id, asset_dict.get("os"))
+                elif job.os_exclude is not None and asset_dict.get("os") in job.os_exclude:
+                    logger.debug("Job %s/%s left out because os %s is in job os exclude list", asset_dict["fqdn"], job.id, asset_dict.get("os"))
+                elif job.disabled:
+                    logger.debug("Job %s/%s left out because it is disabled", asset_dict["fqdn"], job.id)
+                else:
+                    effective_jobs.append(job)
+            self.assets[asset_dict["fqdn"]] = tuple(effective_jobs)
+
+    # Effective jobs of asset
+    def jobs(self, asset_fqdn):
+        return self.assets.get(asset_fqdn, ())
+
+# Hash of everything effective job table of client depends on: global jobs, client jobs, asset os and asset jobs
+def effective_job_table_hash(global_jobs, client_dict, minutes_jitter):
+    return hashlib.sha256(json.dumps([
+        EFFECTIVE_JOB_TABLE_VERSION,
+        minutes_jitter,
+        [[job_id, job.data] for job_id, job in global_jobs.items()],
+        client_dict.get("jobs"),
+        [[asset_dict["fqdn"], asset_dict.get("os"), asset_dict.get("jobs")] for asset_dict in client_asset_dicts(client_dict)]
+    ], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+# Get effective job table of client, taken from cache_dir while the config hash of its sources is unchanged
+def get_effective_job_table(global_jobs, client_dict, minutes_jitter, cache_dir, logger):
+    config_hash = effective_job_table_hash(global_jobs, client_dict, minutes_jitter)
+    if cache_dir is not None:
+        cache_file = "{0}/jobs/{1}.pickle".format(cache_dir, hashlib.sha256(client_dict["name"].lower().encode("utf-8")).hexdigest())
+        cache_entry = load_cache_file(cache_file, logger)
+        if cache_entry is not None and cache_entry["hash"] == config_hash:
+            logger.info("Loaded effective job table of client {0} via cache {1}".format(client_dict["name"], cache_file))
+            return cache_entry["table"]
+    job_table = EffectiveJobTable(global_jobs, client_dict, minutes_jitter, logger)
+    if cache_dir is not None:
+        save_cache_file(cache_file, {"hash": config_hash, "table": job_table}, logger)
+    return job_table
+
+# Portion of monthly tariff to bill for needed month
+# The gap between activation and needed month is billed only if asset was added after last client billing date
+def monthly_period_portion(tariff, needed_month, last_client_billing_date):
+
+    # Get crucial dates
+    activated_date_date = datetime.strptime(tariff["activated_date"], "%Y-%m-%d")
+    added_date_date = datetime.strptime(tariff["added_date"], "%Y-%m-%d")
+    first_day_of_needed_month = needed_month.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    last_day_of_needed_month = first_day_of_needed_month + relativedelta(months=1, days=-1)
+    first_day_of_activated_date_month = activated_date_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    last_day_of_activated_date_month = first_day_of_activated_date_month + relativedelta(months=1, days=-1)
+
+    # Just add 1 portion for migrated assets, they were certainly billed before
+    if "migrated" in tariff:
+        return 1
+
+    # Calculate diff between activated_date_date and last_day_of_needed_month
+    # We need +1 for each whole month and +0.x for partial month
+
+    # Give +1 for each month between last_day_of_activated_date_month and last_day_of_needed_month
+    whole_months = (last_day_of_needed_month.year - last_day_of_activated_date_month.year) * 12 + last_day_of_needed_month.month - last_day_of_activated_date_month.month
+
+    # Give decimal for partial month
+    partial_month = (last_day_of_activated_date_month.day - activated_date_date.day + 1) / (last_day_of_activated_date_month.day)
+
+    # Period portion is a sum of all whole months and partial month
+    period_portion = round(whole_months + partial_month, 2)
+
+    # We need to decide if we need to bill portion > 1 if it is larger than 1
+    if period_portion > 1:
+
+        # If added_date_date <= last_client_billing_date --- no, the gap of billing was billed last time
+        if (added_date_date - last_client_billing_date).days <= 0:
+
+            # Just add one whole month
+            period_portion = 1
+
+    # If added_date_date > last_client_billing_date --- yes, we need to fill the gap of billing with portion > 1, so just leave portion as is
+
+    # If period_portion < 0 --- then activation_date is after last_day_of_needed_month, just take 0
+    if period_portion < 0:
+
+        period_portion = 0
+
+    return period_portion
+
+# Monthly invoice details row for asset tariff
+def monthly_details_item(asset_fqdn, tariff, monthly_period, period_portion):
+
+    # Calc employee share
+    price_in_period_employee_share = {}
+    if "monthly_employee_share" in tariff:
+        for empl_email, empl_share in tariff["monthly_employee_share"].items():
+            price_in_period_employee_share[empl_email] = round(empl_share * tariff["monthly"]["rate"] * period_portion / 100, 2)
+
+    return {
+        "asset_fqdn":                       asset_fqdn,
+        "activated_date":                   tariff["activated_date"],
+        "service":                          tariff["service"],
+        "plan":                             tariff["plan"],
+        "revision":                         tariff["revision"],
+        "tariff_plan":                      tariff["service"] + " " + tariff["plan"] + " rev. " + str(tariff["revision"]),
+        "tariff_currency":                  tariff["monthly"]["currency"],
+        "tariff_rate":                      tariff["monthly"]["rate"],
+        "period":                           monthly_period,
+        "period_portion":                   period_portion,
+        "price_in_period":                  round(tariff["monthly"]["rate"] * period_portion, 2),
+        "woocommerce_product_id":           tariff["monthly"]["woocommerce_product_id"] if "woocommerce_product_id" in tariff["monthly"] else None,
+        "price_in_period_employee_share":   price_in_period_employee_share
+    }
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import types
+import logging
+import pytest
+
+# jobs.py needs GitLab and PG client modules from requirements.txt
+pytest.importorskip("gitlab")
+pytest.importorskip("psycopg2")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from jobs import *
+
+# Job record with schedule of job dict
+def make_job(job_id, job_dict):
+    return Job.from_dict(job_id, "GLOBAL", dict({"type": "salt_cmd", "cmd": "test.ping", "timeout": 60, "tz": "Etc/UTC"}, **job_dict), DAEMON_MINUTES_JITTER)
+
+# Failed dispatch of popped job restores its last run and makes it due again after retry delay
+def test_job_schedule_retry():
+    key = ("Acme", "srv1.acme.example.com", "backup")
+    job = make_job("backup", {"each": {"hours": 6}})
+    now = datetime(2026, 3, 17, 9, 0, tzinfo=pytz.utc)
+    last_run = now - timedelta(days=1)
+    schedule = JobSchedule()
+    schedule.load({key: (None, None, job)}, {key: last_run}, now)
+    assert [due[:2] for due in schedule.pop_due(now)] == [(now, key)]
+    assert schedule.last_runs[key] == now
+    schedule.retry(key, now + timedelta(minutes=DAEMON_RETRY_MINUTES))
+    assert schedule.last_runs[key] == last_run
+    assert schedule.next_due_at() == now + timedelta(minutes=DAEMON_RETRY_MINUTES)
+    # Next due time pushed on pop is replaced by retry, so the job is popped once
+    assert [due[:2] for due in schedule.pop_due(now + timedelta(hours=1))] == [(now + timedelta(minutes=DAEMON_RETRY_MINUTES), key)]
+    assert schedule.next_due_at() == now + timedelta(minutes=DAEMON_RETRY_MINUTES) + timedelta(seconds=job.schedule.each_seconds)
+
+# Fake GitLab project, records created pipelines and has no tags
+class FakeProject:
+
+    default_branch = "master"
+
+    def __init__(self):
+        self.created = []
+        self.pipelines = self
+
+    def create(self, data):
+        self.created.append(data)
+        return types.SimpleNamespace(id=123, web_url="https://gitlab.example.com/acme/acme-salt/-/pipelines/123", status="created")
+
+# Api backend creates one default branch pipeline with job variables and returns its pipeline history row
+def test_job_dispatch_api_backend():
+    project = FakeProject()
+    client_dict = {"name": "Acme", "gitlab": {"salt_project": {"path": "acme/acme-salt", "api_dispatch": True}}}
+    asset = types.SimpleNamespace(fqdn="srv1.acme.example.com", ssh_host="10.0.0.1", ssh_port=2222, ssh_jump="")
+    job = make_job("test_ping", {"minutes": [0]})
+    now = datetime(2026, 3, 17, 9, 0, tzinfo=pytz.utc)
+    job_details, job_log_row, dispatch_func, dispatch_args = job_dispatch(client_dict, project, asset, job, now, "api", False, logging.getLogger("tests"))
+    assert job_log_row[1:4] == ("Acme", "srv1.acme.example.com", "test_ping")
+    assert dispatch_func(*dispatch_args) == ("pipeline_salt_cmd_history", ("srv1.acme.example.com", "acme/acme-salt", "60", "test.ping", "123", "https://gitlab.example.com/acme/acme-salt/-/pipelines/123", "created"))
+    assert project.created == [{"ref": "master", "variables": [
+        {"key": "JOB_TYPE", "value": "salt_cmd"},
+        {"key": "SALT_TARGET", "value": "srv1.acme.example.com"},
+        {"key": "SALT_TIMEOUT", "value": "60"},
+        {"key": "SALT_CMD", "value": "test.ping"}
+    ]}]
+    # Dry run creates nothing
+    job_details, job_log_row, dispatch_func, dispatch_args = job_dispatch(client_dict, project, asset, job, now, "api", True, logging.getLogger("tests"))
+    assert dispatch_func(*dispatch_args) is None
+    assert len(project.created) == 1
+    # Clients without api_dispatch are dispatched by script
+    client_dict["gitlab"]["salt_project"]["api_dispatch"] = False
+    job_details, job_log_row, dispatch_func, dispatch_args = job_dispatch(client_dict, project, asset, job, now, "api", True, logging.getLogger("tests"))
+    assert dispatch_func is dispatch_script
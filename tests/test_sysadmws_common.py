@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import logging
+import yaml
+import pytest
+from datetime import date
+from datetime import timedelta
+import pytz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sysadmws_common import *
+
+logger = logging.getLogger("tests")
+
+# Sample client, tariff and accounting.yaml files shipped with repo
+SAMPLE_YAML_FILES = ["clients/example.yaml", "tariffs/free-1.yaml", "accounting.yaml.example"]
+
+# Write YAML file, dirs are created as needed
+def write_yaml(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as yaml_file:
+        yaml.dump(data, yaml_file, default_flow_style=False)
+
+# Not active asset with future tariffs only, its tariff file is missing
+def test_client_registry_assets_skip_not_active(tmp_path, monkeypatch):
+    write_yaml("{0}/tariffs/basic.yaml".format(tmp_path), {"service": "Basic", "plan": "Server", "revision": 1, "licenses": ["backup"]})
+    write_yaml("{0}/clients/acme.yaml".format(tmp_path), {
+        "name": "Acme",
+        "active": True,
+        "gitlab": {},
+        "configuration_management": {"type": "salt-ssh"},
+        "assets": [
+            {"fqdn": "srv1.acme.example.com", "active": True, "kind": "server", "tariffs": [{"activated": date(2024, 1, 1), "added": date(2024, 1, 1), "tariffs": [{"file": "basic.yaml"}]}]},
+            {"fqdn": "srv2.acme.example.com", "active": False, "kind": "server", "tariffs": [{"activated": date(2030, 1, 1), "added": date(2030, 1, 1), "tariffs": [{"file": "missing.yaml"}]}]}
+        ]
+    })
+    monkeypatch.chdir(tmp_path)
+    client_registry = ClientRegistry(str(tmp_path), "clients", "*.yaml", logger)
+    tariff_catalog = TariffCatalog(str(tmp_path), "tariffs", logger)
+    assets = client_registry.assets("clients/acme.yaml", tariff_catalog, datetime(2025, 3, 17))
+    assert [asset.fqdn for asset in assets] == ["srv1.acme.example.com"]
+    assert assets[0].licenses == frozenset(["backup"])
+
+# Config snapshot built in one work dir is used for unchanged files after the work dir is moved
+def test_config_snapshot_moved_work_dir(tmp_path, monkeypatch):
+    build_dir = "{0}/build".format(tmp_path)
+    write_yaml("{0}/accounting.yaml".format(build_dir), {"jobs": {}})
+    write_yaml("{0}/tariffs/basic.yaml".format(build_dir), {"service": "Basic", "plan": "Server", "revision": 1})
+    write_yaml("{0}/clients/acme.yaml".format(build_dir), {"name": "Acme", "active": True, "include": {"dirs": ["acme"]}})
+    write_yaml("{0}/clients/acme/assets.yaml".format(build_dir), {"assets": [{"fqdn": "srv1.acme.example.com"}]})
+    monkeypatch.chdir(build_dir)
+    build_config_snapshot("{0}/config.snapshot".format(build_dir), build_dir, "accounting.yaml", "tariffs", "clients", "*.yaml", logger)
+    work_dir = "{0}/work".format(tmp_path)
+    os.rename(build_dir, work_dir)
+    monkeypatch.chdir(work_dir)
+    config_snapshot = ConfigSnapshot("{0}/config.snapshot".format(work_dir), work_dir, logger)
+    assert load_yaml_cached("{0}/tariffs/basic.yaml".format(work_dir), None, logger, config_snapshot)["plan"] == "Server"
+    assert config_snapshot.client("clients/acme.yaml")["assets"][0]["fqdn"] == "srv1.acme.example.com"
+    # Changed include is not taken from snapshot
+    write_yaml("{0}/clients/acme/assets.yaml".format(work_dir), {"assets": [{"fqdn": "srv2.acme.example.com"}]})
+    assert config_snapshot.client("clients/acme.yaml") is None
+
+# Effective jobs are looked up by asset fqdn, so asset listed twice is a config error
+def test_effective_job_table_duplicate_asset():
+    client_dict = {
+        "name": "Acme",
+        "configuration_management": {"type": "salt-ssh"},
+        "assets": [{"fqdn": "srv1.acme.example.com"}, {"fqdn": "srv1.acme.example.com", "jobs": {"backup": {"type": "salt_cmd", "cmd": "test.ping", "tz": "Etc/UTC"}}}]
+    }
+    with pytest.raises(LoadError):
+        EffectiveJobTable({}, client_dict, 1, logger)
+
+# Next due minute of schedule, found by checking each minute
+def next_due_scan(schedule, after, last_run, minutes):
+    candidate = after.astimezone(pytz.utc).replace(second=0, microsecond=0)
+    if candidate < after:
+        candidate += timedelta(minutes=1)
+    for minute in range(minutes):
+        if schedule.is_due(candidate.astimezone(schedule.tz), last_run):
+            return candidate
+        candidate += timedelta(minutes=1)
+    return None
+
+# Days and hours skipped on DST change days land on local midnight and hour starts
+def test_compiled_schedule_next_due_dst():
+    job_dicts = [
+        {"tz": "Europe/Berlin", "days": [30], "hours": [0], "minutes": [0]},
+        {"tz": "Europe/Berlin", "hours": [2], "minutes": [30]},
+        {"tz": "Europe/Berlin", "hours": [3]},
+        {"tz": "Europe/Berlin", "weekdays": ["Mon"], "hours": [1, 2, 3], "minutes": [15]},
+        {"tz": "America/New_York", "days": [2, 3], "hours": [0, 1, 2], "minutes": [5]},
+        {"tz": "America/New_York", "each": {"hours": 5}, "hours": ["1-3"], "minutes": [0]}
+    ]
+    afters = [
+        pytz.timezone("Europe/Berlin").localize(datetime(2026, 3, 29, 0, 30)),
+        pytz.timezone("Europe/Berlin").localize(datetime(2026, 3, 28, 23, 59)),
+        pytz.timezone("Europe/Berlin").localize(datetime(2026, 10, 25, 1, 45)),
+        pytz.timezone("America/New_York").localize(datetime(2026, 3, 8, 0, 10)),
+        pytz.timezone("America/New_York").localize(datetime(2026, 11, 1, 0, 59))
+    ]
+    for job_dict in job_dicts:
+        for minutes_jitter in [1, 10]:
+            schedule = CompiledSchedule.from_dict(job_dict, minutes_jitter)
+            for after in afters:
+                last_run = after - timedelta(hours=3)
+                assert schedule.next_due(after, last_run, horizon_days=40) == next_due_scan(schedule, after, last_run, 40*24*60)
+    schedule = CompiledSchedule.from_dict(job_dicts[0], 1)
+    assert schedule.next_due(afters[0], afters[0]) == pytz.timezone("Europe/Berlin").localize(datetime(2026, 3, 30, 0, 0))
+
+# Schedules checked each minute run jobs without minutes and each once per hour, not each minute of it
+def test_compiled_schedule_with_default_minutes():
+    schedule = CompiledSchedule.from_dict({"tz": "Etc/UTC", "hours": [3]}, 1).with_default_minutes()
+    after = datetime(2026, 3, 17, 0, 0, tzinfo=pytz.utc)
+    last_run = after - timedelta(days=1)
+    due = []
+    while True:
+        due_at = schedule.next_due(after, last_run, horizon_days=1)
+        if due_at is None or due_at >= datetime(2026, 3, 18, 0, 0, tzinfo=pytz.utc):
+            break
+        due.append(due_at)
+        last_run = due_at
+        after = due_at + timedelta(minutes=1)
+    assert due == [datetime(2026, 3, 17, 3, 0, tzinfo=pytz.utc)]
+    each_schedule = CompiledSchedule.from_dict({"tz": "Etc/UTC", "hours": [3], "each": {"minutes": 30}}, 1)
+    assert each_schedule.with_default_minutes() is each_schedule
+    # Exact minutes need no each slack, jittered ones wait less by double jitter
+    assert each_schedule.each_seconds == 30*60
+    assert CompiledSchedule.from_dict({"tz": "Etc/UTC", "each": {"minutes": 30}}, 10).each_seconds == 10*60
+
+# Libyaml based loader used by load_yaml gives the same output as pure Python loader for sample files
+@pytest.mark.parametrize("yaml_file", SAMPLE_YAML_FILES)
+def test_yaml_loader_parity(yaml_file):
+    if YAML_SAFE_LOADER is yaml.SafeLoader:
+        pytest.skip("PyYAML is built without libyaml, nothing to compare")
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), yaml_file), "rb") as sample_file:
+        yaml_bytes = sample_file.read()
+    assert yaml.load(yaml_bytes, Loader=yaml.SafeLoader) == yaml.load(yaml_bytes, Loader=YAML_SAFE_LOADER)